@@ -4,9 +4,19 @@ import streamlit as st
 
 from moviepy.video.io.VideoFileClip import VideoFileClip
 
-from riffusion.streamlit.tasks.model_processing import predict, pipe_and_device_generate
-from riffusion.streamlit.tasks.video_processing import split_video, add_audio_to_video
-from riffusion.streamlit.tasks.utils import archive_files, calculate_required_width, display_videos_in_columns
+from riffusion.inference_scheduler import QueueFullError
+from riffusion.streamlit.tasks.model_processing import (
+    AUDIO_SAMPLE_RATE, predict, pipe_and_device_generate, warmup
+)
+from riffusion.streamlit.tasks.video_processing import (
+    SPLIT_MODES, SPLIT_THREADS_PER_WORKER, add_audio_to_video, default_split_workers
+)
+from riffusion.streamlit.tasks.split_cache import get_split_cache
+from riffusion.streamlit.tasks.utils import (
+    UploadTooLargeError, archive_files, calculate_required_width, display_cut_points,
+    display_videos_in_columns, save_uploaded_file
+)
+from riffusion.streamlit.tasks.workspace import touch_session_workspaces
 
 
 def main():
@@ -27,6 +37,9 @@ def main():
 
     st.markdown("<h1 style='text-align: center;'>Video Manipulator</h1>", unsafe_allow_html=True)
 
+    warmup()
+    touch_session_workspaces()
+
     with st.expander("About˙✧˖°"):
         st.write("""
         - **🎞️:** Splits your video into multiple parts.
@@ -51,12 +64,13 @@ def main():
     input_video = st.file_uploader("Upload a video file", type=["mp4", "mov", "avi"])
     if input_video:
         if st.session_state.input_video_path is None:
-            temp_dir = "temp"
-            os.makedirs(temp_dir, exist_ok=True)
-
-            st.session_state.input_video_path = os.path.join(temp_dir, input_video.name)
-            with open(st.session_state.input_video_path, "wb") as f:
-                f.write(input_video.read())
+            try:
+                st.session_state.input_video_path, st.session_state.input_video_hash = (
+                    save_uploaded_file(input_video, "temp")
+                )
+            except UploadTooLargeError as e:
+                st.error(str(e))
+                return
 
         n_parts = st.number_input(
             "Enter the number of parts to split the video into",
@@ -70,12 +84,27 @@ def main():
             help="Recommend optimizing the number of columns if the number of parts "
                  "exceeds 10 or more to avoid long down scrolling ¨̮ "
         )
+        split_mode = st.selectbox(
+            "Select the split mode",
+            SPLIT_MODES,
+            help="reencode: exact cuts, slowest. copy: cuts on the nearest keyframes without "
+                 "re-encoding, fastest. accurate: exact cuts, re-encodes only around each cut."
+        )
         if st.button("Split Video"):
             with st.spinner('Splitting video, please wait...✨'):
-                st.session_state.output_dir, st.session_state.generated_files = split_video(
-                    st.session_state.input_video_path, n_parts)
+                output_dir, generated_files, cut_points = get_split_cache().split(
+                    st.session_state.input_video_path,
+                    st.session_state.input_video_hash,
+                    n_parts,
+                    mode=split_mode,
+                    workers=default_split_workers(n_parts),
+                    threads_per_worker=SPLIT_THREADS_PER_WORKER
+                )
+                st.session_state.output_dir = output_dir
+                st.session_state.generated_files = generated_files
                 st.divider()
                 st.write(f"**Video has been split into {n_parts} parts and saved**")
+                display_cut_points(cut_points)
                 display_videos_in_columns(st.session_state.generated_files, num_columns)
                 st.divider()
 
@@ -110,6 +139,11 @@ def main():
                 value=30, min_value=10, step=1,
                 help="🕒 of training"
             )
+            tiled = st.checkbox(
+                "Tiled generation",
+                help="Generate long parts as 512 px wide tiles stitched together. Faster and "
+                     "lighter on memory for long parts, at some cost in musical coherence."
+            )
 
             if st.button("Generate and Add Audio"):
                 if prompt:
@@ -118,27 +152,37 @@ def main():
                         video_duration = video_clip.duration
                         width_for_audio = calculate_required_width(video_duration) + 320
                         pipe, device = pipe_and_device_generate()
-                        audio_path, spec = predict(
-                            prompt,
-                            negative_prompt,
-                            width_for_audio,
-                            seeds,
-                            num_inference_steps,
-                            str(device)
-                        )
-                        st.image(spec, caption="Generated Spectrogram")
-                        add_audio_to_video(video_part_path, audio_path, output_video_path)
-                        st.session_state.generated_files.append(output_video_path)
-                        st.write(
-                            f"Audio added to video part {st.session_state.part_to_add_audio} and saved as {output_video_path}"
-                        )
-                        st.session_state.zip_name = archive_files(st.session_state.generated_files)
+                        try:
+                            audio, spec = predict(
+                                prompt,
+                                negative_prompt,
+                                width_for_audio,
+                                seeds,
+                                num_inference_steps,
+                                str(device),
+                                tiled=tiled
+                            )
+                        except QueueFullError as e:
+                            st.error(f"{e}, the server is busy. Please try again in a moment.")
+                        else:
+                            st.image(spec, caption="Generated Spectrogram")
+                            add_audio_to_video(
+                                video_part_path, audio, output_video_path,
+                                sample_rate=AUDIO_SAMPLE_RATE
+                            )
+                            st.session_state.generated_files.append(output_video_path)
+                            st.write(
+                                f"Audio added to video part {st.session_state.part_to_add_audio} and saved as {output_video_path}"
+                            )
+                            st.session_state.zip_name = archive_files(
+                                st.session_state.generated_files
+                            )
                 else:
                     st.warning("Prompt must be provided to generate audio.")
 
         if 'zip_name' in st.session_state:
             with open(st.session_state.zip_name, "rb") as f:
-                st.download_button("Download ZIP", f, file_name=st.session_state.zip_name)
+                st.download_button("Download ZIP", f, file_name=os.path.basename(st.session_state.zip_name))
 
 
 if __name__ == "__main__":
@@ -4,9 +4,19 @@ import uuid
 import streamlit as st
 
 from moviepy.video.io.VideoFileClip import VideoFileClip
-from riffusion.streamlit.tasks.model_processing import predict, pipe_and_device_generate
-from riffusion.streamlit.tasks.video_processing import split_video, add_audio_to_video
-from riffusion.streamlit.tasks.utils import archive_files, calculate_required_width, display_videos_in_columns
+from riffusion.inference_scheduler import QueueFullError
+from riffusion.streamlit.tasks.model_processing import (
+    AUDIO_SAMPLE_RATE, predict, pipe_and_device_generate, warmup
+)
+from riffusion.streamlit.tasks.video_processing import (
+    SPLIT_MODES, SPLIT_THREADS_PER_WORKER, add_audio_to_video, default_split_workers
+)
+from riffusion.streamlit.tasks.split_cache import get_split_cache
+from riffusion.streamlit.tasks.utils import (
+    UploadTooLargeError, archive_files, calculate_required_width, display_cut_points,
+    display_videos_in_columns, save_uploaded_file
+)
+from riffusion.streamlit.tasks.workspace import touch_session_workspaces
 
 
 def main():
@@ -19,6 +29,9 @@ def main():
     st.set_page_config(page_title="Video Manipulator", page_icon="🎥")
     st.markdown("<h1 style='text-align: center;'>Video Manipulator</h1>", unsafe_allow_html=True)
 
+    warmup()
+    touch_session_workspaces()
+
     pages = ["Upload Video", "Split Video", "Generate Audio", "Download"]
     if 'page' not in st.session_state:
         st.session_state.page = pages[0]
@@ -39,11 +52,13 @@ def upload_video_page():
     st.markdown("### Upload Video")
     input_video = st.file_uploader("Upload a video file", type=["mp4", "mov", "avi"])
     if input_video:
-        temp_dir = "temp"
-        os.makedirs(temp_dir, exist_ok=True)
-        st.session_state.input_video_path = os.path.join(temp_dir, input_video.name)
-        with open(st.session_state.input_video_path, "wb") as f:
-            f.write(input_video.read())
+        try:
+            st.session_state.input_video_path, st.session_state.input_video_hash = (
+                save_uploaded_file(input_video, "temp")
+            )
+        except UploadTooLargeError as e:
+            st.error(str(e))
+            return
         st.session_state.page = "Split Video"
         st.rerun()
 
@@ -60,13 +75,27 @@ def split_video_page():
             min_value=3,
             value=5, step=1
         )
+        split_mode = st.selectbox(
+            "Select the split mode",
+            SPLIT_MODES,
+            help="reencode: exact cuts, slowest. copy: cuts on the nearest keyframes without "
+                 "re-encoding, fastest. accurate: exact cuts, re-encodes only around each cut."
+        )
 
         if st.button("Split Video"):
             with st.spinner('Splitting video, please wait...✨'):
-                st.session_state.output_dir, st.session_state.generated_files = split_video(
-                    st.session_state.input_video_path, n_parts
+                output_dir, generated_files, cut_points = get_split_cache().split(
+                    st.session_state.input_video_path,
+                    st.session_state.input_video_hash,
+                    n_parts,
+                    mode=split_mode,
+                    workers=default_split_workers(n_parts),
+                    threads_per_worker=SPLIT_THREADS_PER_WORKER
                 )
+                st.session_state.output_dir = output_dir
+                st.session_state.generated_files = generated_files
                 st.write(f"**Video has been split into {n_parts} parts and saved**")
+                display_cut_points(cut_points)
 
         if 'generated_files' in st.session_state and st.session_state.generated_files:
             display_videos_in_columns(st.session_state.generated_files, num_columns)
@@ -107,6 +136,11 @@ def generate_audio_page():
             "Enter the number of inference steps",
             value=30, min_value=10, step=1
         )
+        tiled = st.checkbox(
+            "Tiled generation",
+            help="Generate long parts as 512 px wide tiles stitched together. Faster and "
+                 "lighter on memory for long parts, at some cost in musical coherence."
+        )
 
         if st.button("Generate and Add Audio"):
             if prompt:
@@ -115,12 +149,19 @@ def generate_audio_page():
                     video_duration = video_clip.duration
                     width_for_audio = calculate_required_width(video_duration) + 320
                     pipe, device = pipe_and_device_generate()
-                    audio_path, spec = predict(
-                        prompt, negative_prompt,
-                        width_for_audio, seeds, num_inference_steps, str(device)
-                    )
+                    try:
+                        audio, spec = predict(
+                            prompt, negative_prompt,
+                            width_for_audio, seeds, num_inference_steps, str(device),
+                            tiled=tiled
+                        )
+                    except QueueFullError as e:
+                        st.error(f"{e}, the server is busy. Please try again in a moment.")
+                        return
                     st.image(spec, caption="Generated Spectrogram")
-                    add_audio_to_video(video_part_path, audio_path, output_video_path)
+                    add_audio_to_video(
+                        video_part_path, audio, output_video_path, sample_rate=AUDIO_SAMPLE_RATE
+                    )
                     st.session_state.generated_files.append(output_video_path)
                     st.write(f"Audio added to video part {part_to_add_audio} and saved as {output_video_path}")
                     st.session_state.last_output_video = output_video_path
@@ -142,10 +183,10 @@ def download_page():
 
     if 'zip_name' in st.session_state:
         with open(st.session_state.zip_name, "rb") as f:
-            if st.download_button("Download ZIP", f, file_name=st.session_state.zip_name):
+            if st.download_button("Download ZIP", f, file_name=os.path.basename(st.session_state.zip_name)):
                 for key in [
                     'generated_files', 'output_dir',
-                    'input_video_path', 'part_to_add_audio',
+                    'input_video_path', 'input_video_hash', 'part_to_add_audio',
                     'zip_name', 'last_output_video'
                 ]:
                     if key in st.session_state:
@@ -0,0 +1,145 @@
+"""
+Benchmark the array-backed audio processing in riffusion.util.audio_util against the previous
+pydub implementations, reporting the time of each and how far apart the outputs are.
+
+Usage:
+    python -m benchmarks.audio_util_benchmark
+"""
+import time
+import typing as T
+
+import numpy as np
+import pydub
+
+from riffusion.util import audio_util, waveform_util
+
+SAMPLE_RATE = 44100
+DURATIONS_S = [5.0, 30.0, 120.0]
+NUM_STITCH_SEGMENTS = [4, 16, 64]
+NUM_OVERLAY_SEGMENTS = [2, 8, 16]
+NUM_REPEATS = 3
+
+
+def reference_apply_filters(
+    segment: pydub.AudioSegment, compression: bool = False
+) -> pydub.AudioSegment:
+    """
+    The implementation of audio_util.apply_filters before it moved to numpy.
+    """
+    if compression:
+        segment = pydub.effects.normalize(segment, headroom=0.1)
+        segment = segment.apply_gain(-10 - segment.dBFS)
+        segment = pydub.effects.compress_dynamic_range(
+            segment,
+            threshold=-20.0,
+            ratio=4.0,
+            attack=5.0,
+            release=50.0,
+        )
+
+    segment = segment.apply_gain(-12 - segment.dBFS)
+    return pydub.effects.normalize(segment, headroom=0.1)
+
+
+def reference_stitch_segments(
+    segments: T.Sequence[pydub.AudioSegment], crossfade_s: float
+) -> pydub.AudioSegment:
+    """
+    The implementation of audio_util.stitch_segments before it moved to numpy.
+    """
+    crossfade_ms = int(crossfade_s * 1000)
+    combined_segment = segments[0]
+    for segment in segments[1:]:
+        combined_segment = combined_segment.append(segment, crossfade=crossfade_ms)
+    return combined_segment
+
+
+def reference_overlay_segments(segments: T.Sequence[pydub.AudioSegment]) -> pydub.AudioSegment:
+    """
+    The implementation of audio_util.overlay_segments before it moved to numpy.
+    """
+    output = segments[0]
+    for segment in segments[1:]:
+        output = output.overlay(segment)
+    return output
+
+
+def test_segment(duration_s: float, seed: int = 0) -> pydub.AudioSegment:
+    """
+    Tones with a loudness envelope plus noise, so the compressor has something to do.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration_s * SAMPLE_RATE)) / SAMPLE_RATE
+    envelope = 0.2 + 0.8 * (np.sin(2 * np.pi * 0.5 * t) > 0)
+    waveform = 0.02 * rng.standard_normal(t.size)
+    for frequency, amplitude in ((110.0, 0.4), (330.0, 0.2), (880.0, 0.1)):
+        waveform += amplitude * envelope * np.sin(2 * np.pi * frequency * t)
+    return audio_util.audio_from_waveform(waveform[None].astype(np.float32), SAMPLE_RATE, True)
+
+
+def best_time(func: T.Callable[[], pydub.AudioSegment]) -> T.Tuple[float, pydub.AudioSegment]:
+    result = func()
+    best_s = float("inf")
+    for _ in range(NUM_REPEATS):
+        start = time.perf_counter()
+        result = func()
+        best_s = min(best_s, time.perf_counter() - start)
+    return best_s, result
+
+
+def max_difference(actual: pydub.AudioSegment, expected: pydub.AudioSegment) -> float:
+    """
+    Largest sample difference as a fraction of full scale, or inf if the lengths differ.
+    """
+    a = waveform_util.from_segment(actual)
+    b = waveform_util.from_segment(expected)
+    if a.shape != b.shape:
+        return float("inf")
+    return float(np.max(np.abs(a - b)))
+
+
+def report(name: str, reference: T.Callable, current: T.Callable) -> None:
+    reference_s, expected = best_time(reference)
+    current_s, actual = best_time(current)
+    print(
+        f"{name:<36} pydub {1000 * reference_s:9.1f} ms   numpy {1000 * current_s:8.1f} ms   "
+        f"speedup {reference_s / current_s:7.1f}x   max diff {max_difference(actual, expected):.2e}"
+    )
+
+
+def main() -> None:
+    for duration_s in DURATIONS_S:
+        segment = test_segment(duration_s)
+        report(
+            f"apply_filters {duration_s:.0f}s",
+            lambda: reference_apply_filters(segment),
+            lambda: audio_util.apply_filters(segment),
+        )
+
+        # The pydub compressor is per sample in Python, only time it on the short input
+        if duration_s <= 5.0:
+            report(
+                f"apply_filters compression {duration_s:.0f}s",
+                lambda: reference_apply_filters(segment, compression=True),
+                lambda: audio_util.apply_filters(segment, compression=True),
+            )
+
+    for num_segments in NUM_STITCH_SEGMENTS:
+        segments = [test_segment(5.0, seed=i) for i in range(num_segments)]
+        report(
+            f"stitch_segments x{num_segments}",
+            lambda: reference_stitch_segments(segments, crossfade_s=0.2),
+            lambda: audio_util.stitch_segments(segments, crossfade_s=0.2),
+        )
+
+    for num_segments in NUM_OVERLAY_SEGMENTS:
+        segments = [test_segment(30.0, seed=i) for i in range(num_segments)]
+        report(
+            f"overlay_segments x{num_segments}",
+            lambda: reference_overlay_segments(segments),
+            lambda: audio_util.overlay_segments(segments),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Benchmark the spectrogram <-> image conversions in riffusion.util.image_util against the
+previous implementation, checking that the output is bit-identical.
+
+Usage:
+    python -m benchmarks.image_util_benchmark
+"""
+import time
+import tracemalloc
+import typing as T
+
+import numpy as np
+from PIL import Image
+
+from riffusion.util import image_util
+
+WIDTHS = [512, 1024, 2048, 4096, 8192]
+HEIGHT = 512
+NUM_REPEATS = 5
+
+
+def reference_image_from_spectrogram(spectrogram: np.ndarray, power: float = 0.25) -> Image.Image:
+    """
+    The implementation of image_util.image_from_spectrogram before it was optimized.
+    """
+    max_value = np.max(spectrogram)
+    data = spectrogram / max_value
+    data = np.power(data, power)
+    data = data * 255
+    data = 255 - data
+    data = data.astype(np.uint8)
+
+    if data.shape[0] == 1:
+        image = Image.fromarray(data[0], mode="L").convert("RGB")
+    elif data.shape[0] == 2:
+        data = np.array([np.zeros_like(data[0]), data[0], data[1]]).transpose(1, 2, 0)
+        image = Image.fromarray(data, mode="RGB")
+    else:
+        raise NotImplementedError(f"Unsupported number of channels: {data.shape[0]}")
+
+    return image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+
+
+def reference_spectrogram_from_image(
+    image: Image.Image,
+    power: float = 0.25,
+    stereo: bool = False,
+    max_value: float = 30e6,
+) -> np.ndarray:
+    """
+    The implementation of image_util.spectrogram_from_image before it was optimized.
+    """
+    if image.mode in ("P", "L"):
+        image = image.convert("RGB")
+
+    image = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+
+    data = np.array(image).transpose(2, 0, 1)
+    if stereo:
+        data = data[[1, 2], :, :]
+    else:
+        data = data[0:1, :, :]
+
+    data = data.astype(np.float32)
+    data = 255 - data
+    data = data / 255
+    data = np.power(data, 1 / power)
+    data = data * max_value
+
+    return data
+
+
+def measure(func: T.Callable[[], T.Any]) -> T.Tuple[float, int, T.Any]:
+    """
+    Best wall time over NUM_REPEATS runs and peak traced memory of one run.
+    """
+    result = func()
+
+    tracemalloc.start()
+    func()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best_s = float("inf")
+    for _ in range(NUM_REPEATS):
+        start = time.perf_counter()
+        func()
+        best_s = min(best_s, time.perf_counter() - start)
+
+    return best_s, peak_bytes, result
+
+
+def report(name: str, width: int, old: T.Tuple[float, int], new: T.Tuple[float, int]) -> None:
+    print(
+        f"{name:<24} width={width:<5} "
+        f"time {old[0] * 1e3:8.2f} ms -> {new[0] * 1e3:8.2f} ms ({old[0] / new[0]:4.1f}x)   "
+        f"peak {old[1] / 2**20:7.1f} MiB -> {new[1] / 2**20:7.1f} MiB"
+    )
+
+
+def main() -> None:
+    rng = np.random.default_rng(0)
+
+    for channels in (1, 2):
+        stereo = channels == 2
+        print(f"\n{'stereo' if stereo else 'mono'}")
+
+        for width in WIDTHS:
+            spectrogram = rng.gamma(0.5, 1e5, size=(channels, HEIGHT, width)).astype(np.float32)
+
+            old_t, old_m, old_image = measure(
+                lambda: reference_image_from_spectrogram(spectrogram)
+            )
+            new_t, new_m, new_image = measure(
+                lambda: image_util.image_from_spectrogram(spectrogram)
+            )
+            assert np.array_equal(np.asarray(old_image), np.asarray(new_image))
+            report("image_from_spectrogram", width, (old_t, old_m), (new_t, new_m))
+
+            old_t, old_m, old_spec = measure(
+                lambda: reference_spectrogram_from_image(old_image, stereo=stereo)
+            )
+            new_t, new_m, new_spec = measure(
+                lambda: image_util.spectrogram_from_image(old_image, stereo=stereo)
+            )
+            assert np.array_equal(old_spec, new_spec)
+            report("spectrogram_from_image", width, (old_t, old_m), (new_t, new_m))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Compare the accuracy and latency of the inverse mel methods in SpectrogramConverter.
+
+For a synthetic test signal at several spectrogram widths, reports the time to convert mel
+amplitudes back to linear amplitudes and the relative errors of the result against the true
+linear amplitudes and, after re-applying the mel scale, against the input mel amplitudes.
+
+Usage:
+    python -m benchmarks.inverse_mel_benchmark [--device cpu]
+"""
+import argparse
+import dataclasses
+import time
+import typing as T
+
+import numpy as np
+import torch
+
+from riffusion.spectrogram_converter import INVERSE_MEL_METHODS, SpectrogramConverter
+from riffusion.spectrogram_params import SpectrogramParams
+
+# Spectrogram widths in frames, including the ones generated for long video parts
+WIDTHS = [512, 1024, 2048, 5376]
+NUM_REPEATS = 3
+
+
+def test_waveform(num_samples: int, sample_rate: int) -> torch.Tensor:
+    """
+    A few harmonic tones with vibrato plus some noise, as a (1, samples) tensor.
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(num_samples) / sample_rate
+    waveform = 0.01 * rng.standard_normal(num_samples)
+    vibrato = 0.5 * np.sin(2 * np.pi * 5.0 * t)
+    for frequency, amplitude in ((110.0, 0.5), (220.0, 0.3), (440.0, 0.2), (1320.0, 0.1)):
+        waveform += amplitude * np.sin(2 * np.pi * frequency * t + vibrato)
+    return torch.from_numpy(waveform.astype(np.float32))[None]
+
+
+def synchronize(device: str) -> None:
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def time_call(func: T.Callable[[], torch.Tensor], device: str) -> T.Tuple[float, torch.Tensor]:
+    result = func()
+    best_s = float("inf")
+    for _ in range(NUM_REPEATS):
+        synchronize(device)
+        start = time.perf_counter()
+        result = func()
+        synchronize(device)
+        best_s = min(best_s, time.perf_counter() - start)
+    return best_s, result
+
+
+def relative_error(actual: torch.Tensor, expected: torch.Tensor) -> float:
+    return float(torch.linalg.norm(actual - expected) / torch.linalg.norm(expected))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    base_params = SpectrogramParams()
+    converters = {
+        method: SpectrogramConverter(
+            dataclasses.replace(base_params, inverse_mel_method=method), device=args.device
+        )
+        for method in INVERSE_MEL_METHODS
+    }
+    reference = converters[INVERSE_MEL_METHODS[0]]
+
+    print(f"{'width':>6} {'method':>6} {'time':>10} {'linear err':>11} {'mel err':>9}")
+    for width in WIDTHS:
+        num_samples = (width - 1) * base_params.hop_length
+        waveform = test_waveform(num_samples, base_params.sample_rate).to(reference.device)
+
+        with torch.no_grad():
+            linear = torch.abs(reference.spectrogram_func(waveform))
+            mel = reference.mel_scaler(linear)
+
+        for method, converter in converters.items():
+            with torch.no_grad():
+                elapsed_s, estimate = time_call(
+                    lambda: converter.linear_amplitudes_from_mel_amplitudes(mel), args.device
+                )
+                mel_error = relative_error(reference.mel_scaler(estimate), mel)
+
+            print(
+                f"{width:>6} {method:>6} {elapsed_s * 1e3:>8.1f}ms "
+                f"{relative_error(estimate, linear):>11.4f} {mel_error:>9.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare the latency and quality of the phase reconstruction methods in SpectrogramConverter.
+
+Quality is the spectral convergence ||S - |STFT(x)||| / ||S|| of the reconstructed waveform x
+against the linear amplitudes S it was reconstructed from (lower is better).
+
+Usage:
+    python -m benchmarks.phase_reconstruction_benchmark [--device cpu] [--tolerance 1e-3]
+"""
+import argparse
+import dataclasses
+import time
+
+import torch
+
+from benchmarks.inverse_mel_benchmark import relative_error, synchronize, test_waveform
+from riffusion.phase_reconstruction import PHASE_RECONSTRUCTION_METHODS
+from riffusion.spectrogram_converter import SpectrogramConverter
+from riffusion.spectrogram_params import SpectrogramParams
+
+WIDTHS = [512, 2048]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--tolerance", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    base_params = SpectrogramParams()
+
+    print(f"{'width':>6} {'method':>22} {'tolerance':>9} {'time':>10} {'convergence':>11}")
+    for width in WIDTHS:
+        num_samples = (width - 1) * base_params.hop_length
+        waveform = test_waveform(num_samples, base_params.sample_rate)
+
+        for method in PHASE_RECONSTRUCTION_METHODS:
+            for tolerance in sorted({0.0, args.tolerance}):
+                if method in ("griffin_lim", "pghi") and tolerance > 0:
+                    continue
+
+                params = dataclasses.replace(
+                    base_params, phase_reconstruction=method, griffin_lim_tolerance=tolerance
+                )
+                converter = SpectrogramConverter(params, device=args.device)
+
+                with torch.no_grad():
+                    linear = torch.abs(converter.spectrogram_func(waveform.to(converter.device)))
+
+                    synchronize(args.device)
+                    start = time.perf_counter()
+                    reconstructed = converter.waveform_from_linear_amplitudes(linear)
+                    synchronize(args.device)
+                    elapsed_s = time.perf_counter() - start
+
+                    convergence = relative_error(
+                        torch.abs(converter.spectrogram_func(reconstructed)), linear
+                    )
+
+                print(
+                    f"{width:>6} {method:>22} {tolerance:>9.0e} "
+                    f"{elapsed_s * 1e3:>8.1f}ms {convergence:>11.4f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
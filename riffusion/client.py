@@ -0,0 +1,114 @@
+"""
+Client for the riffusion inference server in riffusion.server.
+"""
+from __future__ import annotations
+
+import dataclasses
+import io
+import json
+import os
+import typing as T
+
+import pydub
+import requests
+from PIL import Image
+
+from riffusion.datatypes import InferenceInput, InferenceOutput
+from riffusion.util import base64_util, binary_util
+
+# Environment variable with the base URL of the inference server, e.g. http://127.0.0.1:3013
+SERVER_URL_ENV = "RIFFUSION_SERVER_URL"
+
+
+def server_url() -> T.Optional[str]:
+    """
+    Base URL of the inference server to use, or None to run the model in process.
+    """
+    return os.environ.get(SERVER_URL_ENV) or None
+
+
+class RiffusionClient:
+    """
+    Runs inference requests against a riffusion inference server.
+
+    Keeps a connection open across requests.
+    """
+
+    def __init__(self, url: str, timeout_s: float = 600.0):
+        self.url = url.rstrip("/")
+        self.timeout_s = timeout_s
+        self._session = requests.Session()
+
+    def run_inference(self, inputs: InferenceInput) -> InferenceOutput:
+        """
+        Raises:
+            requests.HTTPError: If the server rejects the request or fails to serve it
+        """
+        response = self._session.post(
+            f"{self.url}/run_inference/",
+            json=dataclasses.asdict(inputs),
+            timeout=self.timeout_s,
+        )
+        response.raise_for_status()
+        return InferenceOutput(**response.json())
+
+    def run(
+        self,
+        inputs: InferenceInput,
+        binary: bool = True,
+        audio_format: str = "pcm_s16le",
+        image_format: str = "jpeg",
+    ) -> T.Tuple[Image.Image, pydub.AudioSegment]:
+        """
+        Run inference and decode the spectrogram image and audio of the output.
+
+        Args:
+            inputs: The input dataclass
+            binary: Receive raw bytes in binary frames rather than base64 encoded JSON
+            audio_format: Audio format of the binary frames, see riffusion.server.AUDIO_FORMATS
+            image_format: Image format of the binary frames, see riffusion.server.IMAGE_FORMATS
+        """
+        if not binary:
+            output = self.run_inference(inputs)
+            image = Image.open(base64_util.decode(output.image)).convert("RGB")
+            segment = pydub.AudioSegment.from_file(base64_util.decode(output.audio), format="mp3")
+            return image, segment
+
+        response = self._session.post(
+            f"{self.url}/run_inference/",
+            params=dict(audio_format=audio_format, image_format=image_format),
+            json=dataclasses.asdict(inputs),
+            headers={"Accept": binary_util.CONTENT_TYPE},
+            timeout=self.timeout_s,
+        )
+        response.raise_for_status()
+
+        frames = binary_util.frames_by_name(binary_util.decode_frames(response.content))
+        metadata = json.loads(frames["metadata"].data)
+
+        image = Image.open(io.BytesIO(frames["image"].data)).convert("RGB")
+
+        audio = frames["audio"].data
+        if metadata["audio_format"] == "pcm_s16le":
+            segment = pydub.AudioSegment(
+                data=audio,
+                sample_width=metadata["sample_width"],
+                frame_rate=metadata["sample_rate"],
+                channels=metadata["channels"],
+            )
+        else:
+            segment = pydub.AudioSegment.from_file(
+                io.BytesIO(audio), format=metadata["audio_format"]
+            )
+
+        return image, segment
+
+    def health(self) -> T.Dict[str, T.Any]:
+        response = self._session.get(f"{self.url}/health", timeout=self.timeout_s)
+        response.raise_for_status()
+        return response.json()
+
+    def metrics(self) -> T.Dict[str, T.Any]:
+        response = self._session.get(f"{self.url}/metrics", timeout=self.timeout_s)
+        response.raise_for_status()
+        return response.json()
@@ -56,6 +56,10 @@ class InferenceInput:
     # ID of mask image to use
     mask_image_id: T.Optional[str] = None
 
+    # Width of the generated spectrogram in pixels, the seed image is tiled or cropped to it.
+    # Defaults to the width of the seed image.
+    width: T.Optional[int] = None
+
 
 @dataclass(frozen=True)
 class InferenceOutput:
@@ -0,0 +1,323 @@
+"""
+Cache of CLIP text embeddings, shared by the pipelines of a process.
+
+Prompts repeat a lot, and encoding one costs a full text encoder forward pass. Embeddings are
+kept in memory up to a byte limit, either on the device they are used on or offloaded to CPU,
+and optionally on disk so that they survive restarts and are shared between processes. The
+disk tier is bounded in size too, and only ever loads plain tensors from it.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import typing as T
+
+import torch
+
+# Total size of embeddings held in memory before the least recently used ones are dropped
+EMBEDDING_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Environment variable to enable the disk tier, e.g. on a volume shared by replicas
+EMBEDDING_CACHE_DIR_ENV = "RIFFUSION_EMBEDDING_CACHE_DIR"
+
+# Total size of embeddings on disk before the least recently used ones are deleted
+EMBEDDING_CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024
+
+# Fraction of the disk limit the disk tier is pruned down to, so it isn't rescanned every write
+EMBEDDING_CACHE_DISK_PRUNE_RATIO = 0.9
+
+
+@dataclasses.dataclass(frozen=True)
+class EmbeddingKey:
+    """
+    Identifies one text embedding in the cache.
+    """
+
+    # Fingerprint of the tokenizer and text encoder, see encoder_fingerprint
+    encoder: str
+
+    # Prompt text
+    text: str
+
+    # Whether the prompt was parsed for attention weights
+    weighted: bool = False
+
+    # Maximum multiple of the tokenizer length for long weighted prompts
+    max_embeddings_multiples: int = 1
+
+    def digest(self) -> str:
+        """
+        Stable hash of the key, used as the file name in the disk tier.
+        """
+        payload = json.dumps(dataclasses.asdict(self), sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def encoder_fingerprint(tokenizer: T.Any, text_encoder: torch.nn.Module) -> str:
+    """
+    Hash identifying a tokenizer and text encoder pair and the dtype it runs in.
+
+    Covers the model config, the vocabulary and the values of the last parameter of the
+    encoder, which is small to read but differs between checkpoints of the same architecture.
+    """
+    fingerprint = hashlib.sha256()
+
+    config = getattr(text_encoder, "config", None)
+    if config is not None and hasattr(config, "to_json_string"):
+        fingerprint.update(config.to_json_string().encode("utf-8"))
+    fingerprint.update(str(getattr(tokenizer, "name_or_path", "")).encode("utf-8"))
+    fingerprint.update(str(len(tokenizer)).encode("utf-8"))
+    fingerprint.update(str(tokenizer.model_max_length).encode("utf-8"))
+
+    parameters = list(text_encoder.parameters())
+    if parameters:
+        last = parameters[-1].detach()
+        fingerprint.update(str(last.dtype).encode("utf-8"))
+        fingerprint.update(last.float().cpu().numpy().tobytes())
+
+    return fingerprint.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of text embeddings bounded by their memory footprint.
+
+    Embeddings are stored on the device they were requested for, or on CPU with
+    `offload_to_cpu` and copied to the device on every hit, trading a small copy for device
+    memory. With a disk directory, misses in memory are looked up on disk before the
+    embedding is computed, and computed embeddings are written there. Entries are written to
+    a temporary file and moved in place, so concurrent processes never read a partial file.
+    The directory may be shared, so files are loaded with weights_only and the least recently
+    used ones are deleted once they take more than disk_max_bytes.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+        offload_to_cpu: bool = False,
+        disk_dir: T.Optional[str] = None,
+        disk_max_bytes: int = EMBEDDING_CACHE_DISK_MAX_BYTES,
+    ):
+        """
+        Args:
+            max_bytes: Drop least recently used embeddings from memory beyond this size
+            offload_to_cpu: Keep embeddings in CPU memory instead of on their device
+            disk_dir: Directory of the disk tier, defaults to $RIFFUSION_EMBEDDING_CACHE_DIR.
+                      No disk tier if neither is set.
+            disk_max_bytes: Delete least recently used embeddings from disk beyond this size
+        """
+        self.max_bytes = max_bytes
+        self.offload_to_cpu = offload_to_cpu
+        self.disk_dir = disk_dir or os.environ.get(EMBEDDING_CACHE_DIR_ENV) or None
+        self.disk_max_bytes = disk_max_bytes
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+        # Size of the disk tier as of the last scan plus what was written since, None until
+        # the first write
+        self._disk_bytes: T.Optional[int] = None
+
+        self._entries: T.OrderedDict[
+            T.Tuple[EmbeddingKey, str], torch.Tensor
+        ] = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        self.num_hits = 0
+        self.num_disk_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    def get(self, key: EmbeddingKey, device: str) -> T.Optional[torch.Tensor]:
+        """
+        Return the embedding for the key on the given device, or None on a miss.
+        """
+        storage_device = self._storage_device(device)
+
+        with self._lock:
+            embedding = self._entries.get((key, storage_device))
+            if embedding is not None:
+                self._entries.move_to_end((key, storage_device))
+                self.num_hits += 1
+
+        if embedding is None:
+            embedding = self._read_disk(key)
+            if embedding is None:
+                with self._lock:
+                    self.num_misses += 1
+                return None
+            with self._lock:
+                self.num_disk_hits += 1
+            embedding = self._store(key, storage_device, embedding)
+
+        return embedding.to(device, non_blocking=True)
+
+    def put(self, key: EmbeddingKey, device: str, embedding: torch.Tensor) -> torch.Tensor:
+        """
+        Add an embedding computed on the given device. Returns it on that device.
+        """
+        embedding = embedding.detach()
+        self._store(key, self._storage_device(device), embedding)
+        self._write_disk(key, embedding)
+        return embedding
+
+    def get_or_compute(
+        self, key: EmbeddingKey, device: str, compute: T.Callable[[], torch.Tensor]
+    ) -> torch.Tensor:
+        """
+        Return the cached embedding for the key, computing and adding it on a miss.
+        """
+        embedding = self.get(key, device)
+        if embedding is None:
+            embedding = self.put(key, device, compute())
+        return embedding
+
+    def clear(self) -> None:
+        """
+        Drop all embeddings from memory. The disk tier is kept.
+        """
+        with self._lock:
+            self.num_evictions += len(self._entries)
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        """
+        Hit rate and memory held by the cache.
+        """
+        with self._lock:
+            lookups = self.num_hits + self.num_disk_hits + self.num_misses
+            return dict(
+                num_entries=len(self._entries),
+                total_bytes=self._total_bytes,
+                max_bytes=self.max_bytes,
+                num_hits=self.num_hits,
+                num_disk_hits=self.num_disk_hits,
+                num_misses=self.num_misses,
+                num_evictions=self.num_evictions,
+                hit_rate=(self.num_hits + self.num_disk_hits) / lookups if lookups else 0.0,
+                offload_to_cpu=self.offload_to_cpu,
+                disk_dir=self.disk_dir,
+                disk_max_bytes=self.disk_max_bytes,
+            )
+
+    def _storage_device(self, device: str) -> str:
+        return "cpu" if self.offload_to_cpu else str(device)
+
+    def _store(
+        self, key: EmbeddingKey, storage_device: str, embedding: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Keep an embedding in memory on the storage device, evicting to fit the limit.
+        """
+        embedding = embedding.to(storage_device)
+        num_bytes = embedding.numel() * embedding.element_size()
+        if num_bytes > self.max_bytes:
+            return embedding
+
+        with self._lock:
+            previous = self._entries.pop((key, storage_device), None)
+            if previous is not None:
+                self._total_bytes -= previous.numel() * previous.element_size()
+
+            self._entries[(key, storage_device)] = embedding
+            self._total_bytes += num_bytes
+
+            while self._total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted.numel() * evicted.element_size()
+                self.num_evictions += 1
+
+        return embedding
+
+    def _disk_path(self, key: EmbeddingKey) -> T.Optional[str]:
+        if not self.disk_dir:
+            return None
+        return os.path.join(self.disk_dir, f"{key.digest()}.pt")
+
+    def _read_disk(self, key: EmbeddingKey) -> T.Optional[torch.Tensor]:
+        path = self._disk_path(key)
+        if path is None:
+            return None
+        try:
+            # Only tensors, the directory may be writable by others
+            embedding = torch.load(path, map_location="cpu", weights_only=True)
+        except (OSError, RuntimeError, EOFError, pickle.UnpicklingError):
+            # Missing, or unreadable, in which case the next put overwrites it
+            return None
+
+        # The file mtime is the last access time used for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return embedding
+
+    def _write_disk(self, key: EmbeddingKey, embedding: torch.Tensor) -> None:
+        path = self._disk_path(key)
+        if path is None or os.path.exists(path):
+            return
+
+        fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(embedding.cpu(), f)
+            num_bytes = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += num_bytes
+            prune = self._disk_bytes is None or self._disk_bytes > self.disk_max_bytes
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """
+        Delete the least recently used embeddings on disk until they fit in a fraction of
+        disk_max_bytes. Other processes may be deleting them at the same time.
+        """
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".pt"):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(num_bytes for _, num_bytes, _ in files)
+        if total > self.disk_max_bytes:
+            target = EMBEDDING_CACHE_DISK_PRUNE_RATIO * self.disk_max_bytes
+            for _, num_bytes, path in sorted(files):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= num_bytes
+
+        with self._lock:
+            self._disk_bytes = total
@@ -8,6 +8,7 @@ License: Apache 2.0
 # ruff: noqa
 # mypy: ignore-errors
 
+import functools
 import logging
 import re
 import typing as T
@@ -17,6 +18,9 @@ from diffusers import StableDiffusionPipeline
 
 logger = logging.getLogger(__name__)
 
+# Number of distinct prompts whose parsed attention and tokens are memoized
+PROMPT_CACHE_SIZE = 1024
+
 
 re_attention = re.compile(
     r"""
@@ -72,7 +76,14 @@ def parse_prompt_attention(text):
      ['sky', 1.4641000000000006],
      ['.', 1.1]]
     """
+    return [list(pair) for pair in _parse_prompt_attention(text)]
+
 
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _parse_prompt_attention(text):
+    """
+    Memoized parse_prompt_attention, with immutable pairs so that results can be shared.
+    """
     res = []
     round_brackets = []
     square_brackets = []
@@ -121,7 +132,38 @@ def parse_prompt_attention(text):
         else:
             i += 1
 
-    return res
+    return tuple((text, weight) for text, weight in res)
+
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def tokenize_prompt_with_weights(tokenizer, text: str, max_length: int):
+    r"""
+    Parse a prompt for attention and tokenize it, with the weight of each token. Memoized.
+
+    All fragments of the prompt are tokenized in a single tokenizer call. No padding, starting or
+    ending token is included.
+
+    Returns a tuple of token ids, a tuple of weights and whether the prompt was truncated.
+    """
+    texts_and_weights = _parse_prompt_attention(text)
+
+    # tokenize and discard the starting and the ending token
+    fragments = tokenizer([word for word, _ in texts_and_weights]).input_ids
+
+    text_token = []
+    text_weight = []
+    for token, (_, weight) in zip(fragments, texts_and_weights):
+        token = token[1:-1]
+        text_token += token
+        # copy the weight by length of token
+        text_weight += [weight] * len(token)
+        # stop if the text is too long (longer than truncation limit)
+        if len(text_token) > max_length:
+            break
+
+    # truncate
+    truncated = len(text_token) > max_length
+    return tuple(text_token[:max_length]), tuple(text_weight[:max_length]), truncated
 
 
 def get_prompts_with_weights(pipe: StableDiffusionPipeline, prompt: T.List[str], max_length: int):
@@ -133,26 +175,12 @@ def get_prompts_with_weights(pipe: StableDiffusionPipeline, prompt: T.List[str],
     weights = []
     truncated = False
     for text in prompt:
-        texts_and_weights = parse_prompt_attention(text)
-        text_token = []
-        text_weight = []
-        for word, weight in texts_and_weights:
-            # tokenize and discard the starting and the ending token
-            token = pipe.tokenizer(word).input_ids[1:-1]
-            text_token += token
-            # copy the weight by length of token
-            text_weight += [weight] * len(token)
-            # stop if the text is too long (longer than truncation limit)
-            if len(text_token) > max_length:
-                truncated = True
-                break
-        # truncate
-        if len(text_token) > max_length:
-            truncated = True
-            text_token = text_token[:max_length]
-            text_weight = text_weight[:max_length]
-        tokens.append(text_token)
-        weights.append(text_weight)
+        text_token, text_weight, text_truncated = tokenize_prompt_with_weights(
+            pipe.tokenizer, text, max_length
+        )
+        tokens.append(list(text_token))
+        weights.append(list(text_weight))
+        truncated = truncated or text_truncated
     if truncated:
         logger.warning(
             "Prompt was truncated. Try to shorten the prompt or increase max_embeddings_multiples"
@@ -165,28 +193,34 @@ def pad_tokens_and_weights(
 ):
     r"""
     Pad the tokens (with starting and ending tokens) and weights (with 1.0) to max_length.
+
+    Returns a (batch, max_length) tensor of token ids and a float32 tensor of weights, of length
+    max_length, or of one chunk_length per chunk if not no_boseos_middle. Each is filled through
+    a mask in one assignment, rather than element by element.
     """
     max_embeddings_multiples = (max_length - 2) // (chunk_length - 2)
-    weights_length = max_length if no_boseos_middle else max_embeddings_multiples * chunk_length
-    for i in range(len(tokens)):
-        tokens[i] = [bos] + tokens[i] + [eos] * (max_length - 1 - len(tokens[i]))
-        if no_boseos_middle:
-            weights[i] = [1.0] + weights[i] + [1.0] * (max_length - 1 - len(weights[i]))
-        else:
-            w = []
-            if len(weights[i]) == 0:
-                w = [1.0] * weights_length
-            else:
-                for j in range(max_embeddings_multiples):
-                    w.append(1.0)  # weight for starting token in this chunk
-                    w += weights[i][
-                        j * (chunk_length - 2) : min(len(weights[i]), (j + 1) * (chunk_length - 2))
-                    ]
-                    w.append(1.0)  # weight for ending token in this chunk
-                w += [1.0] * (weights_length - len(w))
-            weights[i] = w[:]
+    batch_size = len(tokens)
+    body_length = max_length - 2
 
-    return tokens, weights
+    lengths = torch.tensor([len(token) for token in tokens], dtype=torch.long)
+    mask = torch.arange(body_length)[None, :] < lengths[:, None]
+
+    token_body = torch.full((batch_size, body_length), eos, dtype=torch.long)
+    token_body[mask] = torch.tensor([t for token in tokens for t in token], dtype=torch.long)
+    padded_tokens = torch.nn.functional.pad(token_body, (1, 0), value=bos)
+    padded_tokens = torch.nn.functional.pad(padded_tokens, (0, 1), value=eos)
+
+    weight_body = torch.ones((batch_size, body_length), dtype=torch.float32)
+    weight_body[mask] = torch.tensor([w for weight in weights for w in weight], dtype=torch.float32)
+    if no_boseos_middle:
+        padded_weights = torch.nn.functional.pad(weight_body, (1, 1), value=1.0)
+    else:
+        # weight 1.0 for the starting and the ending token of every chunk
+        padded_weights = weight_body.view(batch_size, max_embeddings_multiples, chunk_length - 2)
+        padded_weights = torch.nn.functional.pad(padded_weights, (1, 1), value=1.0)
+        padded_weights = padded_weights.reshape(batch_size, max_embeddings_multiples * chunk_length)
+
+    return padded_tokens, padded_weights
 
 
 def get_unweighted_text_embeddings(
@@ -198,34 +232,41 @@ def get_unweighted_text_embeddings(
     """
     When the length of tokens is a multiple of the capacity of the text encoder,
     it should be split into chunks and sent to the text encoder individually.
+
+    The chunks of all prompts are stacked into a single batch, so the text encoder runs once.
     """
     max_embeddings_multiples = (text_input.shape[1] - 2) // (chunk_length - 2)
     if max_embeddings_multiples > 1:
-        text_embeddings = []
-        for i in range(max_embeddings_multiples):
-            # extract the i-th chunk
-            text_input_chunk = text_input[
-                :, i * (chunk_length - 2) : (i + 1) * (chunk_length - 2) + 2
-            ].clone()
-
-            # cover the head and the tail by the starting and the ending tokens
-            text_input_chunk[:, 0] = text_input[0, 0]
-            text_input_chunk[:, -1] = text_input[0, -1]
-            text_embedding = pipe.text_encoder(text_input_chunk)[0]
-
-            if no_boseos_middle:
-                if i == 0:
-                    # discard the ending token
-                    text_embedding = text_embedding[:, :-1]
-                elif i == max_embeddings_multiples - 1:
-                    # discard the starting token
-                    text_embedding = text_embedding[:, 1:]
-                else:
-                    # discard both starting and ending tokens
-                    text_embedding = text_embedding[:, 1:-1]
-
-            text_embeddings.append(text_embedding)
-        text_embeddings = torch.concat(text_embeddings, axis=1)
+        batch_size = text_input.shape[0]
+
+        # extract all chunks at once, the i-th one overlapping the next by its two end tokens
+        device = text_input.device
+        starts = torch.arange(max_embeddings_multiples, device=device) * (chunk_length - 2)
+        index = starts[:, None] + torch.arange(chunk_length, device=device)[None, :]
+        text_input_chunks = text_input[:, index]
+
+        # cover the head and the tail by the starting and the ending tokens
+        text_input_chunks[:, :, 0] = text_input[0, 0]
+        text_input_chunks[:, :, -1] = text_input[0, -1]
+
+        text_embeddings = pipe.text_encoder(text_input_chunks.reshape(-1, chunk_length))[0]
+        text_embeddings = text_embeddings.view(
+            batch_size, max_embeddings_multiples, chunk_length, -1
+        )
+
+        if no_boseos_middle:
+            # discard the ending token of the first chunk, the starting token of the last one
+            # and both from the chunks in the middle
+            text_embeddings = torch.cat(
+                [
+                    text_embeddings[:, 0, :-1],
+                    text_embeddings[:, 1:-1, 1:-1].flatten(1, 2),
+                    text_embeddings[:, -1, 1:],
+                ],
+                dim=1,
+            )
+        else:
+            text_embeddings = text_embeddings.flatten(1, 2)
     else:
         text_embeddings = pipe.text_encoder(text_input)[0]
     return text_embeddings
@@ -318,7 +359,7 @@ def get_weighted_text_embeddings(
         no_boseos_middle=no_boseos_middle,
         chunk_length=pipe.tokenizer.model_max_length,
     )
-    prompt_tokens = torch.tensor(prompt_tokens, dtype=torch.long, device=pipe.device)
+    prompt_tokens = prompt_tokens.to(pipe.device)
     if uncond_prompt is not None:
         uncond_tokens, uncond_weights = pad_tokens_and_weights(
             uncond_tokens,
@@ -329,26 +370,28 @@ def get_weighted_text_embeddings(
             no_boseos_middle=no_boseos_middle,
             chunk_length=pipe.tokenizer.model_max_length,
         )
-        uncond_tokens = torch.tensor(uncond_tokens, dtype=torch.long, device=pipe.device)
+        uncond_tokens = uncond_tokens.to(pipe.device)
 
-    # get the embeddings
-    text_embeddings = get_unweighted_text_embeddings(
-        pipe,
-        prompt_tokens,
-        pipe.tokenizer.model_max_length,
-        no_boseos_middle=no_boseos_middle,
-    )
-    prompt_weights = torch.tensor(prompt_weights, dtype=text_embeddings.dtype, device=pipe.device)
+    # get the embeddings, of the prompts and the unconditional prompts in one batch
     if uncond_prompt is not None:
-        uncond_embeddings = get_unweighted_text_embeddings(
+        embeddings = get_unweighted_text_embeddings(
             pipe,
-            uncond_tokens,
+            torch.cat([prompt_tokens, uncond_tokens]),
             pipe.tokenizer.model_max_length,
             no_boseos_middle=no_boseos_middle,
         )
-        uncond_weights = torch.tensor(
-            uncond_weights, dtype=uncond_embeddings.dtype, device=pipe.device
+        text_embeddings, uncond_embeddings = embeddings.split(
+            [prompt_tokens.shape[0], uncond_tokens.shape[0]]
+        )
+        uncond_weights = uncond_weights.to(device=pipe.device, dtype=uncond_embeddings.dtype)
+    else:
+        text_embeddings = get_unweighted_text_embeddings(
+            pipe,
+            prompt_tokens,
+            pipe.tokenizer.model_max_length,
+            no_boseos_middle=no_boseos_middle,
         )
+    prompt_weights = prompt_weights.to(device=pipe.device, dtype=text_embeddings.dtype)
 
     # assign weights to the prompts and normalize in the sense of mean
     # TODO: should we normalize by chunk or in a whole (current implementation)?
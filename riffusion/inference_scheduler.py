@@ -0,0 +1,313 @@
+"""
+In-process scheduler that queues model calls from many sessions and runs them in batches.
+
+Callers submit a payload together with a batch key and get a future back. A single worker
+thread takes requests from the per-session queues in round-robin order, so one session
+submitting many requests can't starve the others, and merges requests with the same batch key
+that arrive within a short window into one call of the batch function.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import statistics
+import threading
+import time
+import typing as T
+from concurrent.futures import Future
+
+# Number of recent requests the wait and run time metrics are computed over
+METRICS_WINDOW = 1000
+
+
+class QueueFullError(RuntimeError):
+    """
+    Raised when submitting to a scheduler whose queue is at capacity.
+    """
+
+
+@dataclasses.dataclass
+class InferenceRequest:
+    """
+    A queued call, resolved through its future.
+    """
+
+    session_id: T.Hashable
+    batch_key: T.Hashable
+    payload: T.Any
+    future: Future
+    enqueued_at: float = dataclasses.field(default_factory=time.monotonic)
+
+
+class InferenceScheduler:
+    """
+    Bounded, fair, batching request queue in front of a single model.
+
+    The batch function is called from the worker thread with a batch key and the list of
+    payloads submitted with that key, and must return one result per payload in the same order.
+    """
+
+    def __init__(
+        self,
+        run_batch: T.Callable[[T.Any, T.List[T.Any]], T.Sequence[T.Any]],
+        max_queue_size: int = 64,
+        max_batch_size: int = 4,
+        batch_window_s: float = 0.05,
+        is_session_active: T.Optional[T.Callable[[T.Hashable], bool]] = None,
+    ):
+        """
+        Args:
+            run_batch: Runs a batch of payloads that share a batch key
+            max_queue_size: Number of pending requests beyond which submit raises
+            max_batch_size: Most payloads passed to a single run_batch call
+            batch_window_s: How long to wait for compatible requests to join a batch
+            is_session_active: Returns whether a session is still connected. Requests of
+                               disconnected sessions are dropped before they run.
+        """
+        self.run_batch = run_batch
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.batch_window_s = batch_window_s
+        self.is_session_active = is_session_active
+
+        # Pending requests per session, the order of the keys is the round-robin order
+        self._queues: T.OrderedDict[
+            T.Hashable, T.Deque[InferenceRequest]
+        ] = collections.OrderedDict()
+        self._num_pending = 0
+        self._condition = threading.Condition()
+        self._shutdown = False
+
+        self.num_submitted = 0
+        self.num_completed = 0
+        self.num_failed = 0
+        self.num_cancelled = 0
+        self.num_rejected = 0
+        self.num_batches = 0
+        self._wait_times_s: T.Deque[float] = collections.deque(maxlen=METRICS_WINDOW)
+        self._run_times_s: T.Deque[float] = collections.deque(maxlen=METRICS_WINDOW)
+        self._batch_sizes: T.Deque[int] = collections.deque(maxlen=METRICS_WINDOW)
+
+        self._worker = threading.Thread(
+            target=self._run, name="riffusion-inference-scheduler", daemon=True
+        )
+        self._worker.start()
+
+    def submit(
+        self,
+        batch_key: T.Hashable,
+        payload: T.Any,
+        session_id: T.Hashable = None,
+    ) -> Future:
+        """
+        Queue a payload and return a future for its result.
+
+        Raises:
+            QueueFullError: If max_queue_size requests are already pending
+        """
+        future: Future = Future()
+        request = InferenceRequest(
+            session_id=session_id, batch_key=batch_key, payload=payload, future=future
+        )
+
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Scheduler has been shut down")
+            if self._num_pending >= self.max_queue_size:
+                self.num_rejected += 1
+                raise QueueFullError(
+                    f"Inference queue is full ({self._num_pending} pending requests)"
+                )
+
+            self._queues.setdefault(session_id, collections.deque()).append(request)
+            self._num_pending += 1
+            self.num_submitted += 1
+            self._condition.notify()
+
+        return future
+
+    def run(
+        self,
+        batch_key: T.Hashable,
+        payload: T.Any,
+        session_id: T.Hashable = None,
+        timeout: T.Optional[float] = None,
+    ) -> T.Any:
+        """
+        Submit a payload and block until its result is ready.
+        """
+        return self.submit(batch_key, payload, session_id=session_id).result(timeout=timeout)
+
+    def cancel_session(self, session_id: T.Hashable) -> int:
+        """
+        Cancel all pending requests of a session. Returns how many were cancelled.
+        """
+        with self._condition:
+            queue = self._queues.pop(session_id, None)
+            if not queue:
+                return 0
+            self._num_pending -= len(queue)
+
+        for request in queue:
+            request.future.cancel()
+        with self._condition:
+            self.num_cancelled += len(queue)
+        return len(queue)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Cancel pending requests and stop the worker once the running batch is done.
+        """
+        with self._condition:
+            self._shutdown = True
+            session_ids = list(self._queues.keys())
+            self._condition.notify_all()
+
+        for session_id in session_ids:
+            self.cancel_session(session_id)
+
+        if wait:
+            self._worker.join()
+
+    @property
+    def queue_depth(self) -> int:
+        with self._condition:
+            return self._num_pending
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        """
+        Queue depth, throughput counters and wait/run time percentiles.
+        """
+
+        def percentiles(values: T.Sequence[float]) -> T.Dict[str, float]:
+            if not values:
+                return dict(p50=0.0, p95=0.0, max=0.0)
+            ordered = sorted(values)
+            return dict(
+                p50=ordered[len(ordered) // 2],
+                p95=ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+                max=ordered[-1],
+            )
+
+        with self._condition:
+            return dict(
+                queue_depth=self._num_pending,
+                num_sessions=len(self._queues),
+                num_submitted=self.num_submitted,
+                num_completed=self.num_completed,
+                num_failed=self.num_failed,
+                num_cancelled=self.num_cancelled,
+                num_rejected=self.num_rejected,
+                num_batches=self.num_batches,
+                mean_batch_size=(
+                    statistics.fmean(self._batch_sizes) if self._batch_sizes else 0.0
+                ),
+                wait_time_s=percentiles(self._wait_times_s),
+                run_time_s=percentiles(self._run_times_s),
+            )
+
+    def _pop_next(self, batch_key: T.Hashable = None) -> T.Optional[InferenceRequest]:
+        """
+        Pop the oldest request of the next session in round-robin order, optionally only
+        considering requests with the given batch key. Must hold the lock.
+        """
+        for session_id in list(self._queues.keys()):
+            queue = self._queues[session_id]
+            if batch_key is not None and queue[0].batch_key != batch_key:
+                continue
+
+            request = queue.popleft()
+            self._num_pending -= 1
+
+            # The session goes to the back of the line
+            if queue:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+            return request
+
+        return None
+
+    def _is_live(self, request: InferenceRequest) -> bool:
+        """
+        Whether a request should still run, cancelling it if its session went away.
+        """
+        if request.future.cancelled():
+            return False
+
+        if self.is_session_active is not None and request.session_id is not None:
+            if not self.is_session_active(request.session_id):
+                request.future.cancel()
+                return False
+
+        return request.future.set_running_or_notify_cancel()
+
+    def _next_batch(self) -> T.List[InferenceRequest]:
+        """
+        Block until a request is available, then gather compatible requests into a batch.
+        """
+        batch: T.List[InferenceRequest] = []
+
+        with self._condition:
+            while not batch:
+                while not self._num_pending and not self._shutdown:
+                    self._condition.wait()
+                if self._shutdown:
+                    return []
+
+                request = self._pop_next()
+                assert request is not None
+                batch.append(request)
+
+            deadline = time.monotonic() + self.batch_window_s
+            while len(batch) < self.max_batch_size:
+                request = self._pop_next(batch_key=batch[0].batch_key)
+                if request is not None:
+                    batch.append(request)
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._shutdown:
+                    break
+                self._condition.wait(timeout=remaining)
+
+        live = [request for request in batch if self._is_live(request)]
+        with self._condition:
+            self.num_cancelled += len(batch) - len(live)
+        return live
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                with self._condition:
+                    if self._shutdown:
+                        return
+                continue
+
+            start = time.monotonic()
+            try:
+                results = self.run_batch(batch[0].batch_key, [r.payload for r in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(
+                        f"run_batch returned {len(results)} results for {len(batch)} payloads"
+                    )
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                succeeded = False
+            else:
+                for request, result in zip(batch, results):
+                    request.future.set_result(result)
+                succeeded = True
+            end = time.monotonic()
+
+            with self._condition:
+                self.num_batches += 1
+                self._batch_sizes.append(len(batch))
+                self._run_times_s.append(end - start)
+                self._wait_times_s.extend(start - request.enqueued_at for request in batch)
+                if succeeded:
+                    self.num_completed += len(batch)
+                else:
+                    self.num_failed += len(batch)
@@ -0,0 +1,294 @@
+"""
+Process-wide registry of loaded model pipelines.
+
+Every task that needs a diffusion pipeline should go through a single ModelRegistry so that a
+checkpoint is loaded at most once per (checkpoint, device, dtype, scheduler, pipeline type) and
+is shared across Streamlit sessions and tasks.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import os
+import threading
+import time
+import typing as T
+
+import torch
+
+from riffusion.util import torch_util
+
+# Environment variable with the memory budget of loaded pipelines in MiB, overriding the default
+MODEL_MEMORY_BUDGET_ENV = "RIFFUSION_MODEL_MEMORY_MB"
+
+# Fraction of the device memory that loaded pipelines may take by default, leaving the rest for
+# activations during inference
+MODEL_MEMORY_FRACTION = 0.6
+
+
+def default_memory_budget(fraction: float = MODEL_MEMORY_FRACTION) -> T.Optional[int]:
+    """
+    Memory budget in bytes for a ModelRegistry.
+
+    Read from $RIFFUSION_MODEL_MEMORY_MB if set, otherwise a fraction of the memory of all
+    visible CUDA devices, or of the system memory without CUDA. None if neither is known.
+    """
+    budget_mb = os.environ.get(MODEL_MEMORY_BUDGET_ENV)
+    if budget_mb:
+        return int(float(budget_mb) * 1024 * 1024)
+
+    if torch.cuda.is_available():
+        total = sum(
+            torch.cuda.get_device_properties(i).total_memory
+            for i in range(torch.cuda.device_count())
+        )
+        return int(fraction * total)
+
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+    return int(fraction * total)
+
+
+@dataclasses.dataclass(frozen=True)
+class ModelKey:
+    """
+    Identifies one loaded pipeline in the registry.
+    """
+
+    checkpoint: str
+    device: str
+    dtype: torch.dtype
+    scheduler: str
+
+    # Kind of pipeline, e.g. "txt2img", "img2img" or "riffusion"
+    pipeline_type: str = "txt2img"
+
+    def normalized(self) -> ModelKey:
+        """
+        Resolve the device and dtype the pipeline will actually be loaded with, so that e.g. a
+        float16 request on CPU shares the float32 entry instead of loading a second copy.
+        """
+        device = torch_util.check_device(self.device)
+        dtype = self.dtype
+        if device == "cpu" or device.lower().startswith("mps"):
+            dtype = torch.float32
+        return dataclasses.replace(self, device=device, dtype=dtype)
+
+
+@dataclasses.dataclass
+class ModelEntry:
+    """
+    A loaded pipeline along with bookkeeping information.
+    """
+
+    key: ModelKey
+    model: T.Any
+    num_bytes: int
+    load_time_s: float
+    last_used: float = dataclasses.field(default_factory=time.monotonic)
+    num_hits: int = 0
+
+    # Entry whose modules this pipeline is built from, see ModelRegistry.get
+    shares: T.Optional[ModelKey] = None
+
+
+class ModelRegistry:
+    """
+    Thread-safe cache of loaded pipelines with LRU eviction by memory footprint.
+
+    Loading is done by a caller-provided loader function so the registry does not need to know
+    how to construct each pipeline type. Concurrent requests for the same key wait on a single
+    load instead of loading the checkpoint twice.
+    """
+
+    def __init__(self, max_bytes: T.Optional[int] = None):
+        """
+        Args:
+            max_bytes: Evict least recently used pipelines when the total parameter memory
+                       exceeds this. None means no limit.
+        """
+        self.max_bytes = max_bytes
+
+        self._entries: T.OrderedDict[ModelKey, ModelEntry] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: T.Dict[ModelKey, threading.Lock] = {}
+
+        self.num_loads = 0
+        self.num_evictions = 0
+
+    def get(
+        self,
+        key: ModelKey,
+        loader: T.Callable[[ModelKey], T.Any],
+        shares: T.Optional[ModelKey] = None,
+    ) -> T.Any:
+        """
+        Return the pipeline for the given key, loading it with `loader` if needed.
+
+        A pipeline built from the modules of another entry `shares` that entry's weights. It is
+        counted with no memory of its own, keeps that entry in use whenever it is used, and is
+        dropped along with it, since the weights are only freed once neither is referenced.
+        """
+        key = key.normalized()
+        shares = shares.normalized() if shares is not None else None
+
+        with self._lock:
+            entry = self._touch(key)
+            if entry is not None:
+                return entry.model
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            # Another thread may have finished loading while we waited
+            with self._lock:
+                entry = self._touch(key)
+                if entry is not None:
+                    return entry.model
+
+            start = time.monotonic()
+            model = loader(key)
+            entry = ModelEntry(
+                key=key,
+                model=model,
+                num_bytes=0 if shares is not None else torch_util.pipeline_num_bytes(model),
+                load_time_s=time.monotonic() - start,
+                shares=shares,
+            )
+
+            with self._lock:
+                self._entries[key] = entry
+                self._load_locks.pop(key, None)
+                self.num_loads += 1
+                evicted_devices = [e.key.device for e in self._evict_to_fit(keep=key)]
+
+        self._empty_device_cache(evicted_devices)
+        return model
+
+    def warmup(self, keys: T.Iterable[ModelKey], loader: T.Callable[[ModelKey], T.Any]) -> None:
+        """
+        Load the given pipelines ahead of time so the first request doesn't pay for it.
+        """
+        for key in keys:
+            self.get(key, loader)
+
+    def evict(self, key: ModelKey) -> bool:
+        """
+        Drop a pipeline from the registry. Returns whether it was loaded.
+        """
+        with self._lock:
+            evicted = self._pop(key.normalized())
+            if not evicted:
+                return False
+            devices = [entry.key.device for entry in evicted]
+            del evicted
+
+        self._empty_device_cache(devices)
+        return True
+
+    def clear(self) -> None:
+        """
+        Drop all pipelines from the registry.
+        """
+        with self._lock:
+            devices = [entry.key.device for entry in self._entries.values()]
+            self.num_evictions += len(devices)
+            self._entries.clear()
+
+        self._empty_device_cache(devices)
+
+    def __contains__(self, key: ModelKey) -> bool:
+        with self._lock:
+            return key.normalized() in self._entries
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.num_bytes for entry in self._entries.values())
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        """
+        Summary of what is loaded and how much memory it holds.
+        """
+        with self._lock:
+            models = [
+                dict(
+                    checkpoint=entry.key.checkpoint,
+                    device=entry.key.device,
+                    dtype=str(entry.key.dtype),
+                    scheduler=entry.key.scheduler,
+                    pipeline_type=entry.key.pipeline_type,
+                    num_bytes=entry.num_bytes,
+                    load_time_s=entry.load_time_s,
+                    num_hits=entry.num_hits,
+                )
+                for entry in self._entries.values()
+            ]
+
+        return dict(
+            models=models,
+            total_bytes=sum(m["num_bytes"] for m in models),
+            max_bytes=self.max_bytes,
+            num_loads=self.num_loads,
+            num_evictions=self.num_evictions,
+        )
+
+    def _touch(self, key: ModelKey) -> T.Optional[ModelEntry]:
+        """
+        Mark an entry as most recently used. Must hold the lock.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.num_hits += 1
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(key)
+            if entry.shares in self._entries:
+                self._entries[entry.shares].last_used = entry.last_used
+                self._entries.move_to_end(entry.shares)
+        return entry
+
+    def _pop(self, key: ModelKey) -> T.List[ModelEntry]:
+        """
+        Remove an entry along with the entries sharing its modules. Must hold the lock.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return []
+
+        self.num_evictions += 1
+        evicted = [entry]
+        for other in list(self._entries.values()):
+            if other.shares == key:
+                evicted.extend(self._pop(other.key))
+        return evicted
+
+    def _evict_to_fit(self, keep: ModelKey) -> T.List[ModelEntry]:
+        """
+        Pop least recently used entries until under the memory limit. Must hold the lock.
+        """
+        evicted: T.List[ModelEntry] = []
+        if self.max_bytes is None:
+            return evicted
+
+        keep_shares = self._entries[keep].shares if keep in self._entries else None
+        total = sum(entry.num_bytes for entry in self._entries.values())
+        for key in list(self._entries.keys()):
+            if total <= self.max_bytes:
+                break
+            if key in (keep, keep_shares) or key not in self._entries:
+                continue
+            popped = self._pop(key)
+            total -= sum(entry.num_bytes for entry in popped)
+            evicted.extend(popped)
+
+        return evicted
+
+    @staticmethod
+    def _empty_device_cache(devices: T.Sequence[str]) -> None:
+        """
+        Return memory held by evicted pipelines to the device.
+        """
+        uses_cuda = any(device.lower().startswith("cuda") for device in devices)
+        if uses_cuda and torch.cuda.is_available():
+            torch.cuda.empty_cache()
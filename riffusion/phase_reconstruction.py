@@ -0,0 +1,203 @@
+"""
+Phase reconstruction algorithms for recovering a waveform from STFT magnitudes.
+
+SpectrogramConverter picks one of these based on `SpectrogramParams.phase_reconstruction`.
+"""
+import math
+import typing as T
+
+import torch
+
+PHASE_RECONSTRUCTION_METHODS = [
+    # torchaudio's GriffinLim with random init, the original behavior
+    "griffin_lim",
+    # Fast Griffin-Lim with tunable momentum and early stopping, random init
+    "fast_griffin_lim",
+    # Phase gradient integration only, no iterations
+    "pghi",
+    # Fast Griffin-Lim initialized from the phase gradient integration
+    "pghi_fast_griffin_lim",
+]
+
+# Gaussian window time-frequency ratio that best approximates a Hann window, as a multiple of
+# the squared window length. See Prusa et al., "A Noniterative Method for Reconstruction of
+# Phase From STFT Magnitude", 2017.
+HANN_GAMMA_FACTOR = 0.25645
+
+
+def pghi_angles(
+    magnitudes: torch.Tensor,
+    n_fft: int,
+    hop_length: int,
+    win_length: int,
+    tolerance: float = 1e-5,
+) -> torch.Tensor:
+    """
+    Estimate the STFT phase from magnitudes by integrating the phase gradient.
+
+    For a Gaussian window the time derivative of the phase follows from the frequency
+    derivative of the log magnitude. This integrates it along time for every frequency bin
+    with the trapezoidal rule. Unlike full heap integration it doesn't also integrate across
+    frequency, which keeps it a handful of vectorized tensor ops, and it is meant as a
+    starting point for Griffin-Lim rather than a final answer. Bins below `tolerance` times
+    the max magnitude carry no usable gradient and get random phase.
+
+    Args:
+        magnitudes: (batch, frequency, time) STFT magnitudes, as produced by torch.stft
+        n_fft: FFT size
+        hop_length: Samples between frames
+        win_length: Hann window length
+        tolerance: Relative magnitude below which bins get random phase
+
+    Returns:
+        angles: (batch, frequency, time) complex tensor of unit magnitude
+    """
+    gamma = HANN_GAMMA_FACTOR * win_length**2
+
+    log_magnitudes = torch.log(magnitudes.clamp(min=torch.finfo(magnitudes.dtype).tiny))
+
+    # Centered difference of the log magnitude along frequency
+    d_log_d_bin = torch.gradient(log_magnitudes, dim=-2)[0]
+
+    # Phase advance per hop for every bin, in the frame-local phase convention of torch.stft
+    bins = torch.arange(magnitudes.shape[-2], device=magnitudes.device, dtype=magnitudes.dtype)
+    phase_advance = (hop_length * n_fft / gamma) * d_log_d_bin + (
+        2 * math.pi * hop_length / n_fft
+    ) * bins[:, None]
+
+    # Trapezoidal integration along time, starting from zero phase in the first frame
+    steps = 0.5 * (phase_advance[..., 1:] + phase_advance[..., :-1])
+    phase = torch.cat([torch.zeros_like(phase_advance[..., :1]), steps.cumsum(dim=-1)], dim=-1)
+
+    max_magnitude = magnitudes.amax(dim=(-2, -1), keepdim=True)
+    small = magnitudes < tolerance * max_magnitude
+    phase = torch.where(small, 2 * math.pi * torch.rand_like(phase), phase)
+
+    return torch.polar(torch.ones_like(phase), phase)
+
+
+def continue_angles(
+    leading_angles: torch.Tensor,
+    magnitudes: torch.Tensor,
+    angles: T.Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Initial phase for a window whose first frames overlap the end of a window that was
+    reconstructed before it.
+
+    The overlapping frames keep the phase of the previous window, so that both reconstructions
+    agree where they are crossfaded instead of summing unrelated phases. The following frames
+    take `angles`, e.g. from pghi_angles, rotated in every bin to continue from the last
+    overlapping frame, or random phase if not given.
+
+    Args:
+        leading_angles: (batch, frequency, overlap) complex phase of the overlapping frames
+        magnitudes: (batch, frequency, time) STFT magnitudes of the window, time > overlap
+        angles: (batch, frequency, time) complex initial phase of the window, of unit magnitude
+
+    Returns:
+        angles: (batch, frequency, time) complex tensor of unit magnitude
+    """
+    num_leading = leading_angles.shape[-1]
+    leading_angles = leading_angles / leading_angles.abs().add(1e-16)
+
+    if angles is None:
+        angles = torch.polar(
+            torch.ones_like(magnitudes), 2 * math.pi * torch.rand_like(magnitudes)
+        )
+    else:
+        rotation = leading_angles[..., -1:] * angles[..., num_leading - 1 : num_leading].conj()
+        angles = angles * rotation
+
+    return torch.cat([leading_angles.to(angles.dtype), angles[..., num_leading:]], dim=-1)
+
+
+def fast_griffin_lim(
+    magnitudes: torch.Tensor,
+    n_fft: int,
+    hop_length: int,
+    win_length: int,
+    n_iter: int = 32,
+    momentum: float = 0.99,
+    init_angles: T.Optional[torch.Tensor] = None,
+    tolerance: float = 0.0,
+    length: T.Optional[int] = None,
+) -> torch.Tensor:
+    """
+    Fast Griffin-Lim phase reconstruction with optional early stopping.
+
+    Momentum follows the parameterization of torchaudio.transforms.GriffinLim, so the same
+    value gives the same iterations. With `tolerance` > 0 the iterations stop once the
+    spectral convergence ||S - |STFT(x)||| / ||S|| improves by less than `tolerance` (relative)
+    from one iteration to the next.
+
+    Args:
+        magnitudes: (batch, frequency, time) STFT magnitudes
+        n_fft: FFT size
+        hop_length: Samples between frames
+        win_length: Hann window length
+        n_iter: Maximum number of iterations
+        momentum: Momentum in [0, 1), 0 gives plain Griffin-Lim
+        init_angles: (batch, frequency, time) complex initial phase, random if not given
+        tolerance: Relative spectral convergence improvement below which to stop
+        length: Length of the output waveform
+
+    Returns:
+        waveform: (batch, samples)
+    """
+    if not 0 <= momentum < 1:
+        raise ValueError(f"momentum must be in [0, 1), got {momentum}")
+
+    window = torch.hann_window(win_length, device=magnitudes.device, dtype=magnitudes.dtype)
+
+    def istft(spectrogram: torch.Tensor) -> torch.Tensor:
+        return torch.istft(
+            spectrogram,
+            n_fft=n_fft,
+            hop_length=hop_length,
+            win_length=win_length,
+            window=window,
+            length=length,
+        )
+
+    def stft(waveform: torch.Tensor) -> torch.Tensor:
+        return torch.stft(
+            waveform,
+            n_fft=n_fft,
+            hop_length=hop_length,
+            win_length=win_length,
+            window=window,
+            center=True,
+            pad_mode="reflect",
+            normalized=False,
+            onesided=True,
+            return_complex=True,
+        )
+
+    if init_angles is None:
+        angles = torch.polar(
+            torch.ones_like(magnitudes), 2 * math.pi * torch.rand_like(magnitudes)
+        )
+    else:
+        angles = init_angles
+
+    norm = torch.linalg.vector_norm(magnitudes)
+    previous_convergence = math.inf
+    previous_rebuilt = torch.tensor(0.0, dtype=angles.dtype, device=magnitudes.device)
+
+    for _ in range(n_iter):
+        rebuilt = stft(istft(magnitudes * angles))
+
+        angles = rebuilt
+        if momentum:
+            angles = angles - previous_rebuilt.mul_(momentum / (1 + momentum))
+        angles = angles.div(angles.abs().add(1e-16))
+        previous_rebuilt = rebuilt
+
+        if tolerance > 0:
+            convergence = float(torch.linalg.vector_norm(magnitudes - rebuilt.abs()) / norm)
+            if previous_convergence - convergence < tolerance * previous_convergence:
+                break
+            previous_convergence = convergence
+
+    return istft(magnitudes * angles)
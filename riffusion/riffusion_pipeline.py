@@ -4,7 +4,6 @@ Riffusion inference pipeline.
 from __future__ import annotations
 
 import dataclasses
-import functools
 import inspect
 import typing as T
 
@@ -19,7 +18,8 @@ from diffusers.utils import logging
 from huggingface_hub import hf_hub_download
 from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 
-from riffusion.datatypes import InferenceInput
+from riffusion.datatypes import InferenceInput, PromptInput
+from riffusion.embedding_cache import EmbeddingCache, EmbeddingKey, encoder_fingerprint
 from riffusion.external.prompt_weighting import get_weighted_text_embeddings
 from riffusion.util import torch_util
 
@@ -60,6 +60,11 @@ class RiffusionPipeline(DiffusionPipeline):
             feature_extractor=feature_extractor,
         )
 
+        # Text embeddings of recent prompts, replace with a shared cache to share across
+        # pipelines of the process
+        self.embedding_cache = EmbeddingCache()
+        self._encoder_fingerprint: T.Optional[str] = None
+
     @classmethod
     def load_checkpoint(
         cls,
@@ -174,11 +179,25 @@ class RiffusionPipeline(DiffusionPipeline):
     def device(self) -> str:
         return str(self.vae.device)
 
-    @functools.lru_cache()
+    @property
+    def text_encoder_fingerprint(self) -> str:
+        """
+        Identifies the tokenizer and text encoder in embedding cache keys.
+        """
+        if self._encoder_fingerprint is None:
+            self._encoder_fingerprint = encoder_fingerprint(self.tokenizer, self.text_encoder)
+        return self._encoder_fingerprint
+
     def embed_text(self, text) -> torch.FloatTensor:
         """
         Takes in text and turns it into text embeddings.
         """
+        key = EmbeddingKey(encoder=self.text_encoder_fingerprint, text=text)
+        return self.embedding_cache.get_or_compute(
+            key, self.device, lambda: self._embed_text(text)
+        )
+
+    def _embed_text(self, text) -> torch.FloatTensor:
         text_input = self.tokenizer(
             text,
             padding="max_length",
@@ -190,11 +209,21 @@ class RiffusionPipeline(DiffusionPipeline):
             embed = self.text_encoder(text_input.input_ids.to(self.device))[0]
         return embed
 
-    @functools.lru_cache()
     def embed_text_weighted(self, text) -> torch.FloatTensor:
         """
         Get text embedding with weights.
         """
+        key = EmbeddingKey(
+            encoder=self.text_encoder_fingerprint,
+            text=text,
+            weighted=True,
+            max_embeddings_multiples=3,
+        )
+        return self.embedding_cache.get_or_compute(
+            key, self.device, lambda: self._embed_text_weighted(text)
+        )
+
+    def _embed_text_weighted(self, text) -> torch.FloatTensor:
         return get_weighted_text_embeddings(
             pipe=self,
             prompt=text,
@@ -224,19 +253,57 @@ class RiffusionPipeline(DiffusionPipeline):
                         channel (luminance) before use.
             use_reweighting: Use prompt reweighting
         """
-        alpha = inputs.alpha
-        start = inputs.start
-        end = inputs.end
+        return self.riffuse_sweep(
+            start=inputs.start,
+            end=inputs.end,
+            alphas=[inputs.alpha],
+            init_image=init_image,
+            mask_image=mask_image,
+            num_inference_steps=inputs.num_inference_steps,
+            use_reweighting=use_reweighting,
+        )[0]
+
+    @torch.no_grad()
+    def riffuse_sweep(
+        self,
+        start: PromptInput,
+        end: PromptInput,
+        alphas: T.Sequence[float],
+        init_image: Image.Image,
+        mask_image: T.Optional[Image.Image] = None,
+        num_inference_steps: int = 50,
+        use_reweighting: bool = True,
+        max_batch_size: T.Optional[int] = None,
+    ) -> T.List[Image.Image]:
+        """
+        Runs riffuse for many interpolation alphas between the same two prompts.
+
+        The text and the init image are encoded once, and the alphas are denoised together as
+        a batch through interpolate_img2img. Each output matches what riffuse gives for the same
+        alpha, since every alpha uses the same seeds.
 
-        guidance_scale = start.guidance * (1.0 - alpha) + end.guidance * alpha
+        Alphas are only batched together when their interpolated denoising strength starts at
+        the same timestep, which is always the case when start and end share the denoising.
+
+        Args:
+            start: Prompt at alpha 0
+            end: Prompt at alpha 1
+            alphas: Interpolation alphas in [0, 1]
+            init_image: Image used for conditioning
+            mask_image: Mask as in riffuse
+            num_inference_steps: Number of inner loops of the diffusion model
+            use_reweighting: Use prompt reweighting
+            max_batch_size: Most alphas to denoise at once, unlimited if None
+
+        Returns:
+            One image per alpha, in the order of alphas
+        """
+        alphas = [float(alpha) for alpha in alphas]
+        if not alphas:
+            return []
 
         # TODO(hayk): Always generate the seed on CPU?
-        if self.device.lower().startswith("mps"):
-            generator_start = torch.Generator(device="cpu").manual_seed(start.seed)
-            generator_end = torch.Generator(device="cpu").manual_seed(end.seed)
-        else:
-            generator_start = torch.Generator(device=self.device).manual_seed(start.seed)
-            generator_end = torch.Generator(device=self.device).manual_seed(end.seed)
+        generator_device = "cpu" if self.device.lower().startswith("mps") else self.device
 
         # Text encodings
         if use_reweighting:
@@ -246,8 +313,6 @@ class RiffusionPipeline(DiffusionPipeline):
             embed_start = self.embed_text(start.prompt)
             embed_end = self.embed_text(end.prompt)
 
-        text_embedding = embed_start + alpha * (embed_end - embed_start)
-
         # Image latents
         init_image_torch = preprocess_image(init_image).to(
             device=self.device, dtype=embed_start.dtype
@@ -255,10 +320,7 @@ class RiffusionPipeline(DiffusionPipeline):
         init_latent_dist = self.vae.encode(init_image_torch).latent_dist
         # TODO(hayk): Probably this seed should just be 0 always? Make it 100% symmetric. The
         # result is so close no matter the seed that it doesn't really add variety.
-        if self.device.lower().startswith("mps"):
-            generator = torch.Generator(device="cpu").manual_seed(start.seed)
-        else:
-            generator = torch.Generator(device=self.device).manual_seed(start.seed)
+        generator = torch.Generator(device=generator_device).manual_seed(start.seed)
 
         init_latents = init_latent_dist.sample(generator=generator)
         init_latents = 0.18215 * init_latents
@@ -271,20 +333,57 @@ class RiffusionPipeline(DiffusionPipeline):
                 device=self.device, dtype=embed_start.dtype
             )
 
-        outputs = self.interpolate_img2img(
-            text_embeddings=text_embedding,
-            init_latents=init_latents,
-            mask=mask,
-            generator_a=generator_start,
-            generator_b=generator_end,
-            interpolate_alpha=alpha,
-            strength_a=start.denoising,
-            strength_b=end.denoising,
-            num_inference_steps=inputs.num_inference_steps,
-            guidance_scale=guidance_scale,
-        )
+        # Group the alphas that start denoising at the same timestep
+        groups: T.Dict[int, T.List[int]] = {}
+        for i, alpha in enumerate(alphas):
+            strength = (1 - alpha) * start.denoising + alpha * end.denoising
+            groups.setdefault(self.init_timestep(num_inference_steps, strength), []).append(i)
+
+        batch_size = max_batch_size or len(alphas)
+        images: T.List[T.Optional[Image.Image]] = [None] * len(alphas)
+        for indices in groups.values():
+            for batch_start in range(0, len(indices), batch_size):
+                batch = indices[batch_start : batch_start + batch_size]
+                batch_alphas = [alphas[i] for i in batch]
+
+                alphas_torch = torch.tensor(
+                    batch_alphas, device=self.device, dtype=embed_start.dtype
+                ).view(-1, 1, 1)
+                text_embeddings = embed_start + alphas_torch * (embed_end - embed_start)
+
+                # Reseed for every batch, so that each alpha gets the same noise as with riffuse
+                generator_start = torch.Generator(device=generator_device).manual_seed(start.seed)
+                generator_end = torch.Generator(device=generator_device).manual_seed(end.seed)
+
+                outputs = self.interpolate_img2img(
+                    text_embeddings=text_embeddings,
+                    init_latents=init_latents,
+                    mask=mask,
+                    generator_a=generator_start,
+                    generator_b=generator_end,
+                    interpolate_alpha=batch_alphas,
+                    strength_a=start.denoising,
+                    strength_b=end.denoising,
+                    num_inference_steps=num_inference_steps,
+                    guidance_scale=[
+                        start.guidance * (1.0 - alpha) + end.guidance * alpha
+                        for alpha in batch_alphas
+                    ],
+                    negative_prompt=start.negative_prompt,
+                )
+
+                for i, image in zip(batch, outputs["images"]):
+                    images[i] = image
 
-        return outputs["images"][0]
+        return images
+
+    def init_timestep(self, num_inference_steps: int, strength: float) -> int:
+        """
+        Number of denoising steps that img2img runs for the given strength.
+        """
+        offset = self.scheduler.config.get("steps_offset", 0)
+        init_timestep = int(num_inference_steps * strength) + offset
+        return min(init_timestep, num_inference_steps)
 
     @torch.no_grad()
     def interpolate_img2img(
@@ -293,12 +392,12 @@ class RiffusionPipeline(DiffusionPipeline):
         init_latents: torch.Tensor,
         generator_a: torch.Generator,
         generator_b: torch.Generator,
-        interpolate_alpha: float,
+        interpolate_alpha: T.Union[float, T.Sequence[float]],
         mask: T.Optional[torch.Tensor] = None,
         strength_a: float = 0.8,
         strength_b: float = 0.8,
         num_inference_steps: int = 50,
-        guidance_scale: float = 7.5,
+        guidance_scale: T.Union[float, T.Sequence[float]] = 7.5,
         negative_prompt: T.Optional[T.Union[str, T.List[str]]] = None,
         num_images_per_prompt: int = 1,
         eta: T.Optional[float] = 0.0,
@@ -306,9 +405,18 @@ class RiffusionPipeline(DiffusionPipeline):
         **kwargs,
     ):
         """
-        TODO
+        Denoise the init latents with img2img, starting from noise interpolated between the
+        noise of two generators.
+
+        A sequence of alphas runs a whole interpolation sweep as one batch. The text embeddings
+        and guidance scales then have one entry per alpha, and all alphas must start denoising
+        at the same timestep, see riffuse_sweep.
         """
+        batched = not isinstance(interpolate_alpha, (int, float))
+        alphas = [float(a) for a in interpolate_alpha] if batched else [float(interpolate_alpha)]
         batch_size = text_embeddings.shape[0]
+        if batch_size != len(alphas):
+            raise ValueError("Expected one text embedding per interpolation alpha.")
 
         # set timesteps
         self.scheduler.set_timesteps(num_inference_steps)
@@ -320,8 +428,12 @@ class RiffusionPipeline(DiffusionPipeline):
 
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
         # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
-        # corresponds to doing no classifier free guidance.
-        do_classifier_free_guidance = guidance_scale > 1.0
+        # corresponds to doing no classifier free guidance. In a sweep, alphas with a scale of 1
+        # get the same result with guidance, so it is enough for one alpha to need it.
+        if isinstance(guidance_scale, (int, float)):
+            do_classifier_free_guidance = guidance_scale > 1.0
+        else:
+            do_classifier_free_guidance = max(guidance_scale) > 1.0
         # get unconditional embeddings for classifier free guidance
         if do_classifier_free_guidance:
             if negative_prompt is None:
@@ -355,12 +467,22 @@ class RiffusionPipeline(DiffusionPipeline):
 
         latents_dtype = text_embeddings.dtype
 
-        strength = (1 - interpolate_alpha) * strength_a + interpolate_alpha * strength_b
+        # Guidance is a scalar for a single alpha, or broadcast over the batch for a sweep
+        if not isinstance(guidance_scale, (int, float)):
+            guidance_scale = torch.tensor(
+                guidance_scale, device=self.device, dtype=latents_dtype
+            ).repeat_interleave(num_images_per_prompt)
+            guidance_scale = guidance_scale.view(-1, 1, 1, 1)
 
         # get the original timestep using init_timestep
         offset = self.scheduler.config.get("steps_offset", 0)
-        init_timestep = int(num_inference_steps * strength) + offset
-        init_timestep = min(init_timestep, num_inference_steps)
+        init_timesteps = {
+            self.init_timestep(num_inference_steps, (1 - a) * strength_a + a * strength_b)
+            for a in alphas
+        }
+        if len(init_timesteps) != 1:
+            raise ValueError("All interpolation alphas must start denoising at the same timestep.")
+        init_timestep = init_timesteps.pop()
 
         timesteps = self.scheduler.timesteps[-init_timestep]
         timesteps = torch.tensor(
@@ -374,7 +496,13 @@ class RiffusionPipeline(DiffusionPipeline):
         noise_b = torch.randn(
             init_latents.shape, generator=generator_b, device=self.device, dtype=latents_dtype
         )
-        noise = torch_util.slerp(interpolate_alpha, noise_a, noise_b)
+        if batched:
+            # One interpolated noise per alpha, from the same pair of noises
+            noise = torch_util.slerp(alphas, noise_a, noise_b).flatten(0, 1)
+            noise = noise.repeat_interleave(num_images_per_prompt, dim=0)
+            init_latents = init_latents.expand(noise.shape)
+        else:
+            noise = torch_util.slerp(interpolate_alpha, noise_a, noise_b)
         init_latents_orig = init_latents
         init_latents = self.scheduler.add_noise(init_latents, noise, timesteps)
 
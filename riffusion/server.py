@@ -0,0 +1,475 @@
+"""
+Flask server that serves the riffusion model as an API.
+
+The model is loaded once at startup into a pool of pipelines and requests are served
+concurrently, one pipeline per request, so model workers can be scaled separately from the UI.
+
+Run with:
+
+    python -m riffusion.server --checkpoint riffusion/riffusion-model-v1 --num-workers 2
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import io
+import json
+import logging
+import queue
+import threading
+import time
+import typing as T
+from pathlib import Path
+
+import dacite
+import flask
+import pydub
+from PIL import Image
+
+from riffusion.datatypes import InferenceInput, InferenceOutput
+from riffusion.embedding_cache import EmbeddingCache
+from riffusion.riffusion_pipeline import RiffusionPipeline
+from riffusion.spectrogram_image_converter import get_converter
+from riffusion.spectrogram_params import SpectrogramParams
+from riffusion.util import base64_util, binary_util
+
+# Flask app
+app = flask.Flask(__name__)
+
+# Log at the INFO level to both stdout and disk
+logging.basicConfig(level=logging.INFO)
+logging.getLogger().addHandler(logging.FileHandler("server.log"))
+
+# Where built-in seed images are stored
+SEED_IMAGES_DIR = Path(Path(__file__).resolve().parent.parent, "seed_images")
+
+# Seed image id that needs no file, a silent spectrogram. Useful together with a denoising of
+# 1.0, which makes riffuse equivalent to text to image generation.
+SILENCE_SEED_IMAGE_ID = "silence"
+
+# Height of generated spectrograms, the width comes from the seed image or the request
+SPECTROGRAM_HEIGHT = 512
+
+# How long a request waits for a free pipeline before giving up
+ACQUIRE_TIMEOUT_S = 600.0
+
+# Number of recent requests the latency metrics are computed over
+METRICS_WINDOW = 1000
+
+# Formats the binary transport can send the audio and image in, with their media types. Raw
+# PCM is the samples of the audio segment as is, described by the metadata frame.
+AUDIO_FORMATS = {"mp3": "audio/mpeg", "wav": "audio/wav", "pcm_s16le": "audio/pcm"}
+IMAGE_FORMATS = {"jpeg": "image/jpeg", "png": "image/png"}
+
+
+class PipelinePool:
+    """
+    Fixed set of pipelines handed out to one request at a time.
+
+    Extra workers on the same device share the weights of the first pipeline and only get
+    their own denoising scheduler, which holds per-run state. All pipelines share one text
+    embedding cache.
+    """
+
+    def __init__(self, pipelines: T.Sequence[RiffusionPipeline]):
+        self.size = len(pipelines)
+        self._available: queue.Queue = queue.Queue()
+        for pipeline in pipelines:
+            self._available.put(pipeline)
+
+    @classmethod
+    def load(
+        cls,
+        checkpoint: str,
+        devices: T.Sequence[str],
+        workers_per_device: int = 1,
+        use_traced_unet: bool = False,
+        embedding_cache: T.Optional[EmbeddingCache] = None,
+    ) -> PipelinePool:
+        pipelines = []
+        for device in devices:
+            pipeline = RiffusionPipeline.load_checkpoint(
+                checkpoint=checkpoint,
+                use_traced_unet=use_traced_unet,
+                device=device,
+            )
+            if embedding_cache is not None:
+                pipeline.embedding_cache = embedding_cache
+            pipelines.append(pipeline)
+            pipelines.extend(replicate_pipeline(pipeline) for _ in range(workers_per_device - 1))
+        return cls(pipelines)
+
+    @property
+    def num_available(self) -> int:
+        return self._available.qsize()
+
+    def acquire(self, timeout: T.Optional[float] = None) -> RiffusionPipeline:
+        """
+        Raises:
+            queue.Empty: If no pipeline frees up within the timeout
+        """
+        return self._available.get(timeout=timeout)
+
+    def release(self, pipeline: RiffusionPipeline) -> None:
+        self._available.put(pipeline)
+
+
+def replicate_pipeline(pipeline: RiffusionPipeline) -> RiffusionPipeline:
+    """
+    A pipeline sharing all modules and the embedding cache with the given one except for the
+    scheduler.
+    """
+    replica = RiffusionPipeline(
+        vae=pipeline.vae,
+        text_encoder=pipeline.text_encoder,
+        tokenizer=pipeline.tokenizer,
+        unet=pipeline.unet,
+        scheduler=type(pipeline.scheduler).from_config(pipeline.scheduler.config),
+        safety_checker=pipeline.safety_checker,
+        feature_extractor=pipeline.feature_extractor,
+    )
+    replica.embedding_cache = pipeline.embedding_cache
+    return replica
+
+
+class ServerMetrics:
+    """
+    Request counters and latency percentiles, safe to update from request threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_in_flight = 0
+        self._latencies_s: T.Deque[float] = collections.deque(maxlen=METRICS_WINDOW)
+        self._wait_times_s: T.Deque[float] = collections.deque(maxlen=METRICS_WINDOW)
+
+    def start(self) -> None:
+        with self._lock:
+            self.num_requests += 1
+            self.num_in_flight += 1
+
+    def finish(self, latency_s: float, wait_time_s: float, error: bool = False) -> None:
+        with self._lock:
+            self.num_in_flight -= 1
+            self.num_errors += int(error)
+            self._latencies_s.append(latency_s)
+            self._wait_times_s.append(wait_time_s)
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        def percentiles(values: T.Sequence[float]) -> T.Dict[str, float]:
+            if not values:
+                return dict(p50=0.0, p95=0.0, max=0.0)
+            ordered = sorted(values)
+            return dict(
+                p50=ordered[len(ordered) // 2],
+                p95=ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+                max=ordered[-1],
+            )
+
+        with self._lock:
+            return dict(
+                num_requests=self.num_requests,
+                num_errors=self.num_errors,
+                num_in_flight=self.num_in_flight,
+                latency_s=percentiles(self._latencies_s),
+                wait_time_s=percentiles(self._wait_times_s),
+            )
+
+
+# Global pipeline pool, text embedding cache and metrics, set up by run_app
+POOL: T.Optional[PipelinePool] = None
+EMBEDDINGS: T.Optional[EmbeddingCache] = None
+METRICS = ServerMetrics()
+
+
+def run_app(
+    *,
+    checkpoint: str = "riffusion/riffusion-model-v1",
+    device: str = "cuda",
+    num_workers: int = 1,
+    use_traced_unet: bool = False,
+    seed_images_dir: str = str(SEED_IMAGES_DIR),
+    embedding_cache_dir: T.Optional[str] = None,
+    offload_embeddings: bool = False,
+    host: str = "127.0.0.1",
+    port: int = 3013,
+    debug: bool = False,
+    ssl_certificate: T.Optional[str] = None,
+    ssl_key: T.Optional[str] = None,
+):
+    """
+    Run a flask API that serves the given riffusion model checkpoint.
+
+    Args:
+        checkpoint: Model checkpoint on disk in diffusers format
+        device: Device to load the model on, or several comma separated devices
+        num_workers: Number of concurrent requests per device
+        use_traced_unet: Use the traced unet, which only supports 512 px wide spectrograms
+        seed_images_dir: Directory with the seed images referenced by seed_image_id
+        embedding_cache_dir: Keep text embeddings on disk here, to reuse them across restarts
+                             and servers
+        offload_embeddings: Keep cached text embeddings in CPU memory instead of on the device
+    """
+    global POOL, EMBEDDINGS, SEED_IMAGES_DIR
+
+    SEED_IMAGES_DIR = Path(seed_images_dir)
+    EMBEDDINGS = EmbeddingCache(offload_to_cpu=offload_embeddings, disk_dir=embedding_cache_dir)
+    POOL = PipelinePool.load(
+        checkpoint=checkpoint,
+        devices=[d.strip() for d in device.split(",") if d.strip()],
+        workers_per_device=num_workers,
+        use_traced_unet=use_traced_unet,
+        embedding_cache=EMBEDDINGS,
+    )
+
+    args = dict(
+        debug=debug,
+        threaded=True,
+        host=host,
+        port=port,
+    )
+
+    if ssl_certificate:
+        assert ssl_key is not None
+        args["ssl_context"] = (ssl_certificate, ssl_key)
+
+    app.run(**args)  # type: ignore
+
+
+@app.route("/run_inference/", methods=["POST"])
+def run_inference():
+    """
+    Execute the riffusion model as an API.
+
+    Inputs:
+        Serialized JSON of the InferenceInput dataclass
+
+    Returns:
+        Serialized JSON of the InferenceOutput dataclass, or if the request accepts
+        application/x-riffusion-frames, binary frames with the raw image and audio bytes.
+        The audio_format and image_format query parameters pick the binary formats.
+    """
+    start_time = time.time()
+
+    # Parse the payload as JSON
+    json_data = json.loads(flask.request.data)
+
+    # Parse an InferenceInput dataclass from the payload
+    try:
+        inputs = dacite.from_dict(InferenceInput, json_data)
+    except dacite.exceptions.WrongTypeError as exception:
+        logging.info(json_data)
+        return str(exception), 400
+    except dacite.exceptions.MissingValueError as exception:
+        logging.info(json_data)
+        return str(exception), 400
+
+    # Negotiate the response transport, JSON with base64 data unless binary is preferred
+    binary = (
+        flask.request.accept_mimetypes.best_match(["application/json", binary_util.CONTENT_TYPE])
+        == binary_util.CONTENT_TYPE
+    )
+    audio_format = flask.request.args.get("audio_format", "mp3")
+    image_format = flask.request.args.get("image_format", "jpeg")
+    if audio_format not in AUDIO_FORMATS:
+        return f"Invalid audio format: {audio_format}", 400
+    if image_format not in IMAGE_FORMATS:
+        return f"Invalid image format: {image_format}", 400
+
+    if POOL is None:
+        return "Model is not loaded", 503
+
+    METRICS.start()
+    wait_time_s = 0.0
+    error = True
+    try:
+        try:
+            pipeline = POOL.acquire(timeout=ACQUIRE_TIMEOUT_S)
+        except queue.Empty:
+            return "No model worker became available", 503
+        wait_time_s = time.time() - start_time
+
+        try:
+            response = compute_request(
+                inputs=inputs,
+                seed_images_dir=SEED_IMAGES_DIR,
+                pipeline=pipeline,
+                binary=binary,
+                audio_format=audio_format,
+                image_format=image_format,
+            )
+        finally:
+            POOL.release(pipeline)
+
+        error = isinstance(response, tuple)
+    finally:
+        METRICS.finish(time.time() - start_time, wait_time_s, error=error)
+
+    # Log the total time
+    logging.info(f"Request took {time.time() - start_time:.2f} s")
+
+    if isinstance(response, bytes):
+        return flask.Response(response, mimetype=binary_util.CONTENT_TYPE)
+    return response
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """
+    Liveness and readiness of the model workers.
+    """
+    if POOL is None:
+        return flask.jsonify(status="loading"), 503
+
+    return flask.jsonify(
+        status="ok",
+        num_workers=POOL.size,
+        num_available=POOL.num_available,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Request counters, latency, pool occupancy and text embedding cache hits.
+    """
+    stats = METRICS.stats()
+    if POOL is not None:
+        stats.update(num_workers=POOL.size, num_available=POOL.num_available)
+    if EMBEDDINGS is not None:
+        stats.update(embedding_cache=EMBEDDINGS.stats())
+    return flask.jsonify(stats)
+
+
+def load_seed_image(
+    seed_images_dir: Path, seed_image_id: str, width: T.Optional[int] = None
+) -> T.Optional[Image.Image]:
+    """
+    Load a seed image by id, tiled or cropped horizontally to the given width.
+
+    Returns None if there is no seed image with that id.
+    """
+    if seed_image_id == SILENCE_SEED_IMAGE_ID:
+        # White is the quietest value of a spectrogram image
+        return Image.new("RGB", (width or SPECTROGRAM_HEIGHT, SPECTROGRAM_HEIGHT), "white")
+
+    init_image_path = Path(seed_images_dir, f"{seed_image_id}.png")
+    if not init_image_path.is_file():
+        return None
+
+    image = Image.open(str(init_image_path)).convert("RGB")
+    if width is None or width == image.width:
+        return image
+
+    tiled = Image.new("RGB", (width, image.height))
+    for x in range(0, width, image.width):
+        tiled.paste(image, (x, 0))
+    return tiled
+
+
+def compute_request(
+    inputs: InferenceInput,
+    pipeline: RiffusionPipeline,
+    seed_images_dir: Path,
+    binary: bool = False,
+    audio_format: str = "mp3",
+    image_format: str = "jpeg",
+) -> T.Union[str, bytes, T.Tuple[str, int]]:
+    """
+    Does all the heavy lifting of the request.
+
+    Args:
+        inputs: The input dataclass
+        pipeline: The riffusion model pipeline
+        seed_images_dir: The directory where seed images are stored
+        binary: Return binary frames instead of JSON with base64 encoded JPEG and MP3
+        audio_format: Audio format of the binary frames, one of AUDIO_FORMATS
+        image_format: Image format of the binary frames, one of IMAGE_FORMATS
+    """
+    # preprocess_image crops the seed image to a multiple of 32, anything else would come back
+    # narrower than requested
+    if inputs.width is not None and inputs.width % 32 != 0:
+        return f"Invalid width, must be a multiple of 32: {inputs.width}", 400
+
+    # Load the seed image by ID
+    init_image = load_seed_image(seed_images_dir, inputs.seed_image_id, width=inputs.width)
+    if init_image is None:
+        return f"Invalid seed image: {inputs.seed_image_id}", 400
+
+    # Load the mask image by ID
+    mask_image: T.Optional[Image.Image] = None
+    if inputs.mask_image_id:
+        mask_image = load_seed_image(seed_images_dir, inputs.mask_image_id, width=inputs.width)
+        if mask_image is None:
+            return f"Invalid mask image: {inputs.mask_image_id}", 400
+        mask_image = mask_image.convert("L")
+
+    # Run the model to get the output image
+    image = pipeline.riffuse(
+        inputs,
+        init_image=init_image,
+        mask_image=mask_image,
+    )
+
+    # Reconstruct audio from the image
+    params = SpectrogramParams()
+    converter = get_converter(params=params, device=str(pipeline.device))
+    segment = converter.audio_from_spectrogram_image(image, apply_filters=True)
+
+    if binary:
+        metadata = dict(
+            duration_s=segment.duration_seconds,
+            audio_format=audio_format,
+            sample_rate=segment.frame_rate,
+            channels=segment.channels,
+            sample_width=segment.sample_width,
+        )
+        return binary_util.encode_frames(
+            [
+                binary_util.Frame("metadata", "application/json", json.dumps(metadata).encode()),
+                binary_util.Frame(
+                    "image", IMAGE_FORMATS[image_format], encode_image(image, image_format)
+                ),
+                binary_util.Frame(
+                    "audio", AUDIO_FORMATS[audio_format], encode_audio(segment, audio_format)
+                ),
+            ]
+        )
+
+    # Assemble the output dataclass
+    output = InferenceOutput(
+        image="data:image/jpeg;base64," + base64_util.encode(io.BytesIO(encode_image(image))),
+        audio="data:audio/mpeg;base64," + base64_util.encode(io.BytesIO(encode_audio(segment))),
+        duration_s=segment.duration_seconds,
+    )
+
+    return json.dumps(dataclasses.asdict(output))
+
+
+def encode_image(image: Image.Image, image_format: str = "jpeg") -> bytes:
+    """
+    Image file bytes in the given format.
+    """
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format=image_format.upper())
+    return image_bytes.getvalue()
+
+
+def encode_audio(segment: pydub.AudioSegment, audio_format: str = "mp3") -> bytes:
+    """
+    Audio bytes in the given format, where pcm_s16le is the raw samples without a header.
+    """
+    if audio_format == "pcm_s16le":
+        return segment.raw_data
+
+    audio_bytes = io.BytesIO()
+    segment.export(audio_bytes, format=audio_format)
+    return audio_bytes.getvalue()
+
+
+if __name__ == "__main__":
+    import argh
+
+    argh.dispatch_command(run_app)
@@ -1,3 +1,5 @@
+import functools
+import typing as T
 import warnings
 
 import numpy as np
@@ -5,10 +7,44 @@ import pydub
 import torch
 import torchaudio
 
+from riffusion.phase_reconstruction import (
+    PHASE_RECONSTRUCTION_METHODS,
+    continue_angles,
+    fast_griffin_lim,
+    pghi_angles,
+)
 from riffusion.spectrogram_params import SpectrogramParams
 from riffusion.util import audio_util, torch_util
 
 
+INVERSE_MEL_METHODS = ["lstsq", "pinv"]
+
+
+@functools.lru_cache(maxsize=8)
+def inverse_mel_matrix(params: SpectrogramParams, device: str) -> torch.Tensor:
+    """
+    Pseudo-inverse of the mel filterbank for the given params, as a (frequency, mel) matrix.
+
+    Multiplying mel amplitudes by this matrix gives the minimum norm linear amplitudes that
+    map back onto them, which is what the least squares solve in InverseMelScale converges to,
+    but the expensive decomposition is done once instead of on every call.
+    """
+    filterbank = torchaudio.functional.melscale_fbanks(
+        n_freqs=params.n_fft // 2 + 1,
+        f_min=params.min_frequency,
+        f_max=params.max_frequency,
+        n_mels=params.num_frequencies,
+        sample_rate=params.sample_rate,
+        norm=params.mel_scale_norm,
+        mel_scale=params.mel_scale_type,
+    )
+
+    # The mel scaling is mel = filterbank.T @ linear, so invert filterbank.T
+    pinv = torch.linalg.pinv(filterbank.T.to(torch.float64))
+
+    return pinv.to(dtype=torch.float32, device=device)
+
+
 class SpectrogramConverter:
     """
     Convert between audio segments and spectrogram tensors using torchaudio.
@@ -58,6 +94,12 @@ class SpectrogramConverter:
             onesided=True,
         ).to(self.device)
 
+        if params.phase_reconstruction not in PHASE_RECONSTRUCTION_METHODS:
+            raise ValueError(
+                f"Unknown phase reconstruction {params.phase_reconstruction}, "
+                f"expected one of {PHASE_RECONSTRUCTION_METHODS}"
+            )
+
         # https://pytorch.org/audio/stable/generated/torchaudio.transforms.GriffinLim.html
         self.inverse_spectrogram_func = torchaudio.transforms.GriffinLim(
             n_fft=params.n_fft,
@@ -67,7 +109,7 @@ class SpectrogramConverter:
             window_fn=torch.hann_window,
             power=1.0,
             wkwargs=None,
-            momentum=0.99,
+            momentum=params.griffin_lim_momentum,
             length=None,
             rand_init=True,
         ).to(self.device)
@@ -83,6 +125,12 @@ class SpectrogramConverter:
             mel_scale=params.mel_scale_type,
         ).to(self.device)
 
+        if params.inverse_mel_method not in INVERSE_MEL_METHODS:
+            raise ValueError(
+                f"Unknown inverse mel method {params.inverse_mel_method}, "
+                f"expected one of {INVERSE_MEL_METHODS}"
+            )
+
         # https://pytorch.org/audio/stable/generated/torchaudio.transforms.InverseMelScale.html
         self.inverse_mel_scaler = torchaudio.transforms.InverseMelScale(
             n_stft=params.n_fft // 2 + 1,
@@ -162,6 +210,172 @@ class SpectrogramConverter:
 
         return segment
 
+    def waveform_from_spectrogram(
+        self,
+        spectrogram: np.ndarray,
+        apply_filters: bool = True,
+        normalize: bool = True,
+        length: T.Optional[int] = None,
+        window_frames: T.Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        Reconstruct a float waveform from a spectrogram, without going through an audio segment.
+
+        Args:
+            spectrogram: (batch, frequency, time)
+            apply_filters: Post-process with the float equivalent of the audio segment filters
+            normalize: Peak normalize when not applying the filters. Pieces of a longer
+                       waveform should be normalized together once they are joined.
+            length: Number of samples to reconstruct, by default hop_length * (time - 1)
+            window_frames: Reconstruct spectrograms wider than this in overlapping windows of
+                           this many frames, see iter_waveform_from_mel_amplitudes, so device
+                           memory doesn't grow with the width. Not used with `length`.
+
+        Returns:
+            waveform: (channels, samples) float32 array, in [-1, 1] if filtered or normalized
+        """
+        if window_frames is not None and length is None and spectrogram.shape[-1] > window_frames:
+            chunks = self.iter_waveform_from_mel_amplitudes(
+                torch.from_numpy(spectrogram), window_frames=window_frames
+            )
+            waveform = np.concatenate([chunk.cpu().numpy() for chunk in chunks], axis=-1)
+        else:
+            amplitudes_mel = torch.from_numpy(spectrogram).to(self.device)
+            waveform = self.waveform_from_mel_amplitudes(amplitudes_mel, length=length)
+            waveform = waveform.cpu().numpy()
+
+        if apply_filters:
+            return audio_util.filter_waveform(waveform)
+
+        if not normalize:
+            return waveform
+
+        peak = np.max(np.abs(waveform))
+        return waveform / peak if peak > 0 else waveform
+
+    def iter_audio_from_spectrogram(
+        self,
+        spectrogram: np.ndarray,
+        window_frames: int = 512,
+        overlap_frames: int = 64,
+        headroom_db: float = 0.1,
+    ) -> T.Iterator[pydub.AudioSegment]:
+        """
+        Reconstruct audio from a spectrogram in overlapping time windows, yielding consecutive
+        audio segments as soon as each window is done.
+
+        Peak memory depends on the window size rather than the spectrogram width, and the
+        first audio is available after a single window. Since the overall peak isn't known up
+        front, the audio is scaled by a gain that follows the running peak. The gain only ever
+        decreases, and ramps down within a chunk up to the first sample that exceeds the
+        previous peak instead of stepping at chunk boundaries, so nothing clips and the level
+        doesn't jump. Chunks are not post-processed with audio_util.apply_filters, which needs
+        the whole clip.
+
+        Args:
+            spectrogram: (batch, frequency, time)
+            window_frames: Number of spectrogram frames reconstructed at once
+            overlap_frames: Number of frames shared by neighboring windows, crossfaded
+            headroom_db: Peak level below full scale to normalize to
+
+        Returns:
+            Iterator of audio segments with channels equal to the batch dimension, which
+            concatenate to the full audio
+        """
+        amplitudes_mel = torch.from_numpy(spectrogram)
+
+        target_peak = np.iinfo(np.int16).max * 10 ** (-headroom_db / 20)
+        running_peak = 0.0
+        gain: T.Optional[float] = None
+
+        for waveform in self.iter_waveform_from_mel_amplitudes(
+            amplitudes_mel, window_frames=window_frames, overlap_frames=overlap_frames
+        ):
+            samples = waveform.cpu().numpy()
+            sample_peaks = np.max(np.abs(samples), axis=0, initial=0.0)
+            chunk_peak = float(np.max(sample_peaks, initial=0.0))
+
+            if chunk_peak > running_peak:
+                new_gain = target_peak / chunk_peak
+                gains = np.full(samples.shape[-1], new_gain, dtype=samples.dtype)
+                if gain is not None:
+                    # Samples before the first new peak fit under the previous gain, ramp
+                    # down over them
+                    first_exceeding = int(np.argmax(sample_peaks > running_peak))
+                    gains[:first_exceeding] = np.linspace(
+                        gain, new_gain, first_exceeding, endpoint=False
+                    )
+                samples *= gains
+                running_peak, gain = chunk_peak, new_gain
+            elif gain is not None:
+                samples *= gain
+
+            yield audio_util.audio_from_waveform(samples=samples, sample_rate=self.p.sample_rate)
+
+    def iter_waveform_from_mel_amplitudes(
+        self,
+        amplitudes_mel: torch.Tensor,
+        window_frames: int = 512,
+        overlap_frames: int = 64,
+    ) -> T.Iterator[torch.Tensor]:
+        """
+        Torch-only function to reconstruct a waveform from Mel-scale amplitudes in overlapping
+        time windows, yielding consecutive chunks of the waveform.
+
+        Every window is reconstructed on its own, starting from the phase of the previous
+        window in the frames they share, see continue_angles, and the samples shared by
+        neighboring windows are linearly crossfaded. Without that the two sides of a crossfade
+        have unrelated phases and comb filter. The chunks add up to the same length as the
+        output of waveform_from_mel_amplitudes on the whole input.
+
+        Args:
+            amplitudes_mel: (batch, frequency, time), on any device
+            window_frames: Number of frames reconstructed at once
+            overlap_frames: Number of frames shared by neighboring windows
+
+        Returns:
+            Iterator of (batch, samples) waveform chunks
+        """
+        if not 1 <= overlap_frames < window_frames - 1:
+            raise ValueError("overlap_frames must be at least 1 and less than window_frames - 1")
+
+        num_frames = amplitudes_mel.shape[-1]
+        overlap_samples = (overlap_frames - 1) * self.p.hop_length
+
+        pending: T.Optional[torch.Tensor] = None
+        leading_angles: T.Optional[torch.Tensor] = None
+        start = 0
+        while True:
+            end = min(start + window_frames, num_frames)
+            window = amplitudes_mel[..., start:end].to(self.device)
+            amplitudes_linear = self.linear_amplitudes_from_mel_amplitudes(window)
+            waveform = self.waveform_from_linear_amplitudes(
+                amplitudes_linear, leading_angles=leading_angles
+            )
+
+            if end < num_frames:
+                # Phase of the frames the next window starts with, before crossfading
+                leading_angles = self.spectrogram_func(waveform)[..., -overlap_frames:]
+
+            if pending is not None:
+                num_samples = min(pending.shape[-1], waveform.shape[-1])
+                fade_in = torch.linspace(
+                    0.0, 1.0, num_samples, device=waveform.device, dtype=waveform.dtype
+                )
+                waveform[..., :num_samples] = (
+                    pending[..., :num_samples] * (1 - fade_in)
+                    + waveform[..., :num_samples] * fade_in
+                )
+
+            if end == num_frames:
+                yield waveform
+                return
+
+            pending = waveform[..., -overlap_samples:] if overlap_samples else None
+            yield waveform[..., : waveform.shape[-1] - overlap_samples]
+
+            start = end - overlap_frames
+
     def mel_amplitudes_from_waveform(
         self,
         waveform: torch.Tensor,
@@ -184,21 +398,106 @@ class SpectrogramConverter:
         # Convert to mel scale
         return self.mel_scaler(amplitudes)
 
+    def linear_amplitudes_from_mel_amplitudes(
+        self,
+        amplitudes_mel: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Torch-only function to convert Mel-scale amplitudes to linear amplitudes, using the
+        inverse mel method selected in the params.
+
+        Args:
+            amplitudes_mel: (batch, frequency, time)
+
+        Returns:
+            amplitudes_linear: (batch, frequency, time)
+        """
+        if self.p.inverse_mel_method == "pinv":
+            inverse = inverse_mel_matrix(self.p, str(self.device))
+            amplitudes_linear = torch.matmul(inverse, amplitudes_mel.to(inverse.dtype))
+            return amplitudes_linear.clamp_(min=0)
+
+        return self.inverse_mel_scaler(amplitudes_mel)
+
     def waveform_from_mel_amplitudes(
         self,
         amplitudes_mel: torch.Tensor,
+        length: T.Optional[int] = None,
     ) -> torch.Tensor:
         """
         Torch-only function to approximately reconstruct a waveform from Mel-scale amplitudes.
 
         Args:
             amplitudes_mel: (batch, frequency, time)
+            length: Number of samples to reconstruct, by default hop_length * (time - 1)
 
         Returns:
             waveform: (batch, samples)
         """
         # Convert from mel scale to linear
-        amplitudes_linear = self.inverse_mel_scaler(amplitudes_mel)
+        amplitudes_linear = self.linear_amplitudes_from_mel_amplitudes(amplitudes_mel)
 
         # Run the approximate algorithm to compute the phase and recover the waveform
-        return self.inverse_spectrogram_func(amplitudes_linear)
+        return self.waveform_from_linear_amplitudes(amplitudes_linear, length=length)
+
+    def waveform_from_linear_amplitudes(
+        self,
+        amplitudes_linear: torch.Tensor,
+        length: T.Optional[int] = None,
+        leading_angles: T.Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Torch-only function to reconstruct a waveform from linear STFT amplitudes, using the
+        phase reconstruction method selected in the params.
+
+        Args:
+            amplitudes_linear: (batch, frequency, time)
+            length: Number of samples to reconstruct, by default hop_length * (time - 1)
+            leading_angles: (batch, frequency, overlap) complex phase the first frames start
+                            from, see continue_angles. With "griffin_lim" this runs the
+                            equivalent fast_griffin_lim, which takes an initial phase.
+
+        Returns:
+            waveform: (batch, samples)
+        """
+        method = self.p.phase_reconstruction
+        if method == "griffin_lim" and leading_angles is None:
+            if length is None:
+                return self.inverse_spectrogram_func(amplitudes_linear)
+
+            # Same as the transform, which only takes the length at construction
+            griffin_lim = self.inverse_spectrogram_func
+            return torchaudio.functional.griffinlim(
+                amplitudes_linear,
+                griffin_lim.window,
+                griffin_lim.n_fft,
+                griffin_lim.hop_length,
+                griffin_lim.win_length,
+                griffin_lim.power,
+                griffin_lim.n_iter,
+                griffin_lim.momentum,
+                length,
+                griffin_lim.rand_init,
+            )
+
+        stft_kwargs = dict(
+            n_fft=self.p.n_fft,
+            hop_length=self.p.hop_length,
+            win_length=self.p.win_length,
+        )
+
+        init_angles = None
+        if method in ("pghi", "pghi_fast_griffin_lim"):
+            init_angles = pghi_angles(amplitudes_linear, **stft_kwargs)
+        if leading_angles is not None:
+            init_angles = continue_angles(leading_angles, amplitudes_linear, init_angles)
+
+        return fast_griffin_lim(
+            amplitudes_linear,
+            n_iter=0 if method == "pghi" else self.p.num_griffin_lim_iters,
+            momentum=self.p.griffin_lim_momentum,
+            init_angles=init_angles,
+            tolerance=self.p.griffin_lim_tolerance,
+            length=length,
+            **stft_kwargs,
+        )
@@ -1,10 +1,13 @@
+import threading
+import typing as T
+
 import numpy as np
 import pydub
 from PIL import Image
 
 from riffusion.spectrogram_converter import SpectrogramConverter
 from riffusion.spectrogram_params import SpectrogramParams
-from riffusion.util import image_util
+from riffusion.util import image_util, torch_util
 
 
 class SpectrogramImageConverter:
@@ -89,3 +92,107 @@ class SpectrogramImageConverter:
         )
 
         return segment
+
+    def waveform_from_spectrogram_image(
+        self,
+        image: Image.Image,
+        apply_filters: bool = True,
+        max_value: float = 30e6,
+        normalize: bool = True,
+        length: T.Optional[int] = None,
+        window_frames: T.Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        Reconstruct a float waveform from a spectrogram image. See
+        SpectrogramConverter.waveform_from_spectrogram.
+
+        Args:
+            image: Spectrogram image (in pillow format)
+            apply_filters: Apply post-processing to improve the reconstructed audio
+            max_value: Scaled max amplitude of the spectrogram. Shouldn't matter.
+            normalize: Peak normalize when not applying the filters
+            length: Number of samples to reconstruct, by default hop_length * (width - 1)
+            window_frames: Reconstruct images wider than this in overlapping windows
+
+        Returns:
+            waveform: (channels, samples) float32 array, in [-1, 1] if filtered or normalized
+        """
+        spectrogram = image_util.spectrogram_from_image(
+            image,
+            max_value=max_value,
+            power=self.p.power_for_image,
+            stereo=self.p.stereo,
+        )
+
+        return self.converter.waveform_from_spectrogram(
+            spectrogram,
+            apply_filters=apply_filters,
+            normalize=normalize,
+            length=length,
+            window_frames=window_frames,
+        )
+
+    def iter_audio_from_spectrogram_image(
+        self,
+        image: Image.Image,
+        window_frames: int = 512,
+        overlap_frames: int = 64,
+        max_value: float = 30e6,
+    ) -> T.Iterator[pydub.AudioSegment]:
+        """
+        Reconstruct audio from a spectrogram image in overlapping time windows, yielding audio
+        segments as they are ready. See SpectrogramConverter.iter_audio_from_spectrogram.
+
+        Args:
+            image: Spectrogram image (in pillow format)
+            window_frames: Number of image columns reconstructed at once
+            overlap_frames: Number of columns shared by neighboring windows
+            max_value: Scaled max amplitude of the spectrogram. Shouldn't matter.
+        """
+        spectrogram = image_util.spectrogram_from_image(
+            image,
+            max_value=max_value,
+            power=self.p.power_for_image,
+            stereo=self.p.stereo,
+        )
+
+        yield from self.converter.iter_audio_from_spectrogram(
+            spectrogram,
+            window_frames=window_frames,
+            overlap_frames=overlap_frames,
+        )
+
+
+_CONVERTERS: T.Dict[T.Tuple[SpectrogramParams, str], SpectrogramImageConverter] = {}
+_CONVERTERS_LOCK = threading.Lock()
+
+
+def get_converter(params: SpectrogramParams, device: str = "cuda") -> SpectrogramImageConverter:
+    """
+    Get a shared converter for the given params and device, constructing it on first use.
+
+    Building a converter sets up the spectrogram, Griffin-Lim and mel scale transforms, so
+    reusing one keeps that cost out of every request. After construction a converter holds no
+    mutable state, so the same instance can be used from several threads at once.
+    """
+    key = (params, torch_util.check_device(device))
+
+    converter = _CONVERTERS.get(key)
+    if converter is not None:
+        return converter
+
+    with _CONVERTERS_LOCK:
+        converter = _CONVERTERS.get(key)
+        if converter is None:
+            converter = SpectrogramImageConverter(params=params, device=key[1])
+            _CONVERTERS[key] = converter
+
+    return converter
+
+
+def clear_converters() -> None:
+    """
+    Drop all shared converters.
+    """
+    with _CONVERTERS_LOCK:
+        _CONVERTERS.clear()
@@ -35,9 +35,23 @@ class SpectrogramParams:
     mel_scale_type: str = "htk"
     max_mel_iters: int = 200
 
+    # How to invert the mel scale, one of:
+    #   "lstsq": torchaudio's InverseMelScale, which solves a least squares problem per call
+    #   "pinv": a precomputed pseudo-inverse of the mel filterbank clamped to be non-negative,
+    #           applied as a single matmul
+    inverse_mel_method: str = "lstsq"
+
     # Griffin Lim parameters
     num_griffin_lim_iters: int = 32
 
+    # Phase reconstruction algorithm, one of riffusion.phase_reconstruction.
+    # PHASE_RECONSTRUCTION_METHODS. The options other than "griffin_lim" use the momentum and
+    # stop early once the spectral convergence improves by less than the tolerance (relative)
+    # per iteration, a tolerance of 0 always runs all iterations.
+    phase_reconstruction: str = "griffin_lim"
+    griffin_lim_momentum: float = 0.99
+    griffin_lim_tolerance: float = 0.0
+
     # Image parameterization
     power_for_image: float = 0.25
 
@@ -0,0 +1,182 @@
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+MANIFEST_NAME = "manifest.json"
+
+# Entries still being written after this long were left behind by a crash and are deleted
+STALE_WORK_DIR_AGE_S = 6 * 60 * 60
+
+
+class DiskCache:
+    """
+    Content-addressed cache of files on disk, bounded in size, the base of the split and
+    generation caches.
+
+    Every entry is a directory named after its key, with the cached files and a manifest whose
+    mtime is the last access time. Entries are written to a temporary directory and moved in
+    place, so readers never see a partial entry, and the least recently used entries are
+    deleted once the cache takes more than max_bytes.
+
+    Reading, writing and deleting an entry all hold the lock of its key. Subclasses read the
+    files of an entry into memory, or link them elsewhere, before releasing it, so eviction
+    never deletes files that are still being used.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> [lock, number of threads using it], dropped when no thread uses it
+        self._key_locks = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    @contextlib.contextmanager
+    def key_lock(self, key, blocking=True):
+        """
+        Holds the lock of a key. Yields whether it was acquired, which is always the case when
+        blocking.
+        """
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(blocking=blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._key_locks[key]
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def read_manifest(self, key, names=()):
+        """
+        Returns the manifest of the entry, or None if it is missing or any of the files `names`
+        is. Marks the entry as used. Callers hold the key lock.
+        """
+        entry_dir = self.entry_dir(key)
+        manifest_path = os.path.join(entry_dir, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if not all(os.path.exists(os.path.join(entry_dir, name)) for name in names):
+                return None
+            # The manifest mtime is the last access time used for LRU eviction
+            os.utime(manifest_path)
+        except (OSError, ValueError):
+            return None
+        return manifest
+
+    def write_entry(self, key, write):
+        """
+        Writes an entry. `write(work_dir)` creates the files of the entry in work_dir and
+        returns the fields of its manifest, to which the total size of the files is added.
+        Replaces any existing entry. Callers hold the key lock.
+
+        Returns the manifest.
+        """
+        entry_dir = self.entry_dir(key)
+        work_dir = tempfile.mkdtemp(prefix=f".{key}_", dir=self.root)
+        try:
+            manifest = dict(write(work_dir))
+            manifest["num_bytes"] = sum(
+                os.path.getsize(os.path.join(work_dir, name)) for name in os.listdir(work_dir)
+            )
+            manifest["created"] = time.time()
+            with open(os.path.join(work_dir, MANIFEST_NAME), "w") as f:
+                json.dump(manifest, f)
+
+            # Replace any stale entry, then move the new one in place atomically
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(work_dir, entry_dir)
+        except BaseException:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+        return manifest
+
+    def count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def entries(self):
+        """
+        Returns (last access time, size in bytes, directory) for every cache entry.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            # Skip entries that are still being written
+            if name.startswith("."):
+                continue
+            manifest_path = os.path.join(self.root, name, MANIFEST_NAME)
+            try:
+                with open(manifest_path) as f:
+                    num_bytes = json.load(f)["num_bytes"]
+                last_access = os.path.getmtime(manifest_path)
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((last_access, num_bytes, os.path.join(self.root, name)))
+        return entries
+
+    @property
+    def total_bytes(self):
+        return sum(num_bytes for _, num_bytes, _ in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes, and the
+        work directories of writes that never finished.
+
+        The entry with the key `keep` is never deleted, and neither are entries whose key lock
+        is held, i.e. that are being read or written right now.
+        """
+        self._remove_stale_work_dirs()
+
+        entries = sorted(self.entries())
+        total = sum(num_bytes for _, num_bytes, _ in entries)
+        for _, num_bytes, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            key = os.path.basename(entry_dir)
+            if keep is not None and key == keep:
+                continue
+            with self.key_lock(key, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= num_bytes
+
+    def _remove_stale_work_dirs(self):
+        cutoff = time.time() - STALE_WORK_DIR_AGE_S
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if name.startswith(".") and os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                continue
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return dict(
+            hits=hits,
+            misses=misses,
+            hit_rate=hits / total if total else 0.0,
+            total_bytes=self.total_bytes,
+            max_bytes=self.max_bytes,
+        )
@@ -0,0 +1,123 @@
+import dataclasses
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+import streamlit as st
+from PIL import Image
+from scipy.io import wavfile
+
+from riffusion.streamlit.tasks.disk_cache import DiskCache
+from riffusion.streamlit.tasks.video_processing import OUTPUT_DIR
+from riffusion.util import waveform_util
+
+# Total size of cached generations before the least recently used ones are deleted
+GENERATION_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Environment variable to put the cache somewhere else, e.g. on a volume shared by replicas
+GENERATION_CACHE_DIR_ENV = "RIFFUSION_GENERATION_CACHE_DIR"
+
+IMAGE_NAME = "spectrogram.png"
+AUDIO_NAME = "audio.wav"
+
+
+class GenerationCache(DiskCache):
+    """
+    Content-addressed cache of generated spectrograms and the audio reconstructed from them.
+
+    The key covers everything that determines the output: the model, the generation
+    parameters and the spectrogram parameters. A hit skips both the diffusion and the audio
+    reconstruction. Every entry is a directory with a PNG, a float WAV and a manifest, see
+    DiskCache. Hits are read into memory under the key lock, so eviction can't delete them
+    halfway through.
+    """
+
+    def __init__(self, root=None, max_bytes=GENERATION_CACHE_MAX_BYTES):
+        root = root or os.environ.get(GENERATION_CACHE_DIR_ENV) or os.path.join(
+            OUTPUT_DIR, "generations"
+        )
+        super().__init__(root, max_bytes)
+
+    @staticmethod
+    def key(params=None, **generation):
+        """
+        Cache key for a generation with the given parameters and SpectrogramParams.
+        """
+        payload = json.dumps(
+            dict(
+                generation=generation,
+                params=dataclasses.asdict(params) if params is not None else None,
+            ),
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached (spectrogram image, (channels, samples) waveform) for the key, or
+        None on a miss.
+        """
+        entry_dir = self.entry_dir(key)
+        with self.key_lock(key):
+            try:
+                if self.read_manifest(key, names=(IMAGE_NAME, AUDIO_NAME)) is None:
+                    raise FileNotFoundError(entry_dir)
+                with open(os.path.join(entry_dir, IMAGE_NAME), "rb") as f:
+                    image = Image.open(io.BytesIO(f.read()))
+                    image.load()
+                waveform, _ = load_waveform(os.path.join(entry_dir, AUDIO_NAME), mmap=False)
+            except (OSError, ValueError):
+                # Deleted by another process, or unreadable, in which case the next put
+                # overwrites it
+                self.count(hit=False)
+                return None
+
+        self.count(hit=True)
+        return image, waveform
+
+    def put(self, key, image, waveform, sample_rate):
+        """
+        Stores a spectrogram image and its (channels, samples) float waveform.
+        """
+
+        def write(work_dir):
+            image.save(os.path.join(work_dir, IMAGE_NAME), format="PNG")
+            # Float WAV, so reading it back gives the exact waveform
+            wavfile.write(
+                os.path.join(work_dir, AUDIO_NAME),
+                sample_rate,
+                np.ascontiguousarray(np.atleast_2d(waveform).T, dtype=np.float32),
+            )
+            return dict(duration_s=np.atleast_2d(waveform).shape[1] / sample_rate)
+
+        with self.key_lock(key):
+            self.write_entry(key, write)
+
+        self.evict(keep=key)
+
+
+def load_waveform(path, mmap=True):
+    """
+    Reads a cached WAV back into a (channels, samples) float waveform and its sample rate.
+    With `mmap` float samples are memory mapped rather than read.
+    """
+    sample_rate, samples = wavfile.read(path, mmap=mmap)
+
+    # Integer PCM, as written by older versions of the cache, scaled like waveform_from_audio
+    if np.issubdtype(samples.dtype, np.integer):
+        samples = samples.astype(np.float32) * (
+            1 / waveform_util.full_scale(samples.dtype.itemsize)
+        )
+
+    return np.atleast_2d(samples.T), sample_rate
+
+
+@st.cache_resource
+def get_generation_cache():
+    """
+    Singleton generation cache shared by all sessions of this process.
+    """
+    return GenerationCache()
@@ -1,27 +1,71 @@
+import math
+
 import torch
 import streamlit as st
 
-from diffusers import DiffusionPipeline
+from PIL import Image
 
+from riffusion import client as riffusion_client
+from riffusion.datatypes import InferenceInput, PromptInput
 from riffusion.streamlit import util as streamlit_util
-from riffusion.spectrogram_image_converter import SpectrogramImageConverter
+from riffusion.streamlit.tasks.generation_cache import GenerationCache, get_generation_cache
+from riffusion.spectrogram_image_converter import get_converter
 from riffusion.spectrogram_params import SpectrogramParams
+from riffusion.util import audio_util, waveform_util
+
+# Sample rate of the generated waveforms
+AUDIO_SAMPLE_RATE = SpectrogramParams().sample_rate
+
+# Width of every spectrogram tile in tiled generation, the native resolution of the model
+TILE_WIDTH = 512
+
+# Columns shared by neighbouring tiles, kept from the previous tile and crossfaded in audio
+TILE_OVERLAP = 64
+
+# How much of each new tile is repainted, outside of the overlap which is always kept
+TILE_DENOISING = 0.75
+
+# Spectrograms wider than this are converted to audio in overlapping windows of this many
+# columns, so the memory of the audio reconstruction doesn't grow with the part duration
+RECONSTRUCTION_WINDOW_FRAMES = 512
+
+
+def default_device():
+    """
+    Returns "cuda" if it is available, otherwise falls back to "cpu".
+    """
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def warmup(device=None):
+    """
+    Loads the text to image pipeline into the shared model registry at app startup,
+    so the first "Generate and Add Audio" click doesn't pay for loading the checkpoint.
+    """
+    if riffusion_client.server_url():
+        return None
+    device = device or default_device()
+    return streamlit_util.warmup_models(device=str(device))
 
 
 def pipe_and_device_generate():
     """
-    Initializes the DiffusionPipeline and moves it to the appropriate device.
+    Returns the shared diffusion pipeline and the device it runs on.
 
     This function checks if CUDA is available and sets the device accordingly.
-    If CUDA is not available, it falls back to using the CPU. The function then
-    loads the pre-trained DiffusionPipeline model and moves it to the selected device.
+    If CUDA is not available, it falls back to using the CPU. The pipeline comes from the
+    process-wide model registry, so it is the same instance `predict` uses and the
+    checkpoint is only loaded once per process. When an inference server is configured
+    no pipeline is loaded and None is returned in its place.
     """
-    pipe = DiffusionPipeline.from_pretrained("riffusion/riffusion-model-v1")
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    return pipe.to(device), device
+    device = default_device()
+    if riffusion_client.server_url():
+        return None, device
+    pipe = streamlit_util.load_stable_diffusion_pipeline(device=str(device))
+    return pipe, device
 
 
-def predict(prompt, negative_prompt, width, seed, num_inference_steps, device):
+def predict(prompt, negative_prompt, width, seed, num_inference_steps, device, tiled=False):
     """
     Collects parameters for spectrogram generation and training.
 
@@ -29,9 +73,96 @@ def predict(prompt, negative_prompt, width, seed, num_inference_steps, device):
     a spectrogram image and running the training process. The parameters are collected
     through a user interface, similar to the implementation in the provided example:
     https://github.com/riffusion/riffusion-hobby/blob/main/riffusion/streamlit/tasks/text_to_audio.py
+
+    With `tiled` the spectrogram is generated as fixed-width tiles instead of one image of the
+    full width, see `generate_tiled`. If RIFFUSION_SERVER_URL is set, the model runs on that
+    inference server instead of in this process, see `generate_remote`. The server generates
+    one image of the full width, it has no tiled mode, so `tiled` doesn't apply there.
+
+    Results are kept in the generation cache, so repeating a generation skips both the
+    diffusion and the audio reconstruction.
+
+    Returns the generated audio as a (channels, samples) float waveform at AUDIO_SAMPLE_RATE,
+    to be handed to `add_audio_to_video` without going through a file, and the spectrogram.
     """
+    url = riffusion_client.server_url()
     params = SpectrogramParams()
-    converter = SpectrogramImageConverter(params)
+
+    if url:
+        if tiled:
+            st.info("Tiled generation is not available on the inference server, generating the "
+                    "full width at once.")
+        key = generation_key(
+            "remote", prompt, negative_prompt, width, seed, num_inference_steps, device, params,
+            url=url
+        )
+    elif tiled:
+        key = generation_key(
+            "tiled", prompt, negative_prompt, width, seed, num_inference_steps, device, params,
+            tile_width=TILE_WIDTH, overlap=TILE_OVERLAP, denoising=TILE_DENOISING
+        )
+    else:
+        key = generation_key(
+            "txt2img", prompt, negative_prompt, width, seed, num_inference_steps, device, params
+        )
+
+    cache = get_generation_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        image, waveform = cached
+    else:
+        if url:
+            waveform, image = generate_remote(
+                url, prompt, negative_prompt, width, seed, num_inference_steps
+            )
+        elif tiled:
+            waveform, image = generate_tiled(
+                prompt, negative_prompt, width, seed, num_inference_steps, device, params=params
+            )
+        else:
+            waveform, image = generate_txt2img(
+                prompt, negative_prompt, width, seed, num_inference_steps, device, params=params
+            )
+        cache.put(key, image, waveform, params.sample_rate)
+
+    st.audio(waveform, sample_rate=params.sample_rate)
+    return waveform, image
+
+
+def generation_key(
+    mode, prompt, negative_prompt, width, seed, num_inference_steps, device, params, **extra
+):
+    """
+    Generation cache key for everything that determines the output of `predict`.
+
+    Only the device type is part of it, seeded noise differs between CPU and CUDA generators
+    but not between two GPUs.
+    """
+    return GenerationCache.key(
+        params=params,
+        mode=mode,
+        checkpoint=streamlit_util.DEFAULT_CHECKPOINT,
+        scheduler=streamlit_util.SCHEDULER_OPTIONS[0],
+        prompt=prompt,
+        negative_prompt=negative_prompt or "",
+        seed=seed,
+        num_inference_steps=num_inference_steps,
+        guidance=7.0,
+        width=width,
+        height=512,
+        device_type=str(device).split(":")[0],
+        **extra,
+    )
+
+
+def generate_txt2img(prompt, negative_prompt, width, seed, num_inference_steps, device, params):
+    """
+    Generates a spectrogram of the full width in one text to image call. Wide spectrograms
+    are converted to audio window by window, see RECONSTRUCTION_WINDOW_FRAMES.
+
+    Returns the waveform and the spectrogram image.
+    """
+    converter = get_converter(params, device=device)
     image = streamlit_util.run_txt2img(
         prompt=prompt,
         num_inference_steps=num_inference_steps,
@@ -42,7 +173,224 @@ def predict(prompt, negative_prompt, width, seed, num_inference_steps, device):
         height=512,
         device=device
     )
-    wav = converter.audio_from_spectrogram_image(image=image)
-    wav.export('output.wav', format='wav')
-    st.audio('output.wav')
-    return 'output.wav', image
+    waveform = converter.waveform_from_spectrogram_image(
+        image=image, window_frames=RECONSTRUCTION_WINDOW_FRAMES
+    )
+    return waveform, image
+
+
+@st.cache_resource
+def get_client(url):
+    """
+    Shared inference server client, so connections are reused across requests.
+    """
+    return riffusion_client.RiffusionClient(url)
+
+
+def generate_remote(url, prompt, negative_prompt, width, seed, num_inference_steps):
+    """
+    Generates audio on the inference server at the given URL.
+
+    Riffuse with full denoising on a silent seed image is text to image generation. The
+    server only takes widths that are a multiple of 32, so the width is rounded up to one,
+    which adds at most a fraction of a second of audio past the video.
+    Returns the waveform and the spectrogram image.
+    """
+    width = math.ceil(width / 32) * 32
+
+    prompt_input = PromptInput(
+        prompt=prompt,
+        seed=seed,
+        negative_prompt=negative_prompt or None,
+        denoising=1.0,
+        guidance=7.0,
+    )
+    inputs = InferenceInput(
+        start=prompt_input,
+        end=prompt_input,
+        alpha=0.0,
+        num_inference_steps=num_inference_steps,
+        seed_image_id="silence",
+        width=width,
+    )
+    image, segment = get_client(url).run(inputs)
+    return audio_util.waveform_from_audio(segment), image
+
+
+def predict_batch(jobs, num_inference_steps, device):
+    """
+    Generates audio for several (prompt, negative prompt, seed, width) jobs at once.
+
+    Jobs found in the generation cache are served from it, the rest share batched denoising
+    calls by width, see `streamlit_util.run_txt2img_batch`. Returns a list of
+    (waveform, spectrogram image) in the order of the jobs, see `predict`.
+    """
+    params = SpectrogramParams()
+    cache = get_generation_cache()
+
+    keys = [
+        generation_key(
+            "txt2img", prompt, negative_prompt, width, seed, num_inference_steps, device, params
+        )
+        for prompt, negative_prompt, seed, width in jobs
+    ]
+    results = []
+    for key in keys:
+        cached = cache.get(key)
+        if cached is not None:
+            image, waveform = cached
+            cached = (waveform, image)
+        results.append(cached)
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    if missing:
+        converter = get_converter(params, device=device)
+        images = streamlit_util.run_txt2img_batch(
+            [
+                streamlit_util.Txt2ImgJob(
+                    prompt=jobs[i][0],
+                    negative_prompt=jobs[i][1],
+                    seed=jobs[i][2],
+                    width=jobs[i][3],
+                )
+                for i in missing
+            ],
+            num_inference_steps=num_inference_steps,
+            guidance=7.0,
+            device=device,
+        )
+        for i, image in zip(missing, images):
+            waveform = converter.waveform_from_spectrogram_image(
+                image=image, window_frames=RECONSTRUCTION_WINDOW_FRAMES
+            )
+            cache.put(keys[i], image, waveform, params.sample_rate)
+            results[i] = (waveform, image)
+
+    return results
+
+
+def generate_tiled(
+    prompt,
+    negative_prompt,
+    width,
+    seed,
+    num_inference_steps,
+    device,
+    params,
+    tile_width=TILE_WIDTH,
+    overlap=TILE_OVERLAP,
+    denoising=TILE_DENOISING,
+):
+    """
+    Generates audio for a spectrogram of any width as a sequence of fixed-width tiles.
+
+    The UNet cost of one txt2img call grows faster than linearly with the width, so for long
+    video parts the spectrogram is generated as `tile_width` wide tiles instead: the first one
+    with txt2img, every next one with riffuse img2img on top of the previous tile, keeping
+    its last `overlap` columns through the mask so the music continues across the seam. Each
+    tile is converted to exactly `tile_width` columns of audio on its own, the audio is
+    crossfaded over the overlap and normalized once, so the loudness doesn't jump between tiles.
+    Latency grows linearly with the duration and peak memory stays that of a single tile.
+
+    Returns the waveform and the stitched spectrogram image.
+    """
+    converter = get_converter(params, device=device)
+
+    tiles = generate_spectrogram_tiles(
+        prompt, negative_prompt, width, seed, num_inference_steps, device,
+        tile_width=tile_width, overlap=overlap, denoising=denoising
+    )
+
+    waveforms = [
+        converter.waveform_from_spectrogram_image(
+            image=tile,
+            apply_filters=False,
+            normalize=False,
+            length=tile_width * params.hop_length,
+        )
+        for tile in tiles
+    ]
+    waveform = waveform_util.stitch(waveforms, overlap * params.hop_length)
+    waveform = audio_util.filter_waveform(waveform[:, :width * params.hop_length])
+
+    image = stitch_spectrogram_tiles(tiles, overlap)
+    return waveform, image
+
+
+def generate_spectrogram_tiles(
+    prompt,
+    negative_prompt,
+    width,
+    seed,
+    num_inference_steps,
+    device,
+    tile_width=TILE_WIDTH,
+    overlap=TILE_OVERLAP,
+    denoising=TILE_DENOISING,
+    height=512,
+):
+    """
+    Generates enough overlapping spectrogram tiles to cover `width` columns.
+    """
+    stride = tile_width - overlap
+    num_tiles = max(1, math.ceil((width - overlap) / stride))
+
+    tiles = [
+        streamlit_util.run_txt2img(
+            prompt=prompt,
+            num_inference_steps=num_inference_steps,
+            guidance=7.0,
+            negative_prompt=negative_prompt,
+            seed=seed,
+            width=tile_width,
+            height=height,
+            device=device
+        )
+    ]
+    if num_tiles == 1:
+        return tiles
+
+    pipeline = streamlit_util.load_riffusion_pipeline_shared(device=device)
+
+    # Black keeps the overlap from the previous tile, white is repainted
+    mask = Image.new("L", (tile_width, height), 255)
+    mask.paste(0, (0, 0, overlap, height))
+
+    for i in range(1, num_tiles):
+        previous = tiles[-1]
+
+        # The tail of the previous tile, followed by its beginning as a starting point
+        init_image = Image.new("RGB", (tile_width, height))
+        init_image.paste(previous.crop((tile_width - overlap, 0, tile_width, height)), (0, 0))
+        init_image.paste(previous.crop((0, 0, tile_width - overlap, height)), (overlap, 0))
+
+        prompt_input = PromptInput(
+            prompt=prompt,
+            seed=seed + i,
+            negative_prompt=negative_prompt or None,
+            denoising=denoising,
+            guidance=7.0,
+        )
+        inputs = InferenceInput(
+            start=prompt_input,
+            end=prompt_input,
+            alpha=0.0,
+            num_inference_steps=num_inference_steps,
+        )
+
+        with streamlit_util.pipeline_lock():
+            tiles.append(pipeline.riffuse(inputs, init_image=init_image, mask_image=mask))
+
+    return tiles
+
+
+def stitch_spectrogram_tiles(tiles, overlap):
+    """
+    Pastes overlapping spectrogram tiles into one image for display.
+    """
+    tile_width, height = tiles[0].size
+    stride = tile_width - overlap
+    image = Image.new("RGB", (tile_width + stride * (len(tiles) - 1), height))
+    for i, tile in enumerate(tiles):
+        image.paste(tile, (i * stride, 0))
+    return image
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import shutil
+
+import streamlit as st
+
+from riffusion.streamlit.tasks.disk_cache import DiskCache
+from riffusion.streamlit.tasks.video_processing import (
+    AUDIO_CODEC, OUTPUT_DIR, VIDEO_CODEC, CutPoint, split_video
+)
+from riffusion.streamlit.tasks.workspace import get_output_workspace_manager
+
+# Total size of cached split parts before the least recently used splits are deleted
+SPLIT_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+
+
+class SplitCache(DiskCache):
+    """
+    Content-addressed cache of split_video results.
+
+    The key is the hash of the input content together with the split parameters, so
+    re-splitting the same video into the same parts returns the cached files instantly.
+    Every entry is a directory with the part files and a manifest, see DiskCache.
+
+    The parts are hardlinked (or copied, across file systems) into the output workspace of the
+    session under the key lock before they are returned, so evicting an entry never removes
+    files a session still uses.
+    """
+
+    def __init__(self, root=os.path.join(OUTPUT_DIR, "splits"), max_bytes=SPLIT_CACHE_MAX_BYTES):
+        super().__init__(root, max_bytes)
+
+    @staticmethod
+    def key(input_hash, n_parts, mode, codec_settings=None):
+        """
+        Cache key for splitting the content with the given hash.
+        """
+        codec_settings = codec_settings or {"video_codec": VIDEO_CODEC, "audio_codec": AUDIO_CODEC}
+        payload = json.dumps(
+            dict(input_hash=input_hash, n_parts=n_parts, mode=mode, codec=codec_settings),
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached (files, cut points) for the key, or None on a miss. The files are
+        those of the cache entry, callers have to hold the key lock while using them.
+        """
+        manifest = self.read_manifest(key)
+        if manifest is None:
+            return None
+
+        files = [os.path.join(self.entry_dir(key), name) for name in manifest["files"]]
+        if not all(os.path.exists(path) for path in files):
+            return None
+
+        cut_points = [CutPoint(**cut) for cut in manifest["cut_points"]]
+        return files, cut_points
+
+    def split(self, input_path, input_hash, n_parts, mode="reencode", **split_kwargs):
+        """
+        Returns the parts of the split from the cache, running split_video on a miss.
+
+        Returns the same (output_dir, files, cut_points) triple as split_video. output_dir is
+        a fresh directory in the output workspace of the session, holding the session's own
+        links to the parts, and meant for the outputs derived from them.
+        """
+        key = self.key(input_hash, n_parts, mode)
+
+        # Concurrent requests for the same split wait for one of them to produce it
+        with self.key_lock(key):
+            cached = self.get(key)
+            self.count(hit=cached is not None)
+            if cached is not None:
+                files, cut_points = cached
+            else:
+                files, cut_points = self._put(key, input_path, n_parts, mode, split_kwargs)
+
+            output_dir, files = self._checkout(files)
+
+        self.evict(keep=key)
+        return output_dir, files, cut_points
+
+    @staticmethod
+    def _checkout(files):
+        """
+        Hardlinks the files of an entry into a new directory in the output workspace of the
+        session, copying them if the workspace is on another file system.
+        """
+        output_dir = get_output_workspace_manager().new_file(prefix="split_")
+        os.makedirs(output_dir)
+
+        paths = []
+        for path in files:
+            session_path = os.path.join(output_dir, os.path.basename(path))
+            try:
+                os.link(path, session_path)
+            except OSError:
+                shutil.copy2(path, session_path)
+            paths.append(session_path)
+        return output_dir, paths
+
+    def _put(self, key, input_path, n_parts, mode, split_kwargs):
+        cut_points = []
+
+        def write(work_dir):
+            _, files, cuts = split_video(
+                input_path, n_parts, mode=mode, output_dir=work_dir, **split_kwargs
+            )
+            cut_points.extend(cuts)
+            return dict(
+                files=[os.path.basename(path) for path in files],
+                cut_points=[
+                    dict(
+                        requested_s=cut.requested_s,
+                        actual_s=cut.actual_s,
+                        on_keyframe=cut.on_keyframe,
+                    )
+                    for cut in cuts
+                ],
+            )
+
+        manifest = self.write_entry(key, write)
+        files = [os.path.join(self.entry_dir(key), name) for name in manifest["files"]]
+        return files, cut_points
+
+
+@st.cache_resource
+def get_split_cache():
+    """
+    Singleton split cache shared by all sessions of this process.
+    """
+    return SplitCache()
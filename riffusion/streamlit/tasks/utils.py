@@ -1,9 +1,25 @@
+import hashlib
 import os
+import tempfile
 import streamlit as st
 
 from datetime import datetime
 from zipfile import ZipFile
 
+from riffusion.streamlit.tasks.workspace import get_workspace_manager
+
+# Uploads are copied to disk in blocks of this size, so memory per upload stays bounded
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Largest accepted upload, in bytes
+MAX_UPLOAD_BYTES = 4 * 1024 * 1024 * 1024
+
+
+class UploadTooLargeError(ValueError):
+    """
+    Raised when an uploaded file exceeds the size limit.
+    """
+
 
 def display_videos_in_columns(video_files, num_columns):
     """
@@ -19,11 +35,92 @@ def display_videos_in_columns(video_files, num_columns):
             st.video(video_file)
 
 
+def display_cut_points(cut_points):
+    """
+    Function to report the cut points that were moved to a keyframe while splitting, and
+    warn about the ones for which no keyframe was found.
+    """
+    snapped = [(idx, cut) for idx, cut in enumerate(cut_points) if cut.snapped]
+    if snapped:
+        lines = [
+            f"- Between parts {idx + 1} and {idx + 2}: "
+            f"{cut.requested_s:.2f}s → {cut.actual_s:.2f}s"
+            for idx, cut in snapped
+        ]
+        st.caption("Cut points snapped to the nearest keyframe:\n" + "\n".join(lines))
+
+    off_keyframe = [idx for idx, cut in enumerate(cut_points) if not cut.on_keyframe]
+    if off_keyframe:
+        parts = ", ".join(str(idx + 2) for idx in off_keyframe)
+        st.warning(
+            f"No keyframe was found for the cut before part(s) {parts}. Without re-encoding "
+            "these parts start at an earlier keyframe, use the accurate or reencode mode for "
+            "exact cuts."
+        )
+
+
+def save_uploaded_file(
+    uploaded_file, output_dir="temp", chunk_size=UPLOAD_CHUNK_SIZE, max_bytes=MAX_UPLOAD_BYTES
+):
+    """
+    Streams an uploaded file to disk in fixed-size blocks and hashes it on the fly.
+
+    The file is saved as `<sha256><extension>` in `output_dir`, so uploading the same content
+    twice reuses the existing file, and the hash can be used as a cache key for the content.
+    Uploads larger than `max_bytes` are rejected with UploadTooLargeError, before reading
+    anything if the size is known up front.
+
+    Returns the saved path and the hex digest of the content.
+    """
+    size = getattr(uploaded_file, "size", None)
+    if size is not None and size > max_bytes:
+        raise UploadTooLargeError(f"Upload is {size} bytes, the limit is {max_bytes} bytes")
+
+    os.makedirs(output_dir, exist_ok=True)
+    uploaded_file.seek(0)
+
+    content_hash = hashlib.sha256()
+    num_bytes = 0
+    fd, temp_path = tempfile.mkstemp(dir=output_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = uploaded_file.read(chunk_size)
+                if not chunk:
+                    break
+                num_bytes += len(chunk)
+                if num_bytes > max_bytes:
+                    raise UploadTooLargeError(f"Upload exceeds the limit of {max_bytes} bytes")
+                content_hash.update(chunk)
+                f.write(chunk)
+
+        digest = content_hash.hexdigest()
+        extension = os.path.splitext(getattr(uploaded_file, "name", ""))[1].lower()
+        path = os.path.join(output_dir, f"{digest}{extension}")
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return path, digest
+
+
 def archive_files(files):
     """
     Archives a list of files into a zip file with a timestamped name.
+
+    The archive is written to a unique path in the workspace of the session, its
+    basename is the timestamped name to offer for download.
     """
-    zip_name = f'result_{datetime.now().strftime("%d-%m-%Y:%H-%M-%S")}.zip'
+    archive_dir = get_workspace_manager().new_file(prefix='archive_')
+    os.makedirs(archive_dir)
+    zip_name = os.path.join(
+        archive_dir, f'result_{datetime.now().strftime("%d-%m-%Y:%H-%M-%S")}.zip'
+    )
     with ZipFile(zip_name, 'w') as zipf:
         for file in files:
             zipf.write(file, os.path.basename(file))
@@ -1,49 +1,285 @@
+import multiprocessing
 import os
+import shutil
+import tempfile
 import uuid
 
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
 from moviepy.video.io.VideoFileClip import VideoFileClip
 from moviepy.editor import AudioFileClip
+from moviepy.audio.AudioClip import AudioArrayClip
+
+from riffusion.util import video_util
+
+SPLIT_MODES = ["reencode", "copy", "accurate"]
+
+# Directory where split parts and videos with generated audio are saved
+OUTPUT_DIR = "output"
+
+# Codecs used when parts are re-encoded
+VIDEO_CODEC = "libx264"
+AUDIO_CODEC = "aac"
+
+# ffmpeg threads given to each split worker by default_split_workers
+SPLIT_THREADS_PER_WORKER = 4
+
+
+@dataclass(frozen=True)
+class CutPoint:
+    """
+    A boundary between two video parts, as requested and as actually cut.
+
+    `on_keyframe` is False if a stream copy cut could not be placed on a keyframe, in which case
+    the part after it really starts at the keyframe before `actual_s`, wherever that is.
+    """
+
+    requested_s: float
+    actual_s: float
+    on_keyframe: bool = True
+
+    @property
+    def snapped(self):
+        return abs(self.actual_s - self.requested_s) > 1e-3
 
 
-def split_video(input_path, n_parts):
+def split_video(
+    input_path, n_parts, mode="reencode", workers=1, threads_per_worker=None, output_dir=OUTPUT_DIR
+):
     """
-    Splits a video into a specified number of parts and saves each part in the 'output' directory.
+    Splits a video into a specified number of parts and saves each part in `output_dir`.
     Each part is named with a part number and a unique UUID.
 
+    Modes:
+    - "reencode": decodes the input and re-encodes every part with libx264 + aac (frame accurate).
+    - "copy": cuts on the nearest keyframes with ffmpeg stream copy, nothing is decoded or encoded.
+    - "accurate": like "copy", but re-encodes the partial GOP between each requested cut point
+      and the next keyframe, so the cuts are frame accurate.
+
+    With workers > 1 the parts are written in parallel by a pool of worker processes, each with
+    its own reader. Every worker's ffmpeg gets `threads_per_worker` threads, by default the CPU
+    count divided by the number of workers, so the pool doesn't oversubscribe the machine.
+    The parts are returned in the same order as with the sequential path.
+
+    Returns the output directory, the list of part files and the list of inner cut points.
+    In "copy" mode the cut points report where a boundary was snapped to a keyframe.
+
     In the future, this function can be modified to use a unique ID created after authentication
     in the app for each user.
 
     """
+    if mode not in SPLIT_MODES:
+        raise ValueError(f"Unknown split mode {mode}, expected one of {SPLIT_MODES}")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    output_paths = [
+        os.path.join(output_dir, f"part_{i + 1}_{uuid.uuid4()}.mp4") for i in range(n_parts)
+    ]
+
+    workers = max(1, min(workers, n_parts))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    if mode == "reencode" and workers == 1:
+        cut_points = _split_reencode(input_path, n_parts, output_paths, threads_per_worker)
+        return output_dir, output_paths, cut_points
+
+    duration = video_util.duration_s(input_path)
+    keyframes = video_util.keyframe_times(input_path) if mode != "reencode" else None
+    if mode == "copy":
+        cut_points = _snap_to_keyframes(duration, n_parts, keyframes)
+    else:
+        part_duration = duration / n_parts
+        cut_points = [CutPoint(i * part_duration, i * part_duration) for i in range(1, n_parts)]
+
+    boundaries = [0.0] + [cut.actual_s for cut in cut_points] + [duration]
+    jobs = [
+        (mode, input_path, path, boundaries[i], boundaries[i + 1], keyframes, threads_per_worker)
+        for i, path in enumerate(output_paths)
+    ]
+
+    if workers == 1:
+        for job in jobs:
+            _write_part(*job)
+    else:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            # Consume the results so that errors in the workers are raised here
+            list(executor.map(_write_part, *zip(*jobs)))
+
+    return output_dir, output_paths, cut_points
+
+
+def default_split_workers(n_parts):
+    """
+    Number of split worker processes that keeps every core busy with
+    SPLIT_THREADS_PER_WORKER ffmpeg threads each.
+    """
+    return max(1, min(n_parts, (os.cpu_count() or 1) // SPLIT_THREADS_PER_WORKER))
+
+
+def _split_reencode(input_path, n_parts, output_paths, threads):
     video = VideoFileClip(input_path)
     duration = video.duration
     part_duration = duration / n_parts
 
-    output_dir = "output"
-    os.makedirs(output_dir, exist_ok=True)
-
-    generated_files = []
-    for i in range(n_parts):
+    for i, output_path in enumerate(output_paths):
         start_time = i * part_duration
         end_time = (i + 1) * part_duration
-        unique_id = uuid.uuid4()
-        output_path = os.path.join(output_dir, f"part_{i + 1}_{unique_id}.mp4")
 
         subclip = video.subclip(start_time, end_time)
-        subclip.write_videofile(output_path, codec="libx264", audio_codec="aac")
-        generated_files.append(output_path)
+        subclip.write_videofile(
+            output_path, codec=VIDEO_CODEC, audio_codec=AUDIO_CODEC, threads=threads
+        )
+
+    video.close()
+
+    return [CutPoint(i * part_duration, i * part_duration) for i in range(1, n_parts)]
+
+
+def _write_part(mode, input_path, output_path, start_s, end_s, keyframes, threads):
+    """
+    Writes one part of the video. Runs in a worker process for parallel splits, so it opens
+    its own reader instead of sharing one.
+    """
+    if mode == "copy":
+        video_util.cut_stream_copy(input_path, output_path, start_s, end_s)
+    elif mode == "accurate":
+        _cut_accurate(input_path, output_path, start_s, end_s, keyframes, threads)
+    else:
+        with VideoFileClip(input_path) as video:
+            subclip = video.subclip(start_s, min(end_s, video.duration))
+            subclip.write_videofile(
+                output_path,
+                codec=VIDEO_CODEC,
+                audio_codec=AUDIO_CODEC,
+                threads=threads,
+                logger=None,
+            )
+
+
+def _cut_accurate(input_path, output_path, start_s, end_s, keyframes, threads=None):
+    """
+    Stream copies [start_s, end_s) from its first keyframe onwards and re-encodes only the
+    frames before that keyframe, with the codec, profile, pixel format, size and time base of
+    the source. Both pieces keep the same streams, and are probed to check that they match
+    before they are concatenated, since ffmpeg happily concatenates mismatched pieces into a
+    broken file. Falls back to re-encoding the whole part if there is no keyframe inside it,
+    the source can't be probed or encoded to match, or the pieces don't match.
+    """
+    keyframe = video_util.next_keyframe(keyframes, start_s)
+    if keyframe is not None and abs(keyframe - start_s) < 1e-3:
+        video_util.cut_stream_copy(input_path, output_path, start_s, end_s)
+        return
+
+    if keyframe is None or keyframe >= end_s:
+        video_util.cut_reencode(
+            input_path, output_path, start_s, end_s, VIDEO_CODEC, AUDIO_CODEC, threads
+        )
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="split_video_")
+    try:
+        head_path = os.path.join(work_dir, "head.mp4")
+        tail_path = os.path.join(work_dir, "tail.mp4")
+        streams = video_util.probe_streams(input_path)
+        video_util.cut_reencode_matching(
+            input_path, head_path, start_s, keyframe, streams, threads
+        )
+        video_util.cut_stream_copy(
+            input_path, tail_path, keyframe, end_s, maps=video_util.CONCAT_MAPS
+        )
+        head_signature = video_util.concat_signature(head_path)
+        tail_signature = video_util.concat_signature(tail_path)
+        if head_signature != tail_signature:
+            raise ValueError(f"Pieces don't match: {head_signature} != {tail_signature}")
+        video_util.concat_stream_copy(
+            [head_path, tail_path], output_path, os.path.join(work_dir, "parts.txt")
+        )
+    except (RuntimeError, ValueError):
+        video_util.cut_reencode(
+            input_path, output_path, start_s, end_s, VIDEO_CODEC, AUDIO_CODEC, threads
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _snap_to_keyframes(duration, n_parts, keyframes):
+    """
+    Moves each requested cut point to the nearest keyframe, keeping the parts non-empty.
+    A cut point stays where it was requested if no keyframe is available for it, and is
+    reported as not on a keyframe.
+    """
+    part_duration = duration / n_parts
 
-    return output_dir, generated_files
+    cut_points = []
+    previous = 0.0
+    for i in range(1, n_parts):
+        requested = i * part_duration
+        actual = video_util.nearest_keyframe(keyframes, requested)
+        if actual is None or actual <= previous or actual >= duration:
+            actual = video_util.next_keyframe(keyframes, previous + 1e-3)
+        if actual is None or actual >= duration:
+            cut_points.append(CutPoint(requested, requested, on_keyframe=False))
+            previous = requested
+            continue
+        cut_points.append(CutPoint(requested, actual))
+        previous = actual
 
+    return cut_points
 
-def add_audio_to_video(video_path, audio_path, output_path):
+
+def add_audio_to_video(
+    video_path,
+    audio,
+    output_path,
+    reencode_video=False,
+    audio_codec=AUDIO_CODEC,
+    sample_rate=None,
+):
     """
     Function adds generating audio to chosen part video by user.
+
+    `audio` is either the path of an audio file, or a (channels, samples) float waveform with
+    its `sample_rate`, which is piped to ffmpeg straight from memory.
+
+    By default the video track is stream copied and only the audio is encoded with
+    `audio_codec` ("copy" keeps an audio file stream as is, and is rejected for a waveform, which
+    always has to be encoded), and the generated audio is trimmed to the video duration at the
+    container level. This takes well under a second and avoids generation loss in the video.
+    Set `reencode_video` to re-encode the video with libx264.
     """
+    is_waveform = isinstance(audio, np.ndarray)
+    if is_waveform and sample_rate is None:
+        raise ValueError("sample_rate is required when audio is a waveform")
+    if is_waveform and audio_codec == "copy":
+        raise ValueError("audio_codec can't be 'copy' when audio is a waveform")
+
+    if not reencode_video:
+        video_duration = video_util.duration_s(video_path)
+        if is_waveform:
+            video_util.replace_audio_pcm(
+                video_path, audio, sample_rate, output_path,
+                duration_s=video_duration, audio_codec=audio_codec
+            )
+        else:
+            video_util.replace_audio(
+                video_path, audio, output_path, duration_s=video_duration, audio_codec=audio_codec
+            )
+        return
+
     video = VideoFileClip(video_path)
-    audio = AudioFileClip(audio_path)
+    if is_waveform:
+        audio_clip = AudioArrayClip(np.atleast_2d(audio).T, fps=sample_rate)
+    else:
+        audio_clip = AudioFileClip(audio)
 
-    if audio.duration > video.duration:
-        audio = audio.subclip(0, video.duration)
+    if audio_clip.duration > video.duration:
+        audio_clip = audio_clip.subclip(0, video.duration)
 
-    new_video = video.set_audio(audio)
-    new_video.write_videofile(output_path, codec="libx264", audio_codec="aac")
+    new_video = video.set_audio(audio_clip)
+    new_video.write_videofile(output_path, codec=VIDEO_CODEC, audio_codec=audio_codec)
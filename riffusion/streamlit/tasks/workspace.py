@@ -0,0 +1,237 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from riffusion.streamlit.tasks.video_processing import OUTPUT_DIR
+from riffusion.streamlit.util import is_session_active
+
+# Scratch space goes on tmpfs when it has at least this much free space
+TMPFS_ROOT = "/dev/shm"
+TMPFS_MIN_FREE_BYTES = 1024 * 1024 * 1024
+
+# Workspaces untouched for this long are deleted
+WORKSPACE_MAX_AGE_S = 6 * 60 * 60
+
+# Total size of all workspaces before the least recently used ones are deleted
+WORKSPACE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# Workspaces may take at most this fraction of the space left on their file system, which
+# is RAM for tmpfs
+WORKSPACE_MAX_FREE_FRACTION = 0.5
+
+# Workspaces used more recently than this are never deleted to make room, only once old
+WORKSPACE_MIN_IDLE_S = 15 * 60
+
+# Garbage collection runs at most this often
+WORKSPACE_GC_INTERVAL_S = 60
+
+# Workspace name for code running outside of a Streamlit session
+DEFAULT_SESSION = "default"
+
+# Per-session outputs that are offered to the user, split parts and the videos made from them.
+# Kept on the disk of the split cache so that parts can be hardlinked out of it.
+OUTPUT_WORKSPACE_ROOT = os.path.join(OUTPUT_DIR, "sessions")
+OUTPUT_WORKSPACE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+
+
+def default_scratch_root():
+    """
+    Returns the directory workspaces are created in, on tmpfs when it is available.
+    """
+    base = tempfile.gettempdir()
+    if os.path.isdir(TMPFS_ROOT) and os.access(TMPFS_ROOT, os.W_OK):
+        if shutil.disk_usage(TMPFS_ROOT).free >= TMPFS_MIN_FREE_BYTES:
+            base = TMPFS_ROOT
+    return os.path.join(base, "riffusion-workspaces")
+
+
+class WorkspaceManager:
+    """
+    Gives every session its own scratch directory for intermediate files.
+
+    Files that used to be shared, like the generated audio and the result archive, are created
+    inside the workspace of the session with unique names, so concurrent sessions and requests
+    never write to the same path. Workspaces are deleted once unused for max_age_s, and the
+    least recently used ones idle for at least min_idle_s when they take more than max_bytes
+    together. The limit shrinks to max_free_fraction of the space left on the file system of
+    the root, so workspaces on tmpfs can't use up the memory.
+
+    A workspace was last used when anything in it was last written, or when the session last
+    called workspace(), which the apps do on every run, see touch_session_workspaces. The
+    workspaces of sessions that are still connected are never deleted.
+    """
+
+    def __init__(
+        self,
+        root=None,
+        max_age_s=WORKSPACE_MAX_AGE_S,
+        max_bytes=WORKSPACE_MAX_BYTES,
+        gc_interval_s=WORKSPACE_GC_INTERVAL_S,
+        min_idle_s=WORKSPACE_MIN_IDLE_S,
+        max_free_fraction=WORKSPACE_MAX_FREE_FRACTION,
+        is_session_active=None,
+    ):
+        self.root = root or default_scratch_root()
+        self.max_age_s = max_age_s
+        self.max_bytes = max_bytes
+        self.gc_interval_s = gc_interval_s
+        self.min_idle_s = min_idle_s
+        self.max_free_fraction = max_free_fraction
+        self.is_session_active = is_session_active
+        self._lock = threading.Lock()
+        self._last_gc = 0.0
+        os.makedirs(self.root, exist_ok=True)
+
+    def workspace(self, session_id=None):
+        """
+        Returns the scratch directory of a session, creating it if needed.
+        """
+        session_id = session_id or current_session_id()
+        path = os.path.join(self.root, session_id)
+        os.makedirs(path, exist_ok=True)
+
+        # The directory mtime is the last access time used for garbage collection
+        os.utime(path)
+
+        self.maybe_gc(keep=session_id)
+        return path
+
+    def new_file(self, suffix="", prefix="", session_id=None):
+        """
+        Returns a fresh path with the given suffix in the scratch directory of a session.
+        """
+        return os.path.join(self.workspace(session_id), f"{prefix}{uuid.uuid4().hex}{suffix}")
+
+    def maybe_gc(self, keep=None):
+        """
+        Runs garbage collection unless it ran less than gc_interval_s ago.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_gc < self.gc_interval_s:
+                return
+            self._last_gc = now
+        self.gc(keep=keep)
+
+    def entries(self):
+        """
+        Returns (last access time, size in bytes, directory) for every workspace. The last
+        access time is the latest mtime of the workspace or anything in it.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                last_access = os.path.getmtime(path)
+                num_bytes = 0
+                for dirpath, dirnames, filenames in os.walk(path):
+                    for dirname in dirnames:
+                        last_access = max(
+                            last_access, os.path.getmtime(os.path.join(dirpath, dirname))
+                        )
+                    for filename in filenames:
+                        stat = os.stat(os.path.join(dirpath, filename))
+                        last_access = max(last_access, stat.st_mtime)
+                        num_bytes += stat.st_size
+            except OSError:
+                continue
+            entries.append((last_access, num_bytes, path))
+        return entries
+
+    def effective_max_bytes(self, total_bytes=None):
+        """
+        Returns max_bytes, capped to max_free_fraction of the space the workspaces have on
+        their file system, i.e. the free space plus what they already take.
+        """
+        if total_bytes is None:
+            total_bytes = sum(num_bytes for _, num_bytes, _ in self.entries())
+        try:
+            free = shutil.disk_usage(self.root).free
+        except OSError:
+            return self.max_bytes
+        return min(self.max_bytes, int(self.max_free_fraction * (free + total_bytes)))
+
+    def gc(self, keep=None):
+        """
+        Deletes workspaces older than max_age_s, then the least recently used ones idle for at
+        least min_idle_s until all of them fit in effective_max_bytes. Workspaces in use are
+        never deleted to make room, nor is the workspace of the session `keep` or of any
+        session that is still connected.
+        """
+        entries = sorted(self.entries())
+        total = sum(num_bytes for _, num_bytes, _ in entries)
+        max_bytes = self.effective_max_bytes(total)
+        now = time.time()
+        for last_access, num_bytes, path in entries:
+            session_id = os.path.basename(path)
+            if keep is not None and session_id == keep:
+                continue
+            if self.is_session_active is not None and self.is_session_active(session_id):
+                continue
+            expired = last_access < now - self.max_age_s
+            idle = last_access < now - self.min_idle_s
+            if not expired and not (idle and total > max_bytes):
+                # Entries are sorted by last access, all the following ones are newer
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= num_bytes
+
+    def remove(self, session_id):
+        """
+        Deletes the scratch directory of a session.
+        """
+        shutil.rmtree(os.path.join(self.root, session_id), ignore_errors=True)
+
+    def stats(self):
+        entries = self.entries()
+        total = sum(num_bytes for _, num_bytes, _ in entries)
+        return dict(
+            root=self.root,
+            num_workspaces=len(entries),
+            total_bytes=total,
+            max_bytes=self.effective_max_bytes(total),
+        )
+
+
+def current_session_id():
+    """
+    Returns the id of the Streamlit session running the current script.
+    """
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else DEFAULT_SESSION
+
+
+@st.cache_resource
+def get_workspace_manager():
+    """
+    Singleton workspace manager shared by all sessions of this process.
+    """
+    return WorkspaceManager(is_session_active=is_session_active)
+
+
+@st.cache_resource
+def get_output_workspace_manager():
+    """
+    Singleton manager of the per-session output directories, see OUTPUT_WORKSPACE_ROOT.
+    """
+    return WorkspaceManager(
+        root=OUTPUT_WORKSPACE_ROOT,
+        max_bytes=OUTPUT_WORKSPACE_MAX_BYTES,
+        is_session_active=is_session_active,
+    )
+
+
+def touch_session_workspaces():
+    """
+    Marks the scratch and output workspaces of the current session as used. Called on every
+    run of the apps, since a run may read files written long ago, like the split parts or the
+    archive offered for download.
+    """
+    get_workspace_manager().workspace()
+    get_output_workspace_manager().workspace()
@@ -1,7 +1,9 @@
 """
 Streamlit utilities (mostly cached wrappers around riffusion code).
 """
+import dataclasses
 import io
+import itertools
 import threading
 import typing as T
 
@@ -10,10 +12,15 @@ import streamlit as st
 import torch
 from diffusers import DiffusionPipeline, StableDiffusionImg2ImgPipeline, StableDiffusionPipeline
 from PIL import Image
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 from riffusion.audio_splitter import AudioSplitter
+from riffusion.embedding_cache import EmbeddingCache
+from riffusion.inference_scheduler import InferenceScheduler
+from riffusion.model_registry import ModelKey, ModelRegistry, default_memory_budget
 from riffusion.riffusion_pipeline import RiffusionPipeline
-from riffusion.spectrogram_image_converter import SpectrogramImageConverter
+from riffusion.spectrogram_image_converter import SpectrogramImageConverter, get_converter
 from riffusion.spectrogram_params import SpectrogramParams
 
 # TODO(hayk): Add URL params
@@ -32,8 +39,28 @@ SCHEDULER_OPTIONS = [
     "EulerAncestralDiscreteScheduler",
 ]
 
+# Schedulers that draw fresh noise at every denoising step. That noise comes from one generator
+# per pipeline call, so samples denoised in the same call would depend on each other.
+STOCHASTIC_SCHEDULERS = ["EulerAncestralDiscreteScheduler"]
+
 
 @st.cache_resource
+def model_registry() -> ModelRegistry:
+    """
+    Singleton registry holding every loaded model pipeline for this process, evicting the least
+    recently used ones beyond the memory budget, see default_memory_budget.
+    """
+    return ModelRegistry(max_bytes=default_memory_budget())
+
+
+@st.cache_resource
+def embedding_cache() -> EmbeddingCache:
+    """
+    Singleton cache of text embeddings shared by every riffusion pipeline of this process.
+    """
+    return EmbeddingCache()
+
+
 def load_riffusion_checkpoint(
     checkpoint: str = DEFAULT_CHECKPOINT,
     no_traced_unet: bool = False,
@@ -42,14 +69,27 @@ def load_riffusion_checkpoint(
     """
     Load the riffusion pipeline.
     """
-    return RiffusionPipeline.load_checkpoint(
+    key = ModelKey(
         checkpoint=checkpoint,
-        use_traced_unet=not no_traced_unet,
         device=device,
+        dtype=torch.float16,
+        scheduler="default",
+        pipeline_type="riffusion" if no_traced_unet else "riffusion_traced",
     )
+    return model_registry().get(key, _load_riffusion_checkpoint)
+
+
+def _load_riffusion_checkpoint(key: ModelKey) -> RiffusionPipeline:
+    pipeline = RiffusionPipeline.load_checkpoint(
+        checkpoint=key.checkpoint,
+        use_traced_unet=key.pipeline_type == "riffusion_traced",
+        dtype=key.dtype,
+        device=key.device,
+    )
+    pipeline.embedding_cache = embedding_cache()
+    return pipeline
 
 
-@st.cache_resource
 def load_stable_diffusion_pipeline(
     checkpoint: str = DEFAULT_CHECKPOINT,
     device: str = "cuda",
@@ -61,22 +101,89 @@ def load_stable_diffusion_pipeline(
 
     TODO(hayk): Merge this into RiffusionPipeline to just load one model.
     """
-    if device == "cpu" or device.lower().startswith("mps"):
-        print(f"WARNING: Falling back to float32 on {device}, float16 is unsupported")
-        dtype = torch.float32
+    key = ModelKey(
+        checkpoint=checkpoint,
+        device=device,
+        dtype=dtype,
+        scheduler=scheduler,
+        pipeline_type="txt2img",
+    )
+    return model_registry().get(key, _load_stable_diffusion_pipeline)
+
+
+def _load_stable_diffusion_pipeline(key: ModelKey) -> StableDiffusionPipeline:
+    if key.dtype == torch.float32 and not key.device.lower().startswith("cuda"):
+        print(f"WARNING: Falling back to float32 on {key.device}, float16 is unsupported")
 
     pipeline = StableDiffusionPipeline.from_pretrained(
-        checkpoint,
+        key.checkpoint,
         revision="main",
-        torch_dtype=dtype,
+        torch_dtype=key.dtype,
         safety_checker=lambda images, **kwargs: (images, False),
-    ).to(device)
+    ).to(key.device)
+
+    pipeline.scheduler = get_scheduler(key.scheduler, config=pipeline.scheduler.config)
+
+    return pipeline
+
+
+def load_riffusion_pipeline_shared(
+    checkpoint: str = DEFAULT_CHECKPOINT,
+    device: str = "cuda",
+    dtype: torch.dtype = torch.float16,
+    scheduler: str = SCHEDULER_OPTIONS[0],
+) -> RiffusionPipeline:
+    """
+    Build a riffusion pipeline on top of the modules of the text to image pipeline, so
+    riffuse() is available without loading a second copy of the weights. The registry counts
+    the weights once, under the text to image pipeline.
+    """
+    key = ModelKey(
+        checkpoint=checkpoint,
+        device=device,
+        dtype=dtype,
+        scheduler=scheduler,
+        pipeline_type="riffusion_shared",
+    )
+    shares = dataclasses.replace(key, pipeline_type="txt2img")
+    return model_registry().get(key, _load_riffusion_pipeline_shared, shares=shares)
+
 
-    pipeline.scheduler = get_scheduler(scheduler, config=pipeline.scheduler.config)
+def _load_riffusion_pipeline_shared(key: ModelKey) -> RiffusionPipeline:
+    txt2img = load_stable_diffusion_pipeline(
+        checkpoint=key.checkpoint,
+        device=key.device,
+        dtype=key.dtype,
+        scheduler=key.scheduler,
+    )
 
+    pipeline = RiffusionPipeline(
+        vae=txt2img.vae,
+        text_encoder=txt2img.text_encoder,
+        tokenizer=txt2img.tokenizer,
+        unet=txt2img.unet,
+        # Schedulers hold state while denoising, so don't share that one
+        scheduler=get_scheduler(key.scheduler, config=txt2img.scheduler.config),
+        safety_checker=txt2img.safety_checker,
+        feature_extractor=txt2img.feature_extractor,
+    )
+    pipeline.embedding_cache = embedding_cache()
     return pipeline
 
 
+@st.cache_resource(show_spinner="Loading the audio generation model...")
+def warmup_models(
+    checkpoint: str = DEFAULT_CHECKPOINT,
+    device: str = "cuda",
+    scheduler: str = SCHEDULER_OPTIONS[0],
+) -> ModelRegistry:
+    """
+    Load the text to image pipeline once per process, ahead of the first request.
+    """
+    load_stable_diffusion_pipeline(checkpoint=checkpoint, device=device, scheduler=scheduler)
+    return model_registry()
+
+
 def get_scheduler(scheduler: str, config: T.Any) -> T.Any:
     """
     Construct a denoising scheduler from a string.
@@ -117,7 +224,6 @@ def pipeline_lock() -> threading.Lock:
     return threading.Lock()
 
 
-@st.cache_resource
 def load_stable_diffusion_img2img_pipeline(
     checkpoint: str = DEFAULT_CHECKPOINT,
     device: str = "cuda",
@@ -129,23 +235,33 @@ def load_stable_diffusion_img2img_pipeline(
 
     TODO(hayk): Merge this into RiffusionPipeline to just load one model.
     """
-    if device == "cpu" or device.lower().startswith("mps"):
-        print(f"WARNING: Falling back to float32 on {device}, float16 is unsupported")
-        dtype = torch.float32
+    key = ModelKey(
+        checkpoint=checkpoint,
+        device=device,
+        dtype=dtype,
+        scheduler=scheduler,
+        pipeline_type="img2img",
+    )
+    return model_registry().get(key, _load_stable_diffusion_img2img_pipeline)
+
+
+def _load_stable_diffusion_img2img_pipeline(key: ModelKey) -> StableDiffusionImg2ImgPipeline:
+    if key.dtype == torch.float32 and not key.device.lower().startswith("cuda"):
+        print(f"WARNING: Falling back to float32 on {key.device}, float16 is unsupported")
 
     pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
-        checkpoint,
+        key.checkpoint,
         revision="main",
-        torch_dtype=dtype,
+        torch_dtype=key.dtype,
         safety_checker=lambda images, **kwargs: (images, False),
-    ).to(device)
+    ).to(key.device)
 
-    pipeline.scheduler = get_scheduler(scheduler, config=pipeline.scheduler.config)
+    pipeline.scheduler = get_scheduler(key.scheduler, config=pipeline.scheduler.config)
 
     return pipeline
 
 
-@st.cache_data(persist=True)
+@st.cache_data(max_entries=32)
 def run_txt2img(
     prompt: str,
     num_inference_steps: int,
@@ -160,7 +276,122 @@ def run_txt2img(
 ) -> Image.Image:
     """
     Run the text to image pipeline with caching.
+
+    The cache only holds recent images in memory, finished generations are persisted by the
+    generation cache of the model processing task.
+
+    The call is queued on the shared txt2img scheduler, which may batch it with compatible
+    requests from other sessions of the same size. Requests with a scheduler in
+    STOCHASTIC_SCHEDULERS are never batched, so the result only depends on the request and
+    can be cached.
+
+    Raises:
+        QueueFullError: If the scheduler has too many pending requests
     """
+    job = Txt2ImgJob(
+        prompt=prompt,
+        seed=seed,
+        width=width,
+        negative_prompt=negative_prompt,
+        height=height,
+    )
+    batch_key: T.Tuple = (
+        num_inference_steps, guidance, checkpoint, device, scheduler, width, height
+    )
+    if scheduler in STOCHASTIC_SCHEDULERS:
+        # A key no other request has
+        batch_key += (object(),)
+    return txt2img_scheduler().run(batch_key, job, session_id=current_session_id())
+
+
+def current_session_id() -> T.Optional[str]:
+    """
+    Id of the Streamlit session running the current script, if any.
+    """
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+def is_session_active(session_id: str) -> bool:
+    """
+    Whether the Streamlit session with the given id is still connected.
+    """
+    return runtime.exists() and runtime.get_instance().is_active_session(session_id)
+
+
+@st.cache_resource
+def txt2img_scheduler() -> InferenceScheduler:
+    """
+    Singleton queue for txt2img requests from all sessions of this process.
+    """
+    max_batch_size = 4
+
+    def run_batch(batch_key: T.Tuple, jobs: T.List[Txt2ImgJob]) -> T.List[Image.Image]:
+        num_inference_steps, guidance, checkpoint, device, scheduler = batch_key[:5]
+        return run_txt2img_batch(
+            jobs,
+            num_inference_steps=num_inference_steps,
+            guidance=guidance,
+            checkpoint=checkpoint,
+            device=device,
+            scheduler=scheduler,
+            max_batch_size=max_batch_size,
+        )
+
+    return InferenceScheduler(
+        run_batch=run_batch,
+        max_batch_size=max_batch_size,
+        is_session_active=is_session_active,
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class Txt2ImgJob:
+    """
+    One image to generate with run_txt2img_batch.
+    """
+
+    prompt: str
+    seed: int
+    width: int
+    negative_prompt: str = ""
+    height: int = 512
+
+
+def run_txt2img_batch(
+    jobs: T.Sequence[Txt2ImgJob],
+    num_inference_steps: int,
+    guidance: float,
+    checkpoint: str = DEFAULT_CHECKPOINT,
+    device: str = "cuda",
+    scheduler: str = SCHEDULER_OPTIONS[0],
+    max_batch_size: int = 4,
+) -> T.List[Image.Image]:
+    """
+    Run the text to image pipeline for many jobs, batching jobs of the same size together.
+
+    Jobs with the same width and height are denoised in a single batched call of up to
+    `max_batch_size` samples, every sample starting from the latents its own seed produces.
+    With a scheduler in STOCHASTIC_SCHEDULERS, which also draws noise at every step, each job
+    runs in a call of its own with a generator seeded from its seed instead. Either way the
+    image of a job only depends on the job, not on the jobs it runs with. Returns the images
+    in the order of the jobs.
+    """
+    images: T.List[T.Optional[Image.Image]] = [None] * len(jobs)
+
+    def size(index: int) -> T.Tuple[int, int]:
+        return jobs[index].width, jobs[index].height
+
+    if scheduler in STOCHASTIC_SCHEDULERS:
+        max_batch_size = 1
+
+    order = sorted(range(len(jobs)), key=size)
+    batches = []
+    for _, group in itertools.groupby(order, key=size):
+        group = list(group)
+        for i in range(0, len(group), max_batch_size):
+            batches.append(group[i : i + max_batch_size])
+
     with pipeline_lock():
         pipeline = load_stable_diffusion_pipeline(
             checkpoint=checkpoint,
@@ -169,26 +400,61 @@ def run_txt2img(
         )
 
         generator_device = "cpu" if device.lower().startswith("mps") else device
-        generator = torch.Generator(device=generator_device).manual_seed(seed)
 
-        output = pipeline(
-            prompt=prompt,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance,
-            negative_prompt=negative_prompt or None,
-            generator=generator,
-            width=width,
-            height=height,
-        )
-        return output["images"][0]
+        for batch in batches:
+            width, height = size(batch[0])
+
+            if scheduler in STOCHASTIC_SCHEDULERS:
+                # The pipeline draws the latents and then the step noise from the job's seed
+                job = jobs[batch[0]]
+                output = pipeline(
+                    prompt=job.prompt,
+                    num_inference_steps=num_inference_steps,
+                    guidance_scale=guidance,
+                    negative_prompt=job.negative_prompt or None,
+                    generator=torch.Generator(device=generator_device).manual_seed(job.seed),
+                    width=width,
+                    height=height,
+                )
+                images[batch[0]] = output["images"][0]
+                continue
+
+            # Per-sample noise, drawn exactly like the pipeline does for a single seed
+            latents = torch.cat(
+                [
+                    torch.randn(
+                        (1, pipeline.unet.in_channels, height // 8, width // 8),
+                        generator=torch.Generator(device=generator_device).manual_seed(
+                            jobs[index].seed
+                        ),
+                        device=generator_device,
+                        dtype=pipeline.text_encoder.dtype,
+                    )
+                    for index in batch
+                ]
+            )
+
+            output = pipeline(
+                prompt=[jobs[index].prompt for index in batch],
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance,
+                negative_prompt=[jobs[index].negative_prompt or "" for index in batch],
+                latents=latents,
+                width=width,
+                height=height,
+            )
+
+            for index, image in zip(batch, output["images"]):
+                images[index] = image
+
+    return T.cast(T.List[Image.Image], images)
 
 
-@st.cache_resource
 def spectrogram_image_converter(
     params: SpectrogramParams,
     device: str = "cuda",
 ) -> SpectrogramImageConverter:
-    return SpectrogramImageConverter(params=params, device=device)
+    return get_converter(params=params, device=device)
 
 
 @st.cache_data
@@ -297,18 +563,28 @@ def get_audio_splitter(device: str = "cuda"):
     return AudioSplitter(device=device)
 
 
-@st.cache_resource
 def load_magic_mix_pipeline(
     checkpoint: str = DEFAULT_CHECKPOINT,
     device: str = "cuda",
     scheduler: str = SCHEDULER_OPTIONS[0],
 ):
+    key = ModelKey(
+        checkpoint=checkpoint,
+        device=device,
+        dtype=torch.float32,
+        scheduler=scheduler,
+        pipeline_type="magic_mix",
+    )
+    return model_registry().get(key, _load_magic_mix_pipeline)
+
+
+def _load_magic_mix_pipeline(key: ModelKey):
     pipeline = DiffusionPipeline.from_pretrained(
-        checkpoint,
+        key.checkpoint,
         custom_pipeline="magic_mix",
-    ).to(device)
+    ).to(key.device)
 
-    pipeline.scheduler = get_scheduler(scheduler, pipeline.scheduler.config)
+    pipeline.scheduler = get_scheduler(key.scheduler, pipeline.scheduler.config)
 
     return pipeline
 
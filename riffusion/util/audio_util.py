@@ -2,12 +2,12 @@
 Audio utility functions.
 """
 
-import io
 import typing as T
 
 import numpy as np
 import pydub
-from scipy.io import wavfile
+
+from riffusion.util import waveform_util
 
 
 def audio_from_waveform(
@@ -27,49 +27,69 @@ def audio_from_waveform(
     samples = samples.transpose(1, 0)
     samples = samples.astype(np.int16)
 
-    # Write to the bytes of a WAV file
-    wav_bytes = io.BytesIO()
-    wavfile.write(wav_bytes, sample_rate, samples)
-    wav_bytes.seek(0)
-
-    # Read into pydub
-    return pydub.AudioSegment.from_wav(wav_bytes)
+    # Wrap the interleaved samples, without encoding and parsing a WAV file
+    return pydub.AudioSegment(
+        data=samples.tobytes(),
+        sample_width=2,
+        frame_rate=sample_rate,
+        channels=samples.shape[1],
+    )
 
 
 def apply_filters(segment: pydub.AudioSegment, compression: bool = False) -> pydub.AudioSegment:
     """
     Apply post-processing filters to the audio segment to compress it and
     keep at a -10 dBFS level.
+
+    The filters run on a float waveform, see waveform_util.apply_filters.
     """
     # TODO(hayk): Come up with a principled strategy for these filters and experiment end-to-end.
     # TODO(hayk): Is this going to make audio unbalanced between sequential clips?
+    samples = waveform_util.from_segment(segment)
+    samples = waveform_util.apply_filters(samples, segment.frame_rate, compression=compression)
+    return waveform_util.to_segment(samples, segment.frame_rate, sample_width=segment.sample_width)
 
-    if compression:
-        segment = pydub.effects.normalize(
-            segment,
-            headroom=0.1,
-        )
-
-        segment = segment.apply_gain(-10 - segment.dBFS)
-
-        # TODO(hayk): This is quite slow, ~1.7 seconds on a beefy CPU
-        segment = pydub.effects.compress_dynamic_range(
-            segment,
-            threshold=-20.0,
-            ratio=4.0,
-            attack=5.0,
-            release=50.0,
-        )
-
-    desired_db = -12
-    segment = segment.apply_gain(desired_db - segment.dBFS)
-
-    segment = pydub.effects.normalize(
-        segment,
-        headroom=0.1,
-    )
 
-    return segment
+def filter_waveform(samples: np.ndarray, compression: bool = False, sample_rate: int = 44100):
+    """
+    Float equivalent of apply_filters, for audio kept as a waveform.
+
+    Peak normalizes first, as audio_from_waveform does before filtering. The sample rate only
+    matters with compression.
+
+    Args:
+        samples: (channels, samples) float array
+
+    Returns:
+        samples: (channels, samples) float32 array in [-1, 1]
+    """
+    samples = np.array(samples, dtype=np.float32)
+    waveform_util.normalize(samples, headroom_db=0.0)
+    return waveform_util.apply_filters(samples, sample_rate, compression=compression)
+
+
+def waveform_from_audio(segment: pydub.AudioSegment) -> np.ndarray:
+    """
+    Convert an audio segment to a float waveform in [-1, 1].
+
+    Returns:
+        samples: (channels, samples) float32 array
+    """
+    return waveform_util.from_segment(segment)
+
+
+def _match_formats(segments: T.Sequence[pydub.AudioSegment]) -> T.List[pydub.AudioSegment]:
+    """
+    Bring all segments to the highest frame rate, channel count and sample width among them,
+    like pydub does when combining segments, so nothing is downmixed or downsampled.
+    """
+    frame_rate = max(s.frame_rate for s in segments)
+    channels = max(s.channels for s in segments)
+    sample_width = max(s.sample_width for s in segments)
+    return [
+        s.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width)
+        for s in segments
+    ]
 
 
 def stitch_segments(
@@ -77,23 +97,26 @@ def stitch_segments(
 ) -> pydub.AudioSegment:
     """
     Stitch together a sequence of audio segments with a crossfade between each segment.
+
+    Runs in time linear in the total length, see waveform_util.stitch.
     """
-    crossfade_ms = int(crossfade_s * 1000)
-    combined_segment = segments[0]
-    for segment in segments[1:]:
-        combined_segment = combined_segment.append(segment, crossfade=crossfade_ms)
-    return combined_segment
+    segments = _match_formats(segments)
+    first = segments[0]
+    crossfade_samples = int(first.frame_count(ms=int(crossfade_s * 1000)))
+    samples = waveform_util.stitch(
+        [waveform_util.from_segment(s) for s in segments], crossfade_samples
+    )
+    return waveform_util.to_segment(samples, first.frame_rate, sample_width=first.sample_width)
 
 
 def overlay_segments(segments: T.Sequence[pydub.AudioSegment]) -> pydub.AudioSegment:
     """
     Overlay a sequence of audio segments on top of each other.
+
+    All segments are mixed in one pass, see waveform_util.overlay.
     """
     assert len(segments) > 0
-    output: pydub.AudioSegment = None
-    for segment in segments:
-        if output is None:
-            output = segment
-        else:
-            output = output.overlay(segment)
-    return output
+    segments = _match_formats(segments)
+    first = segments[0]
+    samples = waveform_util.overlay([waveform_util.from_segment(s) for s in segments])
+    return waveform_util.to_segment(samples, first.frame_rate, sample_width=first.sample_width)
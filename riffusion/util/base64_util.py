@@ -4,6 +4,15 @@ import io
 
 def encode(buffer: io.BytesIO) -> str:
     """
-    Encode the given buffer as base64.
+    Encode the given buffer as base64, without line breaks.
     """
-    return base64.encodebytes(buffer.getvalue()).decode("ascii")
+    return base64.b64encode(buffer.getbuffer()).decode("ascii")
+
+
+def decode(data: str) -> io.BytesIO:
+    """
+    Decode base64 data, optionally given as a data URL, into a buffer.
+    """
+    if data.startswith("data:"):
+        data = data.split(",", 1)[1]
+    return io.BytesIO(base64.b64decode(data))
@@ -0,0 +1,111 @@
+"""
+Length-prefixed binary framing, used to send raw image and audio bytes without base64.
+
+A message is a magic header followed by any number of frames. Every frame carries a name, a
+content type and a payload, each prefixed with its length:
+
+    magic (4 bytes) | version (u8) | num frames (u16)
+    name length (u16) | name | content type length (u16) | content type |
+    payload length (u64) | payload
+    ...
+
+All integers are big endian.
+"""
+from __future__ import annotations
+
+import dataclasses
+import struct
+import typing as T
+
+# Media type of a framed message, for HTTP content negotiation
+CONTENT_TYPE = "application/x-riffusion-frames"
+
+MAGIC = b"RFRM"
+VERSION = 1
+
+_HEADER = struct.Struct(">4sBH")
+_SHORT_LENGTH = struct.Struct(">H")
+_LONG_LENGTH = struct.Struct(">Q")
+
+
+@dataclasses.dataclass(frozen=True)
+class Frame:
+    """
+    One named payload of a framed message.
+    """
+
+    name: str
+    content_type: str
+    data: bytes
+
+
+def encode_frames(frames: T.Sequence[Frame]) -> bytes:
+    """
+    Serialize frames into one message.
+    """
+    parts = [_HEADER.pack(MAGIC, VERSION, len(frames))]
+    for frame in frames:
+        name = frame.name.encode("utf-8")
+        content_type = frame.content_type.encode("utf-8")
+        parts.extend(
+            [
+                _SHORT_LENGTH.pack(len(name)),
+                name,
+                _SHORT_LENGTH.pack(len(content_type)),
+                content_type,
+                _LONG_LENGTH.pack(len(frame.data)),
+                frame.data,
+            ]
+        )
+    return b"".join(parts)
+
+
+def decode_frames(data: T.Union[bytes, memoryview]) -> T.List[Frame]:
+    """
+    Parse a message produced by encode_frames.
+
+    Raises:
+        ValueError: If the data is not a well formed message
+    """
+    view = memoryview(data)
+
+    if len(view) < _HEADER.size:
+        raise ValueError("Truncated frame header")
+    magic, version, num_frames = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError(f"Not a framed message, magic is {bytes(magic)!r}")
+    if version != VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+
+    offset = _HEADER.size
+
+    def read(length_struct: struct.Struct) -> memoryview:
+        nonlocal offset
+        if offset + length_struct.size > len(view):
+            raise ValueError("Truncated frame")
+        (length,) = length_struct.unpack_from(view, offset)
+        offset += length_struct.size
+        if offset + length > len(view):
+            raise ValueError("Truncated frame")
+        chunk = view[offset : offset + length]
+        offset += length
+        return chunk
+
+    frames = []
+    for _ in range(num_frames):
+        name = bytes(read(_SHORT_LENGTH)).decode("utf-8")
+        content_type = bytes(read(_SHORT_LENGTH)).decode("utf-8")
+        payload = bytes(read(_LONG_LENGTH))
+        frames.append(Frame(name=name, content_type=content_type, data=payload))
+
+    if offset != len(view):
+        raise ValueError(f"{len(view) - offset} trailing bytes after the last frame")
+
+    return frames
+
+
+def frames_by_name(frames: T.Iterable[Frame]) -> T.Dict[str, Frame]:
+    """
+    Index frames by their name.
+    """
+    return {frame.name: frame for frame in frames}
@@ -2,6 +2,7 @@
 Module for converting between spectrograms tensors and spectrogram images, as well as
 general helpers for operating on pillow images.
 """
+import functools
 import typing as T
 
 import numpy as np
@@ -24,36 +25,54 @@ def image_from_spectrogram(spectrogram: np.ndarray, power: float = 0.25) -> Imag
     Returns:
         image: (frequency, time, channels)
     """
-    # Rescale to 0-1
+    num_channels, height, width = spectrogram.shape
+    if num_channels not in (1, 2):
+        raise NotImplementedError(f"Unsupported number of channels: {num_channels}")
+
+    # Rescale to 0-1. This is the only float temporary, the rest is done in place.
     max_value = np.max(spectrogram)
-    data = spectrogram / max_value
+    data = np.divide(spectrogram, max_value)
 
     # Apply the power curve
-    data = np.power(data, power)
+    np.power(data, power, out=data)
 
     # Rescale to 0-255
-    data = data * 255
+    np.multiply(data, 255, out=data)
 
     # Invert
-    data = 255 - data
-
-    # Convert to uint8
-    data = data.astype(np.uint8)
+    np.subtract(255, data, out=data)
 
-    # Munge channels into a PIL image
-    if data.shape[0] == 1:
+    # Convert to uint8 straight into the pixel buffer, writing rows through a reversed view to
+    # flip Y. Mono is written to all of RGB like a grayscale image, stereo goes into G and B.
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    flipped = pixels[::-1]
+    if num_channels == 1:
         # TODO(hayk): Do we want to write single channel to disk instead?
-        image = Image.fromarray(data[0], mode="L").convert("RGB")
-    elif data.shape[0] == 2:
-        data = np.array([np.zeros_like(data[0]), data[0], data[1]]).transpose(1, 2, 0)
-        image = Image.fromarray(data, mode="RGB")
+        np.copyto(flipped[:, :, 0], data[0], casting="unsafe")
+        pixels[:, :, 1] = pixels[:, :, 0]
+        pixels[:, :, 2] = pixels[:, :, 0]
     else:
-        raise NotImplementedError(f"Unsupported number of channels: {data.shape[0]}")
+        np.copyto(flipped[:, :, 1], data[0], casting="unsafe")
+        np.copyto(flipped[:, :, 2], data[1], casting="unsafe")
+
+    return Image.fromarray(pixels, mode="RGB")
 
-    # Flip Y
-    image = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
 
-    return image
+@functools.lru_cache(maxsize=16)
+def _inverse_power_lut(power: float, max_value: float) -> np.ndarray:
+    """
+    Spectrogram magnitude for each of the 256 possible pixel values.
+
+    Computed with the same float32 operations as the per-pixel formula, so looking values up
+    gives exactly the same result as computing them.
+    """
+    lut = np.arange(256, dtype=np.float32)
+    lut = 255 - lut
+    lut = lut / 255
+    lut = np.power(lut, 1 / power)
+    lut = lut * max_value
+    lut.flags.writeable = False
+    return lut
 
 
 def spectrogram_from_image(
@@ -81,33 +100,18 @@ def spectrogram_from_image(
     if image.mode in ("P", "L"):
         image = image.convert("RGB")
 
-    # Flip Y
-    image = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    # Flip Y with a reversed view of the pixels
+    pixels = np.asarray(image)[::-1]
 
-    # Munge channels into a numpy array of (channels, frequency, time)
-    data = np.array(image).transpose(2, 0, 1)
+    # Take the channels as (channels, frequency, time) views
     if stereo:
         # Take the G and B channels as done in image_from_spectrogram
-        data = data[[1, 2], :, :]
+        channels = pixels[:, :, 1:3].transpose(2, 0, 1)
     else:
-        data = data[0:1, :, :]
-
-    # Convert to floats
-    data = data.astype(np.float32)
-
-    # Invert
-    data = 255 - data
-
-    # Rescale to 0-1
-    data = data / 255
-
-    # Reverse the power curve
-    data = np.power(data, 1 / power)
-
-    # Rescale to max value
-    data = data * max_value
+        channels = pixels[None, :, :, 0]
 
-    return data
+    # Invert, rescale, reverse the power curve and rescale to max value in one table lookup
+    return _inverse_power_lut(power, max_value)[channels]
 
 
 def exif_from_image(pil_image: Image.Image) -> T.Dict[str, T.Any]:
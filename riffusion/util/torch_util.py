@@ -1,3 +1,4 @@
+import typing as T
 import warnings
 
 import numpy as np
@@ -19,30 +20,105 @@ def check_device(device: str, backup: str = "cpu") -> str:
 
 
 def slerp(
-    t: float, v0: torch.Tensor, v1: torch.Tensor, dot_threshold: float = 0.9995
+    t: T.Union[float, T.Sequence[float], torch.Tensor],
+    v0: torch.Tensor,
+    v1: torch.Tensor,
+    dot_threshold: float = 0.9995,
 ) -> torch.Tensor:
     """
     Helper function to spherically interpolate two arrays v1 v2.
+
+    Tensors are interpolated on their own device without copies to the host or synchronization,
+    in at least float32, and the result has the dtype of v0. Falls back to linear interpolation
+    when the inputs are nearly parallel. NumPy arrays are interpolated with NumPy.
+
+    Args:
+        t: Interpolation alpha, or a 1D sequence or tensor of alphas to interpolate a whole
+           sweep at once
+        v0: Start point
+        v1: End point, of the same shape
+        dot_threshold: Normalized dot product above which to interpolate linearly
+
+    Returns:
+        Interpolated tensor of the shape of v0, or (len(t), *v0.shape) for a sequence of alphas
+    """
+    if isinstance(v0, np.ndarray):
+        return _slerp_numpy(t, v0, v1, dot_threshold=dot_threshold)
+
+    compute_dtype = torch.promote_types(v0.dtype, torch.float32)
+    a = v0.to(compute_dtype)
+    b = v1.to(device=v0.device, dtype=compute_dtype)
+
+    if not isinstance(t, (int, float)):
+        t = torch.as_tensor(t, dtype=compute_dtype, device=v0.device)
+        if t.dim() > 0:
+            t = t.reshape(-1, *([1] * v0.dim()))
+
+    dot = torch.sum(a * b) / (torch.linalg.vector_norm(a) * torch.linalg.vector_norm(b))
+
+    theta_0 = torch.arccos(dot.clamp(-1.0, 1.0))
+    sin_theta_0 = torch.sin(theta_0).clamp(min=torch.finfo(compute_dtype).tiny)
+    theta_t = theta_0 * t
+    s0 = torch.sin(theta_0 - theta_t) / sin_theta_0
+    s1 = torch.sin(theta_t) / sin_theta_0
+
+    # Choose between the spherical and linear weights on device, instead of branching on the
+    # dot product in Python, which would wait for the device
+    linear = dot.abs() > dot_threshold
+    s0 = torch.where(linear, 1 - t, s0)
+    s1 = torch.where(linear, t, s1)
+
+    return (s0 * a + s1 * b).to(v0.dtype)
+
+
+def _slerp_numpy(
+    t: T.Union[float, T.Sequence[float], np.ndarray],
+    v0: np.ndarray,
+    v1: np.ndarray,
+    dot_threshold: float = 0.9995,
+) -> np.ndarray:
     """
-    if not isinstance(v0, np.ndarray):
-        inputs_are_torch = True
-        input_device = v0.device
-        v0 = v0.cpu().numpy()
-        v1 = v1.cpu().numpy()
+    NumPy version of slerp.
+    """
+    if not isinstance(t, (int, float)):
+        t = np.asarray(t, dtype=np.float64)
+        if t.ndim > 0:
+            t = t.reshape(-1, *([1] * v0.ndim))
 
     dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
     if np.abs(dot) > dot_threshold:
-        v2 = (1 - t) * v0 + t * v1
-    else:
-        theta_0 = np.arccos(dot)
-        sin_theta_0 = np.sin(theta_0)
-        theta_t = theta_0 * t
-        sin_theta_t = np.sin(theta_t)
-        s0 = np.sin(theta_0 - theta_t) / sin_theta_0
-        s1 = sin_theta_t / sin_theta_0
-        v2 = s0 * v0 + s1 * v1
-
-    if inputs_are_torch:
-        v2 = torch.from_numpy(v2).to(input_device)
-
-    return v2
+        return (1 - t) * v0 + t * v1
+
+    theta_0 = np.arccos(dot)
+    sin_theta_0 = np.sin(theta_0)
+    theta_t = theta_0 * t
+    sin_theta_t = np.sin(theta_t)
+    s0 = np.sin(theta_0 - theta_t) / sin_theta_0
+    s1 = sin_theta_t / sin_theta_0
+    return s0 * v0 + s1 * v1
+
+
+def module_num_bytes(module: torch.nn.Module) -> int:
+    """
+    Memory held by the parameters and buffers of a torch module.
+    """
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def pipeline_num_bytes(pipeline: T.Any) -> int:
+    """
+    Memory held by all torch modules of a diffusers pipeline (or a single module).
+    """
+    if isinstance(pipeline, torch.nn.Module):
+        return module_num_bytes(pipeline)
+
+    components = getattr(pipeline, "components", None)
+    if components is None:
+        components = vars(pipeline)
+
+    return sum(
+        module_num_bytes(component)
+        for component in components.values()
+        if isinstance(component, torch.nn.Module)
+    )
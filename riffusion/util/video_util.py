@@ -0,0 +1,441 @@
+"""
+Video utility functions built on the ffmpeg binary that moviepy ships with.
+"""
+import bisect
+import json
+import os
+import re
+import shutil
+import subprocess
+import typing as T
+
+import numpy as np
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+_SHOWINFO_PTS_TIME = re.compile(r"pts_time:\s*([-+]?[0-9]*\.?[0-9]+)")
+
+# Streams kept when a cut is assembled from pieces, the same on every piece
+CONCAT_MAPS = ("0:v:0", "0:a:0?")
+
+# Stream parameters that have to be equal for pieces to be concatenated without re-encoding
+CONCAT_STREAM_PARAMS = {
+    "video": ("codec_name", "profile", "level", "pix_fmt", "width", "height", "time_base"),
+    "audio": ("codec_name", "profile", "sample_rate", "channels"),
+}
+
+# Encoders that produce a stream of the codec that ffprobe reports
+VIDEO_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+AUDIO_ENCODERS = {"aac": "aac", "mp3": "libmp3lame", "opus": "libopus", "ac3": "ac3"}
+
+
+def ffmpeg_binary() -> str:
+    """
+    Path of the ffmpeg executable used by moviepy.
+    """
+    return get_setting("FFMPEG_BINARY")
+
+
+def run_ffmpeg(
+    args: T.Sequence[str], input: T.Optional[T.Union[bytes, memoryview]] = None
+) -> str:
+    """
+    Run ffmpeg with the given arguments and return its log output. `input` is written to
+    ffmpeg's stdin.
+
+    Raises:
+        RuntimeError: If ffmpeg exits with a non-zero status
+    """
+    command = [ffmpeg_binary(), "-hide_banner", "-nostdin", *args]
+    if input is not None:
+        command.remove("-nostdin")
+
+    result = subprocess.run(command, input=input, capture_output=True)
+    log = result.stderr.decode("utf-8", errors="replace")
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed ({result.returncode}): {' '.join(command)}\n{log}")
+
+    return log
+
+
+def ffprobe_binary() -> T.Optional[str]:
+    """
+    Path of an ffprobe executable next to the ffmpeg binary or on the PATH, None if there is none.
+    """
+    ffmpeg = ffmpeg_binary()
+    directory, name = os.path.split(ffmpeg)
+    sibling = os.path.join(directory, name.replace("ffmpeg", "ffprobe"))
+    if directory and sibling != ffmpeg and os.path.isfile(sibling):
+        return sibling
+    return shutil.which("ffprobe")
+
+
+def probe_streams(path: str) -> T.List[T.Dict[str, T.Any]]:
+    """
+    Parameters of every stream of a media file, as reported by ffprobe.
+
+    Raises:
+        RuntimeError: If ffprobe is not available or fails
+    """
+    binary = ffprobe_binary()
+    if binary is None:
+        raise RuntimeError("ffprobe is not available")
+
+    command = [binary, "-v", "error", "-show_streams", "-of", "json", path]
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        log = result.stderr.decode("utf-8", errors="replace")
+        raise RuntimeError(f"ffprobe failed ({result.returncode}): {' '.join(command)}\n{log}")
+
+    return json.loads(result.stdout)["streams"]
+
+
+def first_stream(
+    streams: T.Sequence[T.Dict[str, T.Any]], codec_type: str
+) -> T.Optional[T.Dict[str, T.Any]]:
+    """
+    The first stream of the given type ("video" or "audio"), or None.
+    """
+    return next((s for s in streams if s.get("codec_type") == codec_type), None)
+
+
+def concat_signature(path: str) -> T.List[T.Tuple]:
+    """
+    The parameters of each stream of a file that must match for it to be concatenated with
+    another file by stream copy.
+    """
+    return [
+        (stream["codec_type"], *(stream.get(k) for k in CONCAT_STREAM_PARAMS[stream["codec_type"]]))
+        for stream in probe_streams(path)
+        if stream.get("codec_type") in CONCAT_STREAM_PARAMS
+    ]
+
+
+def matching_encoder_args(streams: T.Sequence[T.Dict[str, T.Any]]) -> T.List[str]:
+    """
+    ffmpeg output arguments that encode the first video and audio stream with the codec,
+    profile, level, pixel format, size and time base they have in the source, as described by
+    probe_streams, so that the result can be concatenated with stream copies of the source.
+
+    Raises:
+        ValueError: If there is no known encoder for a codec of the source
+    """
+    video = first_stream(streams, "video")
+    if video is None or video.get("codec_name") not in VIDEO_ENCODERS:
+        raise ValueError(f"No matching encoder for video stream {video}")
+
+    args = ["-c:v", VIDEO_ENCODERS[video["codec_name"]]]
+    profile = video.get("profile")
+    if profile:
+        # ffprobe reports e.g. "Constrained Baseline" or "High 4:2:2", encoders take "high422"
+        profile = profile.lower().replace("constrained ", "").replace(":", "").replace(" ", "")
+        args += ["-profile:v", profile]
+    level = video.get("level")
+    if video["codec_name"] == "h264" and isinstance(level, int) and level > 0:
+        args += ["-level:v", f"{level / 10:.1f}"]
+    args += [
+        "-pix_fmt",
+        video["pix_fmt"],
+        "-s",
+        f"{video['width']}x{video['height']}",
+    ]
+    time_base = video.get("time_base", "")
+    if time_base.startswith("1/"):
+        args += ["-video_track_timescale", time_base[2:]]
+
+    audio = first_stream(streams, "audio")
+    if audio is None:
+        return args + ["-an"]
+    if audio.get("codec_name") not in AUDIO_ENCODERS:
+        raise ValueError(f"No matching encoder for audio stream {audio}")
+
+    return args + [
+        "-c:a",
+        AUDIO_ENCODERS[audio["codec_name"]],
+        "-ar",
+        str(audio["sample_rate"]),
+        "-ac",
+        str(audio["channels"]),
+    ]
+
+
+def duration_s(path: str) -> float:
+    """
+    Duration of a media file in seconds, read from the container header.
+    """
+    return float(ffmpeg_parse_infos(path)["duration"])
+
+
+def keyframe_times(path: str) -> T.List[float]:
+    """
+    Presentation times in seconds of all keyframes of the first video stream, empty if none
+    could be found.
+
+    Only keyframes are decoded, so this is much cheaper than a full decode.
+    """
+    log = run_ffmpeg(
+        [
+            "-skip_frame",
+            "nokey",
+            "-i",
+            path,
+            "-map",
+            "0:v:0",
+            "-vf",
+            "showinfo",
+            "-an",
+            "-f",
+            "null",
+            "-",
+        ]
+    )
+    return sorted({float(match) for match in _SHOWINFO_PTS_TIME.findall(log)})
+
+
+def nearest_keyframe(times: T.Sequence[float], t: float) -> T.Optional[float]:
+    """
+    The keyframe time closest to t, given sorted keyframe times, or None if there are none.
+    """
+    if not times:
+        return None
+    index = bisect.bisect_left(times, t)
+    candidates = times[max(index - 1, 0) : index + 1]
+    return min(candidates, key=lambda k: abs(k - t))
+
+
+def next_keyframe(times: T.Sequence[float], t: float) -> T.Optional[float]:
+    """
+    The first keyframe time at or after t, given sorted keyframe times.
+    """
+    index = bisect.bisect_left(times, t)
+    return times[index] if index < len(times) else None
+
+
+def cut_stream_copy(
+    input_path: str,
+    output_path: str,
+    start_s: float,
+    end_s: float,
+    maps: T.Sequence[str] = ("0",),
+) -> None:
+    """
+    Cut [start_s, end_s) out of a video without decoding or encoding.
+
+    The start should be a keyframe, otherwise the output begins at the preceding keyframe.
+    `maps` selects the streams to keep, all of them by default.
+    """
+    map_args = [arg for stream in maps for arg in ("-map", stream)]
+    run_ffmpeg(
+        [
+            "-y",
+            "-ss",
+            f"{start_s:.6f}",
+            "-i",
+            input_path,
+            "-t",
+            f"{end_s - start_s:.6f}",
+            *map_args,
+            "-c",
+            "copy",
+            "-avoid_negative_ts",
+            "make_zero",
+            output_path,
+        ]
+    )
+
+
+def cut_reencode(
+    input_path: str,
+    output_path: str,
+    start_s: float,
+    end_s: float,
+    codec: str = "libx264",
+    audio_codec: str = "aac",
+    threads: T.Optional[int] = None,
+) -> None:
+    """
+    Cut [start_s, end_s) out of a video with frame accuracy by re-encoding it.
+    """
+    thread_args = ["-threads", str(threads)] if threads else []
+    run_ffmpeg(
+        [
+            "-y",
+            "-ss",
+            f"{start_s:.6f}",
+            "-i",
+            input_path,
+            "-t",
+            f"{end_s - start_s:.6f}",
+            "-c:v",
+            codec,
+            "-c:a",
+            audio_codec,
+            *thread_args,
+            output_path,
+        ]
+    )
+
+
+def cut_reencode_matching(
+    input_path: str,
+    output_path: str,
+    start_s: float,
+    end_s: float,
+    streams: T.Sequence[T.Dict[str, T.Any]],
+    threads: T.Optional[int] = None,
+) -> None:
+    """
+    Cut [start_s, end_s) out of a video by re-encoding it with the stream parameters of the
+    source, keeping the streams of CONCAT_MAPS. See matching_encoder_args.
+
+    Raises:
+        ValueError: If there is no known encoder for a codec of the source
+    """
+    encoder_args = matching_encoder_args(streams)
+    map_args = [arg for stream in CONCAT_MAPS for arg in ("-map", stream)]
+    thread_args = ["-threads", str(threads)] if threads else []
+    run_ffmpeg(
+        [
+            "-y",
+            "-ss",
+            f"{start_s:.6f}",
+            "-i",
+            input_path,
+            "-t",
+            f"{end_s - start_s:.6f}",
+            *map_args,
+            *encoder_args,
+            *thread_args,
+            output_path,
+        ]
+    )
+
+
+def replace_audio(
+    video_path: str,
+    audio_path: str,
+    output_path: str,
+    duration_s: T.Optional[float] = None,
+    audio_codec: str = "aac",
+) -> None:
+    """
+    Replace the soundtrack of a video, stream copying the video track.
+
+    Args:
+        video_path: Video whose video track is kept as is
+        audio_path: Audio file to use as the new soundtrack
+        output_path: Where to write the muxed video
+        duration_s: Trim the output to this duration at the container level
+        audio_codec: Codec for the new soundtrack, or "copy" to keep it as is
+    """
+    duration_args = ["-t", f"{duration_s:.6f}"] if duration_s is not None else []
+    run_ffmpeg(
+        [
+            "-y",
+            "-i",
+            video_path,
+            "-i",
+            audio_path,
+            "-map",
+            "0:v:0",
+            "-map",
+            "1:a:0",
+            "-c:v",
+            "copy",
+            "-c:a",
+            audio_codec,
+            *duration_args,
+            output_path,
+        ]
+    )
+
+
+def replace_audio_pcm(
+    video_path: str,
+    samples: np.ndarray,
+    sample_rate: int,
+    output_path: str,
+    duration_s: T.Optional[float] = None,
+    audio_codec: str = "aac",
+) -> None:
+    """
+    Replace the soundtrack of a video with a waveform, stream copying the video track.
+
+    The samples are piped to ffmpeg as raw float PCM, so the audio never goes through an
+    intermediate file.
+
+    Args:
+        video_path: Video whose video track is kept as is
+        samples: (channels, samples) float waveform in [-1, 1]
+        sample_rate: Sample rate of the waveform
+        output_path: Where to write the muxed video
+        duration_s: Trim the output to this duration at the container level
+        audio_codec: Codec for the new soundtrack. Raw float PCM can't be stream copied into
+                     a video container, so "copy" is not accepted.
+
+    Raises:
+        ValueError: If audio_codec is "copy"
+    """
+    if audio_codec == "copy":
+        raise ValueError("A waveform has to be encoded, audio_codec can't be 'copy'")
+
+    channels = samples.shape[0] if samples.ndim == 2 else 1
+
+    # Interleave the channels, this is a view for mono float32 input
+    pcm = np.ascontiguousarray(samples.reshape(channels, -1).T, dtype="<f4")
+
+    duration_args = ["-t", f"{duration_s:.6f}"] if duration_s is not None else []
+    run_ffmpeg(
+        [
+            "-y",
+            "-i",
+            video_path,
+            "-f",
+            "f32le",
+            "-ar",
+            str(sample_rate),
+            "-ac",
+            str(channels),
+            "-i",
+            "pipe:0",
+            "-map",
+            "0:v:0",
+            "-map",
+            "1:a:0",
+            "-c:v",
+            "copy",
+            "-c:a",
+            audio_codec,
+            *duration_args,
+            output_path,
+        ],
+        input=memoryview(pcm).cast("B"),
+    )
+
+
+def concat_stream_copy(input_paths: T.Sequence[str], output_path: str, list_path: str) -> None:
+    """
+    Concatenate videos with identical stream layouts without re-encoding.
+
+    The concat demuxer does not check the layouts and ffmpeg succeeds on mismatched inputs
+    while writing a broken file, so check them with concat_signature first.
+    """
+    with open(list_path, "w") as f:
+        for path in input_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    run_ffmpeg(
+        [
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            list_path,
+            "-c",
+            "copy",
+            output_path,
+        ]
+    )
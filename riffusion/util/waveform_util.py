@@ -0,0 +1,286 @@
+"""
+Audio processing on float waveforms held in numpy arrays.
+
+Waveforms are (channels, samples) float32 arrays with full scale at [-1, 1], matching the
+dBFS convention of pydub. These are vectorized counterparts of the pydub effects used in
+riffusion.util.audio_util, which converts to and from pydub only at its edges.
+"""
+import typing as T
+
+import numpy as np
+import pydub
+
+# Integer type holding the samples of each sample width. 24-bit samples are widened to 32 bits.
+_DTYPES = {1: np.dtype(np.int8), 2: np.dtype("<i2"), 3: np.dtype("<i4"), 4: np.dtype("<i4")}
+
+
+def db_to_ratio(db: float) -> float:
+    """
+    Amplitude ratio of a gain in decibels.
+    """
+    return 10 ** (db / 20)
+
+
+def ratio_to_db(ratio: float) -> float:
+    """
+    Gain in decibels of an amplitude ratio.
+    """
+    return 20 * np.log10(ratio)
+
+
+def full_scale(sample_width: int) -> int:
+    """
+    Integer value of a float sample of 1.0 at the given sample width, 2 ** (bits - 1).
+
+    Both from_segment and to_segment scale by it, so that converting back and forth is exact.
+    """
+    return 2 ** (8 * sample_width - 1)
+
+
+def from_segment(segment: pydub.AudioSegment) -> np.ndarray:
+    """
+    Convert an audio segment to a float waveform.
+
+    Returns:
+        samples: (channels, samples) float32 array
+    """
+    if segment.sample_width not in _DTYPES:
+        segment = segment.set_sample_width(2)
+
+    if segment.sample_width == 3:
+        # Shift every 24-bit sample into the high bytes of a 32-bit one
+        packed = np.frombuffer(segment.raw_data, dtype=np.uint8).reshape(-1, 3)
+        widened = np.zeros((packed.shape[0], 4), dtype=np.uint8)
+        widened[:, 1:] = packed
+        samples = widened.view(_DTYPES[3]).ravel() >> 8
+    else:
+        samples = np.frombuffer(segment.raw_data, dtype=_DTYPES[segment.sample_width])
+
+    samples = samples.reshape(-1, segment.channels).T
+    return samples.astype(np.float32) * (1 / full_scale(segment.sample_width))
+
+
+def to_segment(
+    samples: np.ndarray, sample_rate: int, sample_width: int = 2
+) -> pydub.AudioSegment:
+    """
+    Convert a float waveform to an audio segment, rounding to the nearest integer sample and
+    clipping at full scale.
+
+    Args:
+        samples: (channels, samples) float array
+        sample_rate: Sample rate of the waveform
+        sample_width: Bytes per sample of the segment, 1, 2, 3 or 4
+    """
+    if sample_width not in _DTYPES:
+        raise ValueError(f"Unsupported sample width {sample_width}")
+
+    samples = np.atleast_2d(samples)
+    scale = full_scale(sample_width)
+
+    # Interleave the channels and scale into the integer range
+    scaled = np.multiply(samples.T, scale, dtype=np.float64)
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -scale, scale - 1, out=scaled)
+    scaled = scaled.astype(_DTYPES[sample_width])
+
+    if sample_width == 3:
+        # Keep the three low bytes of every little endian 32-bit sample
+        data = scaled.reshape(-1, 1).view(np.uint8)[:, :3].tobytes()
+    else:
+        data = scaled.tobytes()
+
+    return pydub.AudioSegment(
+        data=data,
+        sample_width=sample_width,
+        frame_rate=sample_rate,
+        channels=samples.shape[0],
+    )
+
+
+def peak(samples: np.ndarray) -> float:
+    """
+    Largest absolute sample value.
+    """
+    return float(np.max(np.abs(samples))) if samples.size else 0.0
+
+
+def rms(samples: np.ndarray) -> float:
+    """
+    Root mean square over all channels.
+    """
+    return float(np.sqrt(np.mean(np.square(samples, dtype=np.float64)))) if samples.size else 0.0
+
+
+def dbfs(samples: np.ndarray) -> float:
+    """
+    RMS level in decibels relative to full scale, -inf for silence.
+    """
+    level = rms(samples)
+    return ratio_to_db(level) if level > 0 else -np.inf
+
+
+def apply_gain(samples: np.ndarray, gain_db: float, clip: bool = True) -> np.ndarray:
+    """
+    Apply a gain in decibels in place, clipping at full scale like pydub does.
+    """
+    samples *= db_to_ratio(gain_db)
+    if clip:
+        np.clip(samples, -1.0, 1.0, out=samples)
+    return samples
+
+
+def normalize(samples: np.ndarray, headroom_db: float = 0.1) -> np.ndarray:
+    """
+    Scale in place so that the peak is `headroom_db` below full scale. Silence is left as is.
+    """
+    current_peak = peak(samples)
+    if current_peak > 0:
+        samples *= db_to_ratio(-headroom_db) / current_peak
+    return samples
+
+
+def compress_dynamic_range(
+    samples: np.ndarray,
+    sample_rate: int,
+    threshold_db: float = -20.0,
+    ratio: float = 4.0,
+    attack_ms: float = 5.0,
+    release_ms: float = 50.0,
+    block_size: int = 64,
+) -> np.ndarray:
+    """
+    Feed-forward compressor with the same gain law as pydub.effects.compress_dynamic_range.
+
+    The level is the RMS over the last `attack_ms`, computed for all samples at once from a
+    cumulative sum. The attenuation then ramps towards (1 - 1/ratio) times the level over the
+    threshold in steps of `block_size` samples rather than per sample, and is interpolated
+    back to every sample. Applied in place.
+
+    Args:
+        samples: (channels, samples) float32 array
+        sample_rate: Sample rate of the waveform
+        threshold_db: Level above which the signal is attenuated
+        ratio: Compression ratio above the threshold
+        attack_ms: Time to reach full attenuation, also the level window
+        release_ms: Time to release full attenuation
+        block_size: Samples per attenuation update
+    """
+    num_samples = samples.shape[-1]
+    if num_samples == 0:
+        return samples
+
+    threshold = db_to_ratio(threshold_db)
+    look = max(1, int(sample_rate * attack_ms / 1000))
+    attack_blocks = max(1.0, sample_rate * attack_ms / 1000 / block_size)
+    release_blocks = max(1.0, sample_rate * release_ms / 1000 / block_size)
+
+    # RMS over the trailing window ending at the start of every block
+    power = np.square(np.atleast_2d(samples), dtype=np.float64).mean(axis=0)
+    cumulative = np.concatenate([[0.0], np.cumsum(power)])
+    ends = np.arange(0, num_samples, block_size)
+    starts = np.maximum(ends - look, 0)
+    counts = np.maximum(ends - starts, 1)
+    level = np.sqrt(np.maximum(cumulative[ends] - cumulative[starts], 0) / counts)
+
+    over_db = np.zeros_like(level)
+    loud = level > threshold
+    over_db[loud] = ratio_to_db(level[loud] / threshold)
+    max_attenuation = (1 - 1 / ratio) * over_db
+
+    # The ramp depends on the previous value, so this loop is over blocks, not samples
+    attenuation = np.empty_like(max_attenuation)
+    current = 0.0
+    for i, (target, is_loud) in enumerate(zip(max_attenuation.tolist(), loud.tolist())):
+        if is_loud and current <= target:
+            current = min(current + target / attack_blocks, target)
+        else:
+            current = max(current - target / release_blocks, 0.0)
+        attenuation[i] = current
+
+    gain = np.interp(
+        np.arange(num_samples), ends, np.power(10.0, -attenuation / 20)
+    ).astype(samples.dtype)
+    samples *= gain
+    return samples
+
+
+def apply_filters(
+    samples: np.ndarray, sample_rate: int, compression: bool = False
+) -> np.ndarray:
+    """
+    Same post-processing as riffusion.util.audio_util.apply_filters, in place: optional
+    compression, then gain to -12 dBFS and normalization to -0.1 dBFS peak.
+    """
+    if compression:
+        normalize(samples, headroom_db=0.1)
+        apply_gain(samples, -10 - dbfs(samples))
+        compress_dynamic_range(
+            samples,
+            sample_rate,
+            threshold_db=-20.0,
+            ratio=4.0,
+            attack_ms=5.0,
+            release_ms=50.0,
+        )
+
+    level = dbfs(samples)
+    if np.isfinite(level):
+        apply_gain(samples, -12 - level)
+
+    return normalize(samples, headroom_db=0.1)
+
+
+def stitch(waveforms: T.Sequence[np.ndarray], crossfade_samples: int) -> np.ndarray:
+    """
+    Concatenate waveforms with a linear crossfade of `crossfade_samples` between neighbours.
+
+    The output is allocated once and every input is written into it once, so the cost is
+    linear in the total length no matter how many waveforms there are.
+    """
+    assert len(waveforms) > 0
+    waveforms = [np.atleast_2d(w) for w in waveforms]
+
+    for w in waveforms[1:]:
+        if crossfade_samples > min(w.shape[-1], waveforms[0].shape[-1]):
+            raise ValueError("Crossfade is longer than a waveform")
+
+    total = sum(w.shape[-1] for w in waveforms) - crossfade_samples * (len(waveforms) - 1)
+    output = np.zeros((waveforms[0].shape[0], total), dtype=np.float32)
+
+    fade_in = np.linspace(0.0, 1.0, crossfade_samples, dtype=np.float32)
+    fade_out = fade_in[::-1]
+
+    position = 0
+    for i, w in enumerate(waveforms):
+        length = w.shape[-1]
+        if i == 0 or crossfade_samples == 0:
+            output[:, position : position + length] = w
+        else:
+            output[:, position : position + crossfade_samples] *= fade_out
+            output[:, position : position + crossfade_samples] += w[:, :crossfade_samples] * fade_in
+            output[:, position + crossfade_samples : position + length] = w[
+                :, crossfade_samples:
+            ]
+        position += length - crossfade_samples
+
+    return output
+
+
+def overlay(waveforms: T.Sequence[np.ndarray]) -> np.ndarray:
+    """
+    Mix waveforms on top of each other in one pass, clipping at full scale.
+
+    Like pydub's overlay, the output has the length of the first waveform and longer ones
+    are cut.
+    """
+    assert len(waveforms) > 0
+    waveforms = [np.atleast_2d(w) for w in waveforms]
+
+    length = waveforms[0].shape[-1]
+    output = np.zeros((waveforms[0].shape[0], length), dtype=np.float32)
+    for w in waveforms:
+        n = min(length, w.shape[-1])
+        output[:, :n] += w[:, :n]
+
+    return np.clip(output, -1.0, 1.0, out=output)